@@ -0,0 +1,400 @@
+import os
+import math
+import time
+import heapq
+import pickle
+import random
+import logging
+import argparse
+import numpy as np
+from export import load_records
+from localsearch import LocalSearchIndex, sample_queries
+
+try:
+    import hnswlib
+except ImportError:
+    # Optional: without it the pure Python HnswIndex is used, which suits tens of thousands of cases
+    hnswlib = None
+
+logger = logging.getLogger(__name__)
+
+# Cases passed to hnswlib in one call, which bounds the vectors copied out of a memory-mapped export
+HNSWLIB_ADD_BLOCK = 100000
+
+
+# Hierarchical Navigable Small World graph over unit-normalized case vectors, matching the HNSW algorithm
+# behind the "myHnsw" vector search configuration of the Azure AI Search index. m is the number of links
+# per node (twice that on the bottom layer), ef_construction the candidate list size while inserting,
+# and ef_search the candidate list size while querying.
+class HnswIndex:
+    def __init__(self, dimensions, m=16, ef_construction=100, ef_search=64, seed=0):
+        self.dimensions = dimensions
+        self.m = m
+        self.m0 = 2 * m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.level_multiplier = 1 / math.log(m)
+        self.rng = random.Random(seed)
+
+        self.vectors = np.zeros((0, dimensions), dtype=np.float32)
+        self.count = 0
+        self.levels = []
+        self.links = []
+        self.labels = []
+        self.label_rows = {}
+        self.entry_point = None
+        self.max_level = -1
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, label):
+        return label in self.label_rows
+
+    def distances(self, query, nodes):
+        return 1 - self.vectors[nodes] @ query
+
+    # Greedy best-first search of one layer, returning up to ef (distance, node) pairs, closest first
+    def search_layer(self, query, entry_points, ef, level):
+        layer = self.links[level]
+        visited = set(entry_points)
+        distances = self.distances(query, entry_points).tolist()
+        candidates = list(zip(distances, entry_points))
+        heapq.heapify(candidates)
+        results = [(-distance, node) for distance, node in candidates]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            distance, node = heapq.heappop(candidates)
+            if distance > -results[0][0] and len(results) >= ef:
+                break
+            neighbors = [neighbor for neighbor in layer.get(node, ()) if neighbor not in visited]
+            if not neighbors:
+                continue
+            visited.update(neighbors)
+            worst = -results[0][0]
+            for neighbor_distance, neighbor in zip(self.distances(query, neighbors).tolist(), neighbors):
+                if len(results) < ef or neighbor_distance < worst:
+                    heapq.heappush(candidates, (neighbor_distance, neighbor))
+                    heapq.heappush(results, (-neighbor_distance, neighbor))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+                    worst = -results[0][0]
+
+        return sorted((-distance, node) for distance, node in results)
+
+    # Neighbor selection heuristic: keep a candidate only if it is closer to the new node than to any
+    # neighbor already kept, which spreads links across clusters. Pruned candidates fill any spare slots.
+    # Each candidate's highest similarity to a kept neighbor is updated with one product per kept neighbor,
+    # rather than comparing every candidate with every kept neighbor.
+    def select_neighbors(self, candidates, m):
+        if len(candidates) <= 1:
+            return [node for _, node in candidates]
+        nodes = [node for _, node in candidates]
+        vectors = self.vectors[nodes]
+        closest = np.full(len(nodes), -np.inf, dtype=np.float32)
+        selected = []
+        pruned = []
+        for position, (distance, node) in enumerate(candidates):
+            if len(selected) >= m:
+                break
+            if distance < 1 - closest[position]:
+                selected.append(node)
+                np.maximum(closest, vectors @ vectors[position], out=closest)
+            else:
+                pruned.append(node)
+        return selected + pruned[:m - len(selected)]
+
+    def add(self, vector, label):
+        if label in self.label_rows:
+            return self.label_rows[label]
+
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+
+        if self.count == len(self.vectors):
+            grown = np.zeros((max(16, 2 * len(self.vectors)), self.dimensions), dtype=np.float32)
+            grown[:self.count] = self.vectors[:self.count]
+            self.vectors = grown
+        node = self.count
+        self.vectors[node] = query
+        self.count += 1
+        self.labels.append(label)
+        self.label_rows[label] = node
+
+        level = int(-math.log(1 - self.rng.random()) * self.level_multiplier)
+        self.levels.append(level)
+        while len(self.links) <= level:
+            self.links.append({})
+        for layer in range(level + 1):
+            self.links[layer][node] = []
+
+        if self.entry_point is None:
+            self.entry_point = node
+            self.max_level = level
+            return node
+
+        entry_points = [self.entry_point]
+        for layer in range(self.max_level, level, -1):
+            entry_points = [self.search_layer(query, entry_points, 1, layer)[0][1]]
+
+        for layer in range(min(level, self.max_level), -1, -1):
+            found = self.search_layer(query, entry_points, self.ef_construction, layer)
+            max_links = self.m0 if layer == 0 else self.m
+            neighbors = self.select_neighbors(found, self.m)
+            self.links[layer][node] = neighbors
+            for neighbor in neighbors:
+                neighbor_links = self.links[layer][neighbor]
+                neighbor_links.append(node)
+                if len(neighbor_links) > max_links:
+                    # Over capacity, so re-select the neighbor's links with the same heuristic
+                    distances = self.distances(self.vectors[neighbor], neighbor_links).tolist()
+                    self.links[layer][neighbor] = self.select_neighbors(sorted(zip(distances, neighbor_links)), max_links)
+            entry_points = [node for _, node in found]
+
+        if level > self.max_level:
+            self.entry_point = node
+            self.max_level = level
+        return node
+
+    # Return the k nearest labels as (label, cosine similarity) pairs, best first
+    def search(self, query_vector, k=10, ef_search=None):
+        if self.entry_point is None:
+            return []
+        query = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+
+        entry_points = [self.entry_point]
+        for layer in range(self.max_level, 0, -1):
+            entry_points = [self.search_layer(query, entry_points, 1, layer)[0][1]]
+        found = self.search_layer(query, entry_points, max(ef_search or self.ef_search, k), 0)
+        return [(self.labels[node], 1 - distance) for distance, node in found[:k]]
+
+    # Insert the cases of an export that are not in the index yet, returning how many were added
+    def add_records(self, records, vectors):
+        added = 0
+        for record in records:
+            if record["CaseID"] not in self.label_rows:
+                self.add(vectors[record["VectorRow"]], record["CaseID"])
+                added += 1
+        return added
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        arrays = {
+            "vectors": self.vectors[:self.count],
+            "levels": np.asarray(self.levels, dtype=np.int32),
+            "labels": np.asarray(self.labels, dtype=str),
+            "params": np.asarray([self.m, self.ef_construction, self.ef_search, -1 if self.entry_point is None else self.entry_point, self.max_level], dtype=np.int64),
+        }
+        # Each layer's adjacency is stored as CSR style node, offset and neighbor arrays
+        for layer, links in enumerate(self.links):
+            nodes = np.fromiter(links.keys(), dtype=np.int64, count=len(links))
+            lengths = np.fromiter((len(links[node]) for node in nodes.tolist()), dtype=np.int64, count=len(nodes))
+            arrays[f"nodes_{layer}"] = nodes
+            arrays[f"offsets_{layer}"] = np.concatenate([[0], np.cumsum(lengths)])
+            arrays[f"neighbors_{layer}"] = np.fromiter((neighbor for node in nodes.tolist() for neighbor in links[node]), dtype=np.int64, count=int(lengths.sum()))
+        with open(path, "wb") as index_file:
+            np.savez(index_file, **arrays)
+        logger.info(f"Saved HNSW index of {self.count} cases to {path}.")
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            m, ef_construction, ef_search, entry_point, max_level = arrays["params"].tolist()
+            vectors = arrays["vectors"]
+            index = cls(vectors.shape[1], m, ef_construction, ef_search)
+            index.vectors = vectors.copy()
+            index.count = len(vectors)
+            index.levels = arrays["levels"].tolist()
+            index.labels = arrays["labels"].tolist()
+            index.label_rows = {label: row for row, label in enumerate(index.labels)}
+            index.entry_point = None if entry_point < 0 else entry_point
+            index.max_level = max_level
+            for layer in range(max_level + 1):
+                nodes = arrays[f"nodes_{layer}"].tolist()
+                offsets = arrays[f"offsets_{layer}"].tolist()
+                neighbors = arrays[f"neighbors_{layer}"].tolist()
+                index.links.append({node: neighbors[offsets[i]:offsets[i + 1]] for i, node in enumerate(nodes)})
+        return index
+
+
+# The same HNSW index on hnswlib, whose C++ implementation inserts with several threads and builds and
+# queries millions of cases where HnswIndex is only practical up to tens of thousands. hnswlib identifies
+# vectors by integer, so the CaseIDs are kept alongside in insertion order.
+class HnswlibIndex:
+    def __init__(self, dimensions, m=16, ef_construction=100, ef_search=64, seed=0):
+        self.dimensions = dimensions
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.index = hnswlib.Index(space="cosine", dim=dimensions)
+        self.index.init_index(max_elements=1024, M=m, ef_construction=ef_construction, random_seed=seed)
+        self.labels = []
+        self.label_rows = {}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, label):
+        return label in self.label_rows
+
+    # Insert the cases of an export that are not in the index yet, returning how many were added
+    def add_records(self, records, vectors):
+        new = {}
+        for record in records:
+            if record["CaseID"] not in self.label_rows:
+                new.setdefault(record["CaseID"], record["VectorRow"])
+        if not new:
+            return 0
+
+        needed = len(self.labels) + len(new)
+        if needed > self.index.get_max_elements():
+            self.index.resize_index(max(needed, 2 * self.index.get_max_elements()))
+        labels = list(new)
+        rows = np.fromiter(new.values(), dtype=np.int64, count=len(new))
+        for start in range(0, len(labels), HNSWLIB_ADD_BLOCK):
+            block = rows[start:start + HNSWLIB_ADD_BLOCK]
+            ids = np.arange(len(self.labels), len(self.labels) + len(block))
+            self.index.add_items(np.asarray(vectors[block], dtype=np.float32), ids)
+            for label in labels[start:start + HNSWLIB_ADD_BLOCK]:
+                self.label_rows[label] = len(self.labels)
+                self.labels.append(label)
+        return len(new)
+
+    # Return the k nearest labels as (label, cosine similarity) pairs, best first
+    def search(self, query_vector, k=10, ef_search=None):
+        if not self.labels:
+            return []
+        k = min(k, len(self.labels))
+        self.index.set_ef(max(ef_search or self.ef_search, k))
+        ids, distances = self.index.knn_query(np.asarray(query_vector, dtype=np.float32), k)
+        return [(self.labels[node], 1 - distance) for node, distance in zip(ids[0].tolist(), distances[0].tolist())]
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # The graph is stored as hnswlib's own pickled form, in the same .npz layout as HnswIndex.save
+        with open(path, "wb") as index_file:
+            np.savez(index_file, graph=np.frombuffer(pickle.dumps(self.index), dtype=np.uint8), labels=np.asarray(self.labels, dtype=str),
+                     params=np.asarray([self.m, self.ef_construction, self.ef_search], dtype=np.int64))
+        logger.info(f"Saved hnswlib index of {len(self)} cases to {path}.")
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            m, ef_construction, ef_search = arrays["params"].tolist()
+            index = cls.__new__(cls)
+            index.index = pickle.loads(arrays["graph"].tobytes())
+            index.dimensions = index.index.dim
+            index.m, index.ef_construction, index.ef_search = m, ef_construction, ef_search
+            index.labels = arrays["labels"].tolist()
+            index.label_rows = {label: row for row, label in enumerate(index.labels)}
+        return index
+
+
+# A new index on hnswlib when it is installed, unless backend asks for the pure Python one
+def create_index(dimensions, m, ef_construction, ef_search, backend="auto"):
+    if backend == "hnswlib" and hnswlib is None:
+        raise SystemExit("The hnswlib package is not installed, install it or use --backend python.")
+    if backend != "python" and hnswlib is not None:
+        return HnswlibIndex(dimensions, m, ef_construction, ef_search)
+    return HnswIndex(dimensions, m, ef_construction, ef_search)
+
+
+# Load an index saved by either implementation
+def load_index(path):
+    with np.load(path) as arrays:
+        uses_hnswlib = "graph" in arrays.files
+    if not uses_hnswlib:
+        return HnswIndex.load(path)
+    if hnswlib is None:
+        raise SystemExit(f"{path} was built with hnswlib, which is not installed.")
+    return HnswlibIndex.load(path)
+
+
+# Compare recall@k and latency of the HNSW index with exact search, for each efSearch setting
+def recall_report(index, records, vectors, queries, k, ef_values):
+    exact = LocalSearchIndex(records, vectors)
+
+    truth = []
+    start = time.perf_counter()
+    for query in queries:
+        truth.append({exact.records[row]["CaseID"] for row, _ in exact.top_k(query, k)})
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    report = [("exact", 1.0, exact_ms)]
+
+    for ef in ef_values:
+        found = 0
+        start = time.perf_counter()
+        results = [index.search(query, k, ef) for query in queries]
+        latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        for expected, result in zip(truth, results):
+            found += len(expected & {label for label, _ in result})
+        report.append((f"efSearch={ef}", found / sum(len(expected) for expected in truth), latency_ms))
+
+    logger.info(f"Recall@{k} over {len(queries)} queries and {len(index)} cases:")
+    for name, recall, latency_ms in report:
+        logger.info(f"  {name:<14} recall {recall:.3f}  mean latency {latency_ms:.3f} ms")
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build and evaluate an approximate nearest-neighbour index over the exported cases.")
+    parser.add_argument("command", choices=["build", "add", "report"], help="build a new index, add new cases to an existing one, or report recall against exact search.")
+    parser.add_argument("--index", default="scripts/indexdata", help="Export base path (without .ndjson/.npy) or an indexdata.json file.")
+    parser.add_argument("--output", default="scripts/.cache/cases.hnsw.npz", help="Where the HNSW index is saved.")
+    parser.add_argument("--m", type=int, default=16, help="Links per node (M).")
+    parser.add_argument("--ef-construction", type=int, default=100, help="Candidate list size while inserting (efConstruction).")
+    parser.add_argument("--ef-search", default="16,32,64,128", help="Comma separated candidate list sizes while querying (efSearch).")
+    parser.add_argument("-k", type=int, default=10, help="Number of neighbours for the recall report.")
+    parser.add_argument("--queries", type=int, default=200, help="Number of queries for the recall report.")
+    parser.add_argument("--backend", choices=["auto", "hnswlib", "python"], default="auto", help="Build with hnswlib, the pure Python implementation, or hnswlib when it is installed.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    records, vectors = load_records(args.index)
+    ef_values = [int(ef) for ef in args.ef_search.split(",")]
+
+    if not records:
+        raise SystemExit(f"The export {args.index} has no cases.")
+
+    if args.command == "build" or not os.path.exists(args.output):
+        if args.command != "build":
+            logger.info(f"No index at {args.output}, building one from the export.")
+        index = create_index(vectors.shape[1], args.m, args.ef_construction, ef_values[0], args.backend)
+    else:
+        index = load_index(args.output)
+        # HNSW cannot remove cases, so an index holding cases the export no longer has must be rebuilt
+        case_ids = {record["CaseID"] for record in records}
+        stale = [label for label in index.labels if label not in case_ids]
+        if stale:
+            raise SystemExit(f"The index at {args.output} has {len(stale)} cases that are not in the export, such as {stale[0]}. Run build to rebuild it.")
+
+    # The report also brings the index up to date first, so it measures the cases the export holds
+    start = time.perf_counter()
+    added = index.add_records(records, vectors)
+    if added or args.command != "report":
+        logger.info(f"Inserted {added} cases in {time.perf_counter() - start:.1f} s, {len(index)} cases in the index.")
+        index.save(args.output)
+    if args.command in ("build", "add"):
+        return
+
+    queries = sample_queries(records, vectors, args.queries)
+    recall_report(index, records, vectors, queries, args.k, ef_values)
+
+
+if __name__ == "__main__":
+    main()
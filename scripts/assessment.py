@@ -0,0 +1,165 @@
+import re
+import json
+
+MOULD_SEVERITIES = ("none", "mild", "moderate", "severe")
+TRADES = ("Plumber", "Electrician", "Carpenter", "Plasterer", "Decorator", "Roofer", "Glazier", "Bricklayer", "Damp specialist", "Gas engineer", "Pest control", "General builder", "Other")
+
+# JSON schema of a structured vision response, sent with response_format json_schema
+ASSESSMENT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "description": {"type": "string"},
+        "repair": {"type": "string"},
+        "tradesman": {"type": "string", "enum": list(TRADES)},
+        "mould_detected": {"type": "boolean"},
+        "mould_severity": {"type": "string", "enum": list(MOULD_SEVERITIES)},
+    },
+    "required": ["description", "repair", "tradesman", "mould_detected", "mould_severity"],
+    "additionalProperties": False,
+}
+
+# JSON schema of a response to several images, one assessment for each with the case ID it was given
+BATCH_ASSESSMENT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "assessments": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"case_id": {"type": "string"}, **ASSESSMENT_SCHEMA["properties"]},
+                "required": ["case_id", *ASSESSMENT_SCHEMA["required"]],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["assessments"],
+    "additionalProperties": False,
+}
+
+# Keywords that map a free text trade onto one of TRADES, for facets with a fixed set of values
+TRADE_KEYWORDS = (
+    ("plumb", "Plumber"), ("electric", "Electrician"), ("carpent", "Carpenter"), ("joiner", "Carpenter"),
+    ("plaster", "Plasterer"), ("decorat", "Decorator"), ("painter", "Decorator"), ("roof", "Roofer"),
+    ("glaz", "Glazier"), ("brick", "Bricklayer"), ("damp", "Damp specialist"), ("mould", "Damp specialist"),
+    ("gas", "Gas engineer"), ("heating", "Gas engineer"), ("pest", "Pest control"), ("builder", "General builder"),
+    ("handyman", "General builder"), ("maintenance", "General builder"),
+)
+
+# The headings of a free text response, in order
+HEADING_PATTERN = re.compile(r"\b(image description|repair needed|tradesman required|mould status)\s*:\s*", re.IGNORECASE)
+SEVERITY_PATTERN = re.compile(r"\b(severe|moderate|mild)", re.IGNORECASE)
+
+
+# The trade named earliest in the text, or Other
+def normalize_trade(text):
+    lower = text.lower()
+    matches = [(lower.find(keyword), trade) for keyword, trade in TRADE_KEYWORDS if keyword in lower]
+    return min(matches)[1] if matches else "Other"
+
+
+# The full description stored in SQL, embedded and indexed. It keeps the headings of the free text
+# format, so parse_text_assessment reads it back to the same fields.
+def format_description(summary, repair, tradesman, mould_detected, mould_severity):
+    if mould_detected:
+        mould_status = f"MOULD DETECTED, {mould_severity} severity" if mould_severity else "MOULD DETECTED"
+    else:
+        mould_status = "MOULD NOT DETECTED"
+    return f"Image Description: {summary}\nRepair needed: {repair}\nTradesman Required: {tradesman}\nMould Status: {mould_status}"
+
+
+def make_assessment(description, repair, tradesman, mould_detected, mould_severity, structured):
+    return {
+        "Description": description,
+        "Repair": repair,
+        "Tradesman": tradesman,
+        "MouldDetected": mould_detected,
+        "MouldSeverity": mould_severity,
+        "Structured": structured,
+    }
+
+
+# Check the fields of a decoded structured response. Returns None when one is missing or has the wrong type.
+def validate_assessment(data):
+    if not isinstance(data, dict):
+        return None
+    summary, repair, tradesman = data.get("description"), data.get("repair"), data.get("tradesman")
+    mould_detected, mould_severity = data.get("mould_detected"), data.get("mould_severity")
+    if not all(isinstance(value, str) for value in (summary, repair, tradesman, mould_severity)) or not isinstance(mould_detected, bool):
+        return None
+    mould_severity = mould_severity.strip().lower()
+    if mould_severity not in MOULD_SEVERITIES:
+        return None
+    # Keep the flag and the severity consistent, the flag is what the prompt asks about first
+    if not mould_detected:
+        mould_severity = "none"
+    elif mould_severity == "none":
+        mould_severity = None
+    tradesman = tradesman.strip()
+    if tradesman not in TRADES:
+        tradesman = normalize_trade(tradesman)
+    repair = repair.strip()
+    description = format_description(summary.strip(), repair, tradesman, mould_detected, mould_severity)
+    return make_assessment(description, repair, tradesman, mould_detected, mould_severity, True)
+
+
+# Read the fields from a free text response by its headings, keeping the text itself as the description.
+# Mould is detected by the MOULD DETECTED phrase the prompt asks for, as before structured responses.
+def parse_text_assessment(text):
+    parts = HEADING_PATTERN.split(text)
+    sections = {heading.lower(): content.strip() for heading, content in zip(parts[1::2], parts[2::2])}
+    mould_status = sections.get("mould status", text)
+    mould_detected = "MOULD DETECTED" in mould_status.upper()
+    if mould_detected:
+        severity = SEVERITY_PATTERN.search(mould_status) or SEVERITY_PATTERN.search(text)
+        mould_severity = severity.group(1).lower() if severity else None
+    else:
+        mould_severity = "none"
+    repair = sections.get("repair needed", "")
+    tradesman = normalize_trade(sections.get("tradesman required", ""))
+    return make_assessment(text, repair, tradesman, mould_detected, mould_severity, False)
+
+
+# Parse a vision response with one JSON decode and validation, falling back to the free text parser
+# for responses that are not valid structured output
+def parse_assessment(content):
+    content = content.strip()
+    if content.startswith("{"):
+        try:
+            assessment = validate_assessment(json.loads(content))
+        except ValueError:
+            assessment = None
+        if assessment is not None:
+            return assessment
+    return parse_text_assessment(content)
+
+
+# Split a response to several images into a response for each case, by the case ID given with each
+# assessment. Assessments that are invalid, for a case not in the request or given twice for the same
+# case are left out, so those cases can be described on their own.
+def split_assessments(content, case_ids):
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return {}
+    items = data.get("assessments") if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        return {}
+
+    expected = set(case_ids)
+    responses = {}
+    repeated = set()
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        case_id = str(item.get("case_id", "")).strip()
+        if case_id not in expected:
+            continue
+        fields = {key: value for key, value in item.items() if key != "case_id"}
+        if validate_assessment(fields) is None:
+            continue
+        if case_id in responses:
+            repeated.add(case_id)
+        responses[case_id] = json.dumps(fields)
+    for case_id in repeated:
+        del responses[case_id]
+    return responses
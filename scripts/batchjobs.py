@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Statuses of a batch job that will not change again
+FINISHED_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+# Writes requests to JSONL input files for the Azure OpenAI Batch API, submits each file as a batch job
+# once it is full and hands each result back by its custom_id. A file holds requests for one endpoint and
+# deployment, bounded by count and size to stay within the service's limits of 100,000 requests and 200 MB.
+# Requests are written to disk as they are added, so only the result callbacks are held in memory.
+#
+# With a journal, each submitted job is recorded until its results have been handed back. reattach() picks
+# up the jobs of an interrupted run, and a request added again with the custom_id it had in one of them
+# waits for that job rather than being submitted and paid for twice.
+class BatchJobs:
+    def __init__(self, client, name, endpoint, folder, max_requests, max_bytes, poll_interval=60, concurrency=4, metrics=None, journal=None):
+        self.client = client
+        self.name = name
+        self.endpoint = endpoint
+        self.folder = folder
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.poll_interval = poll_interval
+        self.metrics = metrics
+        self.journal = journal
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.file = None
+        self.path = None
+        self.callbacks = {}
+        self.file_bytes = 0
+        self.files = 0
+        self.tasks = set()
+        # Requests of jobs submitted by an interrupted run: their batch ID, results not yet claimed, and the
+        # callbacks of requests added again before their job finished, each by custom_id
+        self.resumed = {}
+        self.resumed_results = {}
+        self.resumed_callbacks = {}
+        os.makedirs(folder, exist_ok=True)
+
+    # Whether any request is still waiting to be submitted or for its job
+    @property
+    def pending(self):
+        return bool(self.callbacks or self.tasks)
+
+    # Queue a request. on_result is awaited with the response body once the job completes, or with None
+    # when the request failed.
+    async def add(self, custom_id, body, on_result):
+        if custom_id in self.resumed:
+            if custom_id in self.resumed_results:
+                del self.resumed[custom_id]
+                await on_result(self.resumed_results.pop(custom_id))
+            else:
+                self.resumed_callbacks[custom_id] = on_result
+            return
+
+        line = json.dumps({"custom_id": custom_id, "method": "POST", "url": self.endpoint, "body": body}) + "\n"
+        if self.callbacks and (len(self.callbacks) >= self.max_requests or self.file_bytes + len(line) > self.max_bytes):
+            self.submit()
+        if self.file is None:
+            self.files += 1
+            self.path = os.path.join(self.folder, f"{self.name}-{os.getpid()}-{self.files}.jsonl")
+            self.file = open(self.path, "w", encoding="utf-8")
+        self.file.write(line)
+        self.file_bytes += len(line)
+        self.callbacks[custom_id] = on_result
+
+    # Close the current file and submit it as a job in the background
+    def submit(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.start(self.run(self.path, self.callbacks))
+        self.file = None
+        self.path = None
+        self.callbacks = {}
+        self.file_bytes = 0
+
+    def start(self, job):
+        task = asyncio.create_task(job)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self, path, callbacks):
+        results = {}
+        start = time.perf_counter()
+        try:
+            async with self.semaphore:
+                start = time.perf_counter()
+                results = await self.run_job(path, list(callbacks))
+            os.remove(path)
+        except Exception as e:
+            # The input file is kept for inspection when its job did not run
+            logger.error(f"An error occurred while running the {self.name} batch job for {path}: {e}")
+
+        self.record_metrics(start, callbacks, results)
+        for custom_id, on_result in callbacks.items():
+            await self.hand_back(custom_id, on_result, results.get(custom_id))
+
+    def record_metrics(self, start, custom_ids, results):
+        if self.metrics is not None:
+            self.metrics.observe(f"{self.name}_batch", time.perf_counter() - start)
+            self.metrics.count(f"{self.name}_batch", "requests", len(custom_ids))
+            self.metrics.count(f"{self.name}_batch", "failed", sum(1 for custom_id in custom_ids if custom_id not in results))
+
+    async def hand_back(self, custom_id, on_result, result):
+        try:
+            await on_result(result)
+        except Exception as e:
+            logger.error(f"An error occurred while handling the {self.name} batch result for {custom_id}: {e}")
+
+    # Wait for the jobs the journal recorded for an interrupted run, in the background
+    def reattach(self):
+        if self.journal is None:
+            return
+        for batch_id, custom_ids in self.journal.batch_jobs(self.name):
+            for custom_id in custom_ids:
+                self.resumed[custom_id] = batch_id
+            self.start(self.resume_job(batch_id, custom_ids))
+        if self.resumed:
+            logger.info(f"Waiting for {len(self.resumed)} {self.name} requests in batch jobs submitted by the interrupted run.")
+
+    async def resume_job(self, batch_id, custom_ids):
+        results = {}
+        start = time.perf_counter()
+        try:
+            results = await self.wait_for_job(await self.client.batches.retrieve(batch_id))
+        except Exception as e:
+            # Its requests fail, so the cases are submitted again by the next resumed run
+            logger.error(f"An error occurred while waiting for the {self.name} batch job {batch_id}: {e}")
+        self.record_metrics(start, custom_ids, results)
+        self.journal.remove_batch_job(batch_id)
+
+        for custom_id in custom_ids:
+            result = results.get(custom_id)
+            on_result = self.resumed_callbacks.pop(custom_id, None)
+            if on_result is None:
+                # Kept for the case to claim when it is added again
+                self.resumed_results[custom_id] = result
+                continue
+            del self.resumed[custom_id]
+            await self.hand_back(custom_id, on_result, result)
+
+    # Upload the input file, create the job, record it in the journal and wait for it. Returns the response
+    # body of each successful request by its custom_id.
+    async def run_job(self, path, custom_ids):
+        with open(path, "rb") as file:
+            input_file = await self.client.files.create(file=file, purpose="batch")
+        batch = await self.client.batches.create(input_file_id=input_file.id, endpoint=self.endpoint, completion_window="24h")
+        logger.info(f"Submitted {self.name} batch job {batch.id} with {len(custom_ids)} requests.")
+        if self.journal is not None:
+            self.journal.record_batch_job(self.name, batch.id, custom_ids)
+        results = await self.wait_for_job(batch)
+        if self.journal is not None:
+            self.journal.remove_batch_job(batch.id)
+        return results
+
+    # Poll a job until it finishes, read its results and remove its files from the service
+    async def wait_for_job(self, batch):
+        while batch.status not in FINISHED_STATUSES:
+            await asyncio.sleep(self.poll_interval)
+            batch = await self.client.batches.retrieve(batch.id)
+
+        counts = batch.request_counts
+        summary = f"{counts.completed} of {counts.total} requests completed" if counts is not None else "no request counts"
+        logger.info(f"The {self.name} batch job {batch.id} finished as {batch.status}, {summary}.")
+
+        # An expired or cancelled job still returns the requests it completed
+        results = {}
+        if batch.output_file_id:
+            output = await self.client.files.content(batch.output_file_id)
+            for line in output.text.splitlines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get("response") or {}
+                if response.get("status_code") == 200:
+                    results[result["custom_id"]] = response.get("body")
+                else:
+                    logger.error(f"The {self.name} batch request {result.get('custom_id')} failed: {result.get('error') or response.get('body')}")
+        if batch.error_file_id:
+            errors = await self.client.files.content(batch.error_file_id)
+            failed = [line for line in errors.text.splitlines() if line.strip()]
+            if failed:
+                logger.error(f"{len(failed)} {self.name} batch requests failed in job {batch.id}, the first: {failed[0]}")
+
+        # The files are removed from the service, their results have been read
+        for file_id in (batch.input_file_id, batch.output_file_id, batch.error_file_id):
+            if file_id:
+                try:
+                    await self.client.files.delete(file_id)
+                except Exception as e:
+                    logger.warning(f"Could not delete the batch file {file_id}: {e}")
+        return results
+
+    # Submit the last file and wait for every job. Callbacks can queue further requests, such as the
+    # duplicates of a failed case, so this repeats until nothing is left. More requests can be added and
+    # drained again afterwards.
+    async def drain(self):
+        while self.pending:
+            self.submit()
+            tasks = list(self.tasks)
+            await asyncio.gather(*tasks)
+            self.tasks.difference_update(tasks)
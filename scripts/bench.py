@@ -0,0 +1,731 @@
+import os
+import sys
+import json
+import math
+import time
+import zlib
+import random
+import socket
+import asyncio
+import base64
+import hashlib
+import logging
+import argparse
+import shutil
+import tempfile
+import subprocess
+import multiprocessing
+import urllib.request
+from types import SimpleNamespace
+import numpy as np
+from PIL import Image
+from aiohttp import web
+from images import estimate_image_tokens_from_bytes
+from assessment import format_description
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak memory is not reported
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_CACHE_DIR = os.path.join(SCRIPTS_DIR, ".cache", "bench")
+EMBED_DIMENSIONS = 1536
+
+# Azurite's well known development account, also used as a placeholder when blob storage is faked
+AZURITE_CONNECTION_STRING = (
+    "DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;"
+    "AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw==;"
+    "BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;"
+)
+
+# Assessments returned by the fake vision deployment, as JSON when a response format is requested
+# and otherwise in the free text format
+ASSESSMENTS = [
+    {"description": "Black mould spreading across the corner of a bathroom ceiling above the shower.", "repair": "Clean the affected area with a fungicidal wash, improve ventilation and repaint with anti-mould paint.", "tradesman": "Decorator", "mould_detected": True, "mould_severity": "moderate"},
+    {"description": "A kitchen base unit door hanging off its top hinge.", "repair": "Replace the broken hinge and realign the door.", "tradesman": "Carpenter", "mould_detected": False, "mould_severity": "none"},
+    {"description": "Water staining and flaking plaster below a bedroom window.", "repair": "Reseal the window frame, treat the damp and replaster the wall.", "tradesman": "Plasterer", "mould_detected": True, "mould_severity": "mild"},
+    {"description": "A cracked ceramic wash basin with a dripping tap.", "repair": "Replace the basin and the tap washer.", "tradesman": "Plumber", "mould_detected": False, "mould_severity": "none"},
+    {"description": "Extensive mould growth behind a wardrobe on an external wall.", "repair": "Remove the mould, investigate condensation and install a humidity controlled extractor.", "tradesman": "Damp specialist", "mould_detected": True, "mould_severity": "severe"},
+    {"description": "A loose and sparking light switch in a hallway.", "repair": "Isolate the circuit and replace the switch.", "tradesman": "Electrician", "mould_detected": False, "mould_severity": "none"},
+]
+
+
+# Synthetic photos of smooth random patterns, each with its own perceptual hash, and a share of near
+# duplicates made by shrinking and recompressing an earlier image. Datasets are kept for later runs.
+def make_dataset(count, size=256, duplicate_rate=0.05, seed=0):
+    folder = os.path.join(BENCH_CACHE_DIR, f"data-{count}-{size}-{duplicate_rate:g}-{seed}")
+    complete_marker = os.path.join(folder, ".complete")
+    if os.path.exists(complete_marker):
+        return folder
+
+    logger.info(f"Generating {count} synthetic images in {folder}")
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for i in range(count):
+        path = os.path.join(folder, f"image{i:06d}.jpg")
+        if i and rng.random() < duplicate_rate:
+            with Image.open(os.path.join(folder, f"image{int(rng.integers(i)):06d}.jpg")) as image:
+                image.resize((size * 3 // 4, size * 3 // 4)).save(path, quality=70)
+        else:
+            pattern = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+            Image.fromarray(pattern).resize((size, size), Image.BICUBIC).save(path, quality=85)
+    open(complete_marker, "w").close()
+    return folder
+
+
+# Stand-in for the Azure OpenAI chat completions, embeddings and Batch API endpoints. Latency is log-normal around
+# the given median, a share of requests is throttled with 429s, and an optional tokens-per-minute quota
+# is enforced like a deployment's. Token usage is counted the way the service reports it.
+class FakeOpenAI:
+    def __init__(self, options):
+        self.options = options
+        self.random = random.Random(options.seed)
+        # Start and tokens used of the current quota minute of each deployment
+        self.windows = {}
+        self.files = {}
+        self.file_ids = 0
+        self.batches = {}
+        self.batch_tasks = set()
+        self.reset()
+
+        vectors = np.random.default_rng(options.seed).standard_normal((64, EMBED_DIMENSIONS)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.vectors = [vector.tolist() for vector in vectors]
+        self.vectors_base64 = [base64.b64encode(vector.tobytes()).decode() for vector in vectors]
+
+    def reset(self):
+        self.stats = {
+            "vision_requests": 0,
+            "embedding_requests": 0,
+            "embedding_inputs": 0,
+            "throttled": 0,
+            "errors": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "embedding_tokens": 0,
+            "batch_jobs": 0,
+            "batch_requests": 0,
+        }
+
+    def latency(self, median):
+        return self.random.lognormvariate(math.log(median), 0.5) if median > 0 else 0
+
+    # Seconds the client should wait when this request is throttled, otherwise None. Each deployment
+    # has its own quota, as in Azure.
+    def retry_after(self, tokens, deployment):
+        if self.random.random() < self.options.throttle_rate:
+            return self.options.retry_after
+        if self.options.tpm:
+            now = time.monotonic()
+            window = self.windows.setdefault(deployment, [now, 0])
+            if now - window[0] >= 60:
+                window[:] = [now, 0]
+            if window[1] + tokens > self.options.tpm:
+                return 60 - (now - window[0])
+            window[1] += tokens
+        return None
+
+    # The deployments made unhealthy with --unhealthy answer every request with a 500
+    def unhealthy(self, deployment):
+        if deployment not in self.options.unhealthy_deployments:
+            return None
+        self.stats["errors"] += 1
+        return web.json_response({"error": {"code": "InternalServerError", "message": "The server had an error."}}, status=500)
+
+    def too_many_requests(self, retry_after):
+        self.stats["throttled"] += 1
+        headers = {"retry-after-ms": str(int(retry_after * 1000)), "Retry-After": str(math.ceil(retry_after))}
+        return web.json_response({"error": {"code": "429", "message": "Rate limit is exceeded."}}, status=429, headers=headers)
+
+    # Prompt tokens of a chat completions request, and the case IDs of a request for several images,
+    # which introduces each image with a "Case ID: ..." line
+    def read_chat_request(self, body):
+        system_prompt = body["messages"][0]["content"][0]["text"]
+        case_ids = []
+        image_tokens = 0
+        for part in body["messages"][1]["content"]:
+            if part["type"] == "text" and part["text"].startswith("Case ID:"):
+                case_ids.append(part["text"].split(":", 1)[1].strip())
+            elif part["type"] == "image_url":
+                image_header = base64.b64decode(part["image_url"]["url"].split(",", 1)[1][:87384])
+                image_tokens += estimate_image_tokens_from_bytes(image_header)
+        return len(system_prompt) // 4 + image_tokens, case_ids
+
+    def chat_completion(self, body, deployment, prompt_tokens, case_ids):
+        if case_ids:
+            description = json.dumps({"assessments": [dict(case_id=case_id, **self.random.choice(ASSESSMENTS)) for case_id in case_ids]})
+        else:
+            assessment = self.random.choice(ASSESSMENTS)
+            if "response_format" in body:
+                description = json.dumps(assessment)
+            else:
+                description = format_description(*assessment.values())
+        completion_tokens = len(description) // 4 + 1
+        self.stats["vision_requests"] += 1
+        self.stats["prompt_tokens"] += prompt_tokens
+        self.stats["completion_tokens"] += completion_tokens
+        return {
+            "object": "chat.completion",
+            "model": deployment,
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": description}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        prompt_tokens, case_ids = self.read_chat_request(body)
+        error = self.unhealthy(request.match_info["deployment"])
+        if error is not None:
+            return error
+        retry_after = self.retry_after(prompt_tokens + body.get("max_tokens", 0), request.match_info["deployment"])
+        if retry_after is not None:
+            return self.too_many_requests(retry_after)
+
+        await asyncio.sleep(self.latency(self.options.vision_latency))
+        return web.json_response(self.chat_completion(body, request.match_info["deployment"], prompt_tokens, case_ids))
+
+    def embedding(self, body, deployment, inputs, tokens):
+        # The openai client asks for base64 unless told otherwise
+        vectors = self.vectors_base64 if body.get("encoding_format") == "base64" else self.vectors
+        data = [{"object": "embedding", "index": i, "embedding": vectors[zlib.crc32(text.encode()) % len(vectors)]} for i, text in enumerate(inputs)]
+        self.stats["embedding_requests"] += 1
+        self.stats["embedding_inputs"] += len(inputs)
+        self.stats["embedding_tokens"] += tokens
+        return {
+            "object": "list",
+            "model": deployment,
+            "data": data,
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    async def embeddings(self, request):
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        tokens = sum(len(text) // 4 + 1 for text in inputs)
+        error = self.unhealthy(request.match_info["deployment"])
+        if error is not None:
+            return error
+        retry_after = self.retry_after(tokens, request.match_info["deployment"])
+        if retry_after is not None:
+            return self.too_many_requests(retry_after)
+
+        await asyncio.sleep(self.latency(self.options.embed_latency))
+        return web.json_response(self.embedding(body, request.match_info["deployment"], inputs, tokens))
+
+    # The Batch API: files are uploaded, a batch job runs the requests of one file in the background after
+    # --batch-latency seconds and writes their responses to an output file, and the job is polled until it completes
+    def add_file(self, content, filename, purpose):
+        self.file_ids += 1
+        file = {"id": f"file-{self.file_ids}", "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                "filename": filename, "purpose": purpose, "status": "processed"}
+        self.files[file["id"]] = (file, content)
+        return file
+
+    async def create_file(self, request):
+        form = await request.post()
+        upload = form["file"]
+        return web.json_response(self.add_file(upload.file.read(), upload.filename, form["purpose"]))
+
+    async def file_content(self, request):
+        _, content = self.files[request.match_info["file_id"]]
+        return web.Response(body=content, content_type="application/octet-stream")
+
+    async def delete_file(self, request):
+        file_id = request.match_info["file_id"]
+        self.files.pop(file_id, None)
+        return web.json_response({"id": file_id, "object": "file", "deleted": True})
+
+    async def create_batch(self, request):
+        body = await request.json()
+        batch = {"id": f"batch-{len(self.batches) + 1}", "object": "batch", "endpoint": body["endpoint"], "input_file_id": body["input_file_id"],
+                 "completion_window": body["completion_window"], "status": "validating", "created_at": int(time.time()),
+                 "output_file_id": None, "error_file_id": None, "request_counts": {"total": 0, "completed": 0, "failed": 0}}
+        self.batches[batch["id"]] = batch
+        self.stats["batch_jobs"] += 1
+        task = asyncio.create_task(self.run_batch(batch))
+        self.batch_tasks.add(task)
+        task.add_done_callback(self.batch_tasks.discard)
+        return web.json_response(batch)
+
+    async def run_batch(self, batch):
+        _, content = self.files[batch["input_file_id"]]
+        batch["status"] = "in_progress"
+        await asyncio.sleep(self.options.batch_latency)
+        lines = []
+        for line in content.decode().splitlines():
+            request = json.loads(line)
+            body = request["body"]
+            if request["url"].endswith("/embeddings"):
+                inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+                response = self.embedding(body, body["model"], inputs, sum(len(text) // 4 + 1 for text in inputs))
+            else:
+                response = self.chat_completion(body, body["model"], *self.read_chat_request(body))
+            lines.append(json.dumps({"id": f"response-{len(lines) + 1}", "custom_id": request["custom_id"], "response": {"status_code": 200, "body": response}, "error": None}))
+        self.stats["batch_requests"] += len(lines)
+        output = self.add_file("\n".join(lines).encode(), f"{batch['id']}_output.jsonl", "batch_output")
+        batch.update(status="completed", output_file_id=output["id"], request_counts={"total": len(lines), "completed": len(lines), "failed": 0})
+
+    async def get_batch(self, request):
+        return web.json_response(self.batches[request.match_info["batch_id"]])
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats)
+
+    async def post_reset(self, request):
+        self.reset()
+        return web.json_response(self.stats)
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.add_routes([
+            web.post("/openai/deployments/{deployment}/chat/completions", self.chat_completions),
+            web.post("/openai/deployments/{deployment}/embeddings", self.embeddings),
+            web.post("/openai/files", self.create_file),
+            web.get("/openai/files/{file_id}/content", self.file_content),
+            web.delete("/openai/files/{file_id}", self.delete_file),
+            web.post("/openai/batches", self.create_batch),
+            web.get("/openai/batches/{batch_id}", self.get_batch),
+            web.get("/stats", self.get_stats),
+            web.post("/reset", self.post_reset),
+        ])
+        return app
+
+
+# Runs in its own process, so serving responses does not take CPU from the run being measured
+def serve_fake_openai(options, port):
+    web.run_app(FakeOpenAI(options).app(), host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def fake_openai_request(port, path, method="GET"):
+    request = urllib.request.Request(f"http://127.0.0.1:{port}{path}", method=method)
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return json.load(response)
+
+
+def wait_for_server(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return fake_openai_request(port, "/stats")
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+# In-process stand-in for a blob container. Only digests are kept, and downloads are read back from
+# the data folder, so the fake does not hold every image in memory.
+class FakeBlobContainer:
+    def __init__(self, data_folder, latency):
+        self.data_folder = data_folder
+        self.latency = latency
+        self.blobs = {}
+
+    async def exists(self):
+        return True
+
+    async def create_container(self):
+        pass
+
+    def get_blob_client(self, blob):
+        return FakeBlobClient(self, blob)
+
+    async def close(self):
+        pass
+
+
+class FakeBlobClient:
+    def __init__(self, container, name):
+        self.container = container
+        self.name = name
+        self.url = f"https://bench.blob.core.windows.net/images/{name}"
+
+    async def get_blob_properties(self):
+        await asyncio.sleep(self.container.latency)
+        if self.name not in self.container.blobs:
+            raise Exception("The specified blob does not exist. ErrorCode:BlobNotFound")
+        return SimpleNamespace(content_settings=SimpleNamespace(content_md5=self.container.blobs[self.name]))
+
+    async def upload_blob(self, data, overwrite=False):
+        await asyncio.sleep(self.container.latency)
+        self.container.blobs[self.name] = hashlib.md5(data).digest()
+
+    async def download_blob(self):
+        await asyncio.sleep(self.container.latency)
+        with open(os.path.join(self.container.data_folder, self.name), "rb") as file:
+            data = file.read()
+        return FakeDownload(data)
+
+    async def close(self):
+        pass
+
+
+class FakeDownload:
+    def __init__(self, data):
+        self.data = data
+
+    async def readall(self):
+        return self.data
+
+
+# In-process stand-in for the aioodbc pool. It recognises the statements prepdata issues for a fresh
+# run and keeps the rows in a dict, with a fixed round trip latency per statement.
+class FakeDatabase:
+    INSERT_COLUMNS = ("CustomerID", "CaseID", "Description", "ImageURL", "MouldDetected", "FileName", "DateOpened", "JobAssigned", "ImageHash", "PerceptualHash", "DuplicateOf")
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.table_exists = False
+        self.rows = {}
+        self.staged = []
+
+    def acquire(self):
+        return FakeConnection(self)
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, database):
+        self.database = database
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def cursor(self):
+        return FakeCursor(self.database)
+
+    async def commit(self):
+        await asyncio.sleep(self.database.latency)
+
+    async def rollback(self):
+        pass
+
+
+class FakeCursor:
+    def __init__(self, database):
+        self.database = database
+        self.result = []
+        self._impl = SimpleNamespace(fast_executemany=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def execute(self, query, *params):
+        await asyncio.sleep(self.database.latency)
+        database = self.database
+        self.result = []
+        if "OBJECT_ID('dbo.MaintenanceRequests', 'U')" in query:
+            self.result = [(1 if database.table_exists else 0,)]
+        elif "CREATE TABLE MaintenanceRequests" in query:
+            database.table_exists = True
+            database.rows = {}
+        elif "SELECT FileName, CaseID" in query:
+            self.result = [(row["FileName"], row["CaseID"], row["ImageHash"], row["PerceptualHash"], row["DuplicateOf"], row["Description"]) for row in database.rows.values()]
+        elif "INNER JOIN #DescriptionUpdates" in query:
+            for case_id, description, mould_detected, described_hash, repair, tradesman, mould_severity in database.staged:
+                if case_id in database.rows:
+                    database.rows[case_id].update(Description=description, MouldDetected=mould_detected, DescribedHash=described_hash,
+                                                  Repair=repair, Tradesman=tradesman, MouldSeverity=mould_severity)
+            database.staged = []
+
+    async def executemany(self, query, rows):
+        await asyncio.sleep(self.database.latency)
+        database = self.database
+        if "INSERT INTO MaintenanceRequests" in query:
+            for row in rows:
+                database.rows[row[1]] = dict(zip(FakeDatabase.INSERT_COLUMNS, row))
+        elif "INSERT INTO #DescriptionUpdates" in query:
+            database.staged = list(rows)
+
+    async def fetchone(self):
+        return self.result[0] if self.result else None
+
+    async def fetchall(self):
+        return self.result
+
+
+# In-process stand-in for the search service, counting the documents it accepts
+class FakeSearchService:
+    def __init__(self, latency):
+        self.latency = latency
+        self.documents = 0
+
+    def client(self, **kwargs):
+        return FakeSearchClient(self)
+
+    def index_client(self, **kwargs):
+        return FakeSearchIndexClient()
+
+
+class FakeSearchClient:
+    def __init__(self, service):
+        self.service = service
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def upload_documents(self, documents):
+        await asyncio.sleep(self.service.latency)
+        self.service.documents += len(documents)
+        return [SimpleNamespace(key=document["CaseID"], succeeded=True, status_code=201, error_message=None) for document in documents]
+
+
+class FakeSearchIndexClient:
+    def list_index_names(self):
+        return []
+
+    def delete_index(self, name):
+        pass
+
+    def create_or_update_index(self, index):
+        return index
+
+
+def peak_rss_mb(who):
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+# One benchmark run in a fresh process, so peak memory belongs to this dataset size alone.
+# prepdata reads its configuration on import, which is why it is imported here and not at the top.
+async def run_child(run_folder):
+    with open(os.path.join(run_folder, "options.json")) as file:
+        options = SimpleNamespace(**json.load(file))
+
+    import prepdata
+    logging.getLogger().setLevel(logging.INFO if options.verbose else logging.WARNING)
+
+    database = FakeDatabase(options.sql_latency / 1000)
+    search_service = FakeSearchService(options.search_latency / 1000)
+
+    async def create_pool():
+        return database
+
+    prepdata.create_pool = create_pool
+    prepdata.SearchClient = search_service.client
+    prepdata.SearchIndexClient = search_service.index_client
+    if not options.azurite:
+        container = FakeBlobContainer(options.data_folder, options.blob_latency / 1000)
+        prepdata.blob_service_client = container
+        prepdata.container_client = container
+
+    args = SimpleNamespace(no_cache=not options.cache, clear_cache=False, incremental=False, resume=False,
+                           no_preprocess=options.no_preprocess, no_dedupe=options.no_dedupe, batch=options.batch,
+                           shards=None, shard=None, setup_only=False, merge_shards=None)
+    start = time.perf_counter()
+    await prepdata.main(args)
+    elapsed = time.perf_counter() - start
+
+    stages = {}
+    for name, stage in prepdata.metrics.stages.items():
+        latency = stage.latency
+        stages[name] = {
+            "calls": latency.count,
+            "seconds": latency.total,
+            "p50": latency.percentile(0.5),
+            "p95": latency.percentile(0.95),
+            "p99": latency.percentile(0.99),
+            "counters": stage.counters,
+        }
+    result = {
+        "images": options.images,
+        "cases": search_service.documents,
+        "seconds": elapsed,
+        "cases_per_second": search_service.documents / elapsed if elapsed else 0,
+        "peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+        "peak_worker_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+        "stages": stages,
+    }
+    with open(os.path.join(run_folder, "result.json"), "w") as file:
+        json.dump(result, file)
+
+
+# The child runs against the fakes, never the deployment in the caller's environment, and its caches,
+# journal and export live in the run folder. The fake deployments only throttle when asked to, so the
+# client budgets are opened up unless they are set explicitly.
+def child_environment(options, port):
+    env = dict(os.environ)
+    env.pop("APPLICATIONINSIGHTS_CONNECTION_STRING", None)
+    env.pop("OTEL_EXPORTER_OTLP_ENDPOINT", None)
+    env.pop("PREPDATA_OPENAI_DEPLOYMENTS_FILE", None)
+    if options.deployments > 1:
+        env["PREPDATA_OPENAI_DEPLOYMENTS_FILE"] = "deployments.json"
+    env.update({
+        "AZURE_OAI_ENDPOINT": f"http://127.0.0.1:{port}/",
+        "AZURE_OAI_API_KEY": "bench",
+        "AZURE_SEARCH_SERVICE_ENDPOINT": "https://bench.search.windows.net",
+        "AZURE_SEARCH_API_KEY": "bench",
+        "AZURE_BLOB_CONNECTION_STRING": AZURITE_CONNECTION_STRING,
+        "AZURE_PYTHON_SQL_CONNECTION_STRING": "Driver={bench}",
+        "PREPDATA_DESCRIPTION_CACHE_PATH": "scripts/.cache/descriptions.sqlite3",
+        "PREPDATA_EMBEDDING_CACHE_PATH": "scripts/.cache/embeddings.bin",
+        "PREPDATA_JOURNAL_PATH": "scripts/.cache/journal.sqlite3",
+        "PREPDATA_BATCH_FOLDER": "scripts/.cache/batch",
+        "PREPDATA_METRICS_FILE": "",
+    })
+    if options.images_per_request:
+        env["PREPDATA_VISION_IMAGES_PER_REQUEST"] = str(options.images_per_request)
+    env.setdefault("PREPDATA_BATCH_POLL_INTERVAL", "0.5")
+    for name in ("PREPDATA_VISION_RPM", "PREPDATA_VISION_TPM", "PREPDATA_EMBED_RPM", "PREPDATA_EMBED_TPM"):
+        env.setdefault(name, "100000000")
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [SCRIPTS_DIR, env.get("PYTHONPATH")]))
+    return env
+
+
+# Names of the fake deployments of a kind, for --deployments
+def deployment_names(kind, count):
+    return [f"{kind}-{i}" for i in range(1, count + 1)]
+
+
+def run_once(options, count, port, run_folder):
+    data_folder = make_dataset(count, options.image_size, options.duplicate_rate, options.seed)
+    os.makedirs(os.path.join(run_folder, "scripts"), exist_ok=True)
+    os.symlink(data_folder, os.path.join(run_folder, "data"), target_is_directory=True)
+    with open(os.path.join(run_folder, "options.json"), "w") as file:
+        json.dump(dict(vars(options), images=count, data_folder=data_folder), file)
+    if options.deployments > 1:
+        # Every fake deployment is served by the one fake server, each with its own quota
+        endpoint = f"http://127.0.0.1:{port}/"
+        deployments = {kind: [{"name": name, "endpoint": endpoint, "deployment": name} for name in deployment_names(kind, options.deployments)]
+                       for kind in ("vision", "embedding")}
+        with open(os.path.join(run_folder, "deployments.json"), "w") as file:
+            json.dump(deployments, file)
+
+    fake_openai_request(port, "/reset", "POST")
+    subprocess.run([sys.executable, os.path.abspath(__file__), "--child", run_folder], cwd=run_folder, env=child_environment(options, port), check=True)
+    with open(os.path.join(run_folder, "result.json")) as file:
+        result = json.load(file)
+    result["openai"] = fake_openai_request(port, "/stats")
+    return result
+
+
+def format_mb(value):
+    return f"{value:.0f}" if value is not None else "n/a"
+
+
+def report(result):
+    openai = result["openai"]
+    logger.info(f"{result['images']} images: {result['cases']} cases indexed in {result['seconds']:.1f} s, "
+                f"{result['cases_per_second']:.1f} cases/sec, peak RSS {format_mb(result['peak_rss_mb'])} MiB "
+                f"(image workers {format_mb(result['peak_worker_rss_mb'])} MiB)")
+    logger.info(f"  fake OpenAI: {openai['vision_requests']} vision and {openai['embedding_requests']} embedding requests, "
+                f"{openai['throttled']} throttled, {openai['errors']} errors, {openai['prompt_tokens'] + openai['completion_tokens']} vision tokens, "
+                f"{openai['embedding_tokens']} embedding tokens, {openai['batch_requests']} requests in {openai['batch_jobs']} batch jobs")
+    logger.info(f"  {'stage':<16}{'calls':>8}{'seconds':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, stage in result["stages"].items():
+        logger.info(f"  {name:<16}{stage['calls']:>8}{stage['seconds']:>10.1f}{stage['p50'] * 1000:>10.1f}{stage['p95'] * 1000:>10.1f}{stage['p99'] * 1000:>10.1f}")
+
+
+# Compare throughput with an earlier --json file. Returns False when a size slowed by more than the tolerance.
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as file:
+        baseline = {result["images"]: result for result in json.load(file)}
+    passed = True
+    for result in results:
+        previous = baseline.get(result["images"])
+        if previous is None or not previous["cases_per_second"]:
+            continue
+        change = result["cases_per_second"] / previous["cases_per_second"] - 1
+        if change < -tolerance:
+            logger.error(f"{result['images']} images: {result['cases_per_second']:.1f} cases/sec is {-change:.0%} slower than the baseline {previous['cases_per_second']:.1f}")
+            passed = False
+        else:
+            logger.info(f"{result['images']} images: {change:+.0%} cases/sec against the baseline")
+    return passed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark prepdata.py against local stand-ins for Azure OpenAI, Blob Storage, SQL and Search.")
+    parser.add_argument("--images", default="10,1000", help="Comma separated dataset sizes to run, e.g. 10,1000,100000.")
+    parser.add_argument("--image-size", type=int, default=256, help="Edge length in pixels of the synthetic images.")
+    parser.add_argument("--duplicate-rate", type=float, default=0.05, help="Share of images that are near duplicates of an earlier one.")
+    parser.add_argument("--vision-latency", type=float, default=0.5, help="Median latency in seconds of the fake vision deployment.")
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="Median latency in seconds of the fake embedding deployment.")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Share of OpenAI requests answered with a 429.")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After in seconds sent with throttled responses.")
+    parser.add_argument("--tpm", type=int, default=0, help="Tokens per minute quota of the fake deployments, 0 for none.")
+    parser.add_argument("--blob-latency", type=float, default=5, help="Latency in milliseconds of fake blob operations.")
+    parser.add_argument("--sql-latency", type=float, default=5, help="Latency in milliseconds of fake SQL round trips.")
+    parser.add_argument("--search-latency", type=float, default=50, help="Latency in milliseconds of a fake search upload.")
+    parser.add_argument("--azurite", action="store_true", help="Use an Azurite blob emulator on 127.0.0.1:10000 instead of the in-process fake.")
+    parser.add_argument("--cache", action="store_true", help="Use the description and embedding caches instead of bypassing them.")
+    parser.add_argument("--no-preprocess", action="store_true", help="Send images at their original size.")
+    parser.add_argument("--no-dedupe", action="store_true", help="Describe near duplicate images separately.")
+    parser.add_argument("--images-per-request", type=int, help="Images sent in each vision request, by default prepdata's default.")
+    parser.add_argument("--deployments", type=int, default=1, help="Vision and embedding deployments to spread requests over, each with the --tpm quota.")
+    parser.add_argument("--unhealthy", type=int, default=0, help="Deployments that answer every request with a 500, to exercise failover.")
+    parser.add_argument("--batch", action="store_true", help="Run prepdata with --batch against the fake Batch API.")
+    parser.add_argument("--batch-latency", type=float, default=2.0, help="Seconds a fake batch job takes to complete.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the datasets and fake responses.")
+    parser.add_argument("--verbose", action="store_true", help="Show the prepdata log of each run.")
+    parser.add_argument("--json", help="Write the results to this file.")
+    parser.add_argument("--compare", help="Fail when cases/sec drops against the results in this --json file.")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed drop in cases/sec for --compare.")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        asyncio.run(run_child(args.child))
+        return
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args.unhealthy_deployments = [name for kind in ("vision", "embedding") for name in deployment_names(kind, args.unhealthy)]
+    port = free_port()
+    server = multiprocessing.Process(target=serve_fake_openai, args=(args, port), daemon=True)
+    server.start()
+    results = []
+    try:
+        wait_for_server(port)
+        os.makedirs(BENCH_CACHE_DIR, exist_ok=True)
+        for count in (int(value) for value in args.images.split(",")):
+            run_folder = tempfile.mkdtemp(prefix=f"run-{count}-", dir=BENCH_CACHE_DIR)
+            try:
+                result = run_once(args, count, port, run_folder)
+            finally:
+                shutil.rmtree(run_folder, ignore_errors=True)
+            report(result)
+            results.append(result)
+    finally:
+        server.terminate()
+        server.join()
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+        logger.info(f"Wrote results to {args.json}")
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+import os
+import time
+import struct
+import sqlite3
+import hashlib
+import logging
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# Hash helper shared by the cache keys
+def sha256_hex(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+# Persistent, content-addressed cache of GPT-4 Vision descriptions stored in a local SQLite file
+class DescriptionCache:
+    def __init__(self, path, max_entries=50000, max_age_days=30):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_days * 24 * 60 * 60 if max_age_days else None
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS Descriptions (
+            CacheKey TEXT PRIMARY KEY,
+            Description TEXT NOT NULL,
+            MouldDetected INTEGER NOT NULL,
+            CreatedAt REAL NOT NULL,
+            LastUsedAt REAL NOT NULL
+        )
+        """)
+        self.conn.commit()
+
+    # Key on the image content, the deployment and the prompt so a change to any of them is a miss
+    @staticmethod
+    def make_key(image_hash, deployment_name, system_prompt, variant=""):
+        return sha256_hex(f"{image_hash}:{deployment_name}:{sha256_hex(system_prompt)}:{variant}")
+
+    def get(self, key):
+        row = self.conn.execute(
+            "SELECT Description, MouldDetected, CreatedAt FROM Descriptions WHERE CacheKey = ?", (key,)
+        ).fetchone()
+        now = time.time()
+        if row is None or (self.max_age_seconds and now - row[2] > self.max_age_seconds):
+            self.misses += 1
+            return None
+
+        self.conn.execute("UPDATE Descriptions SET LastUsedAt = ? WHERE CacheKey = ?", (now, key))
+        self.conn.commit()
+        self.hits += 1
+        return row[0], bool(row[1])
+
+    def put(self, key, description, mould_detected):
+        now = time.time()
+        self.conn.execute("""
+        INSERT OR REPLACE INTO Descriptions (CacheKey, Description, MouldDetected, CreatedAt, LastUsedAt)
+        VALUES (?, ?, ?, ?, ?)
+        """, (key, description, int(bool(mould_detected)), now, now))
+        self.conn.commit()
+
+    # Drop expired entries, then the least recently used ones above the size limit
+    def evict(self):
+        removed = 0
+        if self.max_age_seconds:
+            cursor = self.conn.execute("DELETE FROM Descriptions WHERE CreatedAt < ?", (time.time() - self.max_age_seconds,))
+            removed += cursor.rowcount
+        if self.max_entries:
+            cursor = self.conn.execute("""
+            DELETE FROM Descriptions WHERE CacheKey IN (
+                SELECT CacheKey FROM Descriptions ORDER BY LastUsedAt DESC LIMIT -1 OFFSET ?
+            )
+            """, (self.max_entries,))
+            removed += cursor.rowcount
+        self.conn.commit()
+        if removed:
+            logger.info(f"Evicted {removed} entries from the description cache.")
+        return removed
+
+    def clear(self):
+        self.conn.execute("DELETE FROM Descriptions")
+        self.conn.commit()
+        logger.info(f"Description cache {self.path} cleared.")
+
+    def close(self):
+        self.evict()
+        self.conn.close()
+        logger.info(f"Description cache: {self.hits} hits, {self.misses} misses.")
+
+
+# Normalize a description before hashing, so differences in whitespace or Unicode form share an embedding
+def normalize_text(text):
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+# Persistent cache of embedding vectors with an in-memory LRU in front. Vectors are appended to a flat
+# binary file of fixed size records, a 32 byte SHA-256 key followed by the float32 vector, so the file
+# is about 6 KB per ada-002 embedding and the key index is rebuilt by reading the keys at startup.
+class EmbeddingCache:
+    MAGIC = b"PDEMBED1"
+    HEADER = struct.Struct("<8sI")
+
+    def __init__(self, path, max_memory_entries=10000):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.memory = OrderedDict()
+        self.offsets = {}
+        self.dimensions = None
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, "a+b")
+        self.load_index()
+
+    # Key on the normalized text and the deployment, since another model embeds the same text differently
+    @staticmethod
+    def make_key(text, deployment_name):
+        return hashlib.sha256(f"{deployment_name}:{normalize_text(text)}".encode("utf-8")).digest()
+
+    @property
+    def record_size(self):
+        return 32 + 4 * self.dimensions
+
+    def load_index(self):
+        self.file.seek(0, os.SEEK_END)
+        size = self.file.tell()
+        if size < self.HEADER.size:
+            return
+
+        self.file.seek(0)
+        magic, dimensions = self.HEADER.unpack(self.file.read(self.HEADER.size))
+        if magic != self.MAGIC:
+            logger.warning(f"Embedding cache {self.path} is not in the expected format, starting it again.")
+            self.file.truncate(0)
+            return
+
+        self.dimensions = dimensions
+        count = (size - self.HEADER.size) // self.record_size
+        if self.HEADER.size + count * self.record_size != size:
+            # Drop a partial record left by an interrupted write
+            self.file.truncate(self.HEADER.size + count * self.record_size)
+        if count:
+            records = np.memmap(self.path, dtype=np.dtype([("key", "S32"), ("vector", "<f4", (dimensions,))]), mode="r", offset=self.HEADER.size, shape=(count,))
+            # Fixed width bytes drop trailing zero bytes, so pad the keys back to their full length
+            self.offsets = {key.ljust(32, b"\0"): self.HEADER.size + row * self.record_size for row, key in enumerate(records["key"].tolist())}
+            del records
+        logger.info(f"Embedding cache {self.path} holds {len(self.offsets)} vectors.")
+
+    def get(self, key):
+        vector = self.memory.get(key)
+        if vector is not None:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return vector
+
+        offset = self.offsets.get(key)
+        if offset is None:
+            self.misses += 1
+            return None
+        self.file.seek(offset + 32)
+        vector = np.frombuffer(self.file.read(4 * self.dimensions), dtype="<f4")
+        self.remember(key, vector)
+        self.hits += 1
+        return vector
+
+    def put(self, key, vector):
+        if key in self.offsets:
+            return
+        vector = np.asarray(vector, dtype="<f4")
+        if self.dimensions is None:
+            self.dimensions = len(vector)
+            self.file.seek(0)
+            self.file.truncate(0)
+            self.file.write(self.HEADER.pack(self.MAGIC, self.dimensions))
+        elif len(vector) != self.dimensions:
+            logger.warning(f"Not caching a {len(vector)} dimension embedding in a {self.dimensions} dimension cache.")
+            return
+
+        # Appends always land at the end of the file, whatever the last read position was
+        self.file.seek(0, os.SEEK_END)
+        self.offsets[key] = self.file.tell()
+        self.file.write(key + vector.tobytes())
+        self.remember(key, vector)
+
+    def remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def clear(self):
+        self.file.truncate(0)
+        self.offsets = {}
+        self.memory.clear()
+        self.dimensions = None
+        logger.info(f"Embedding cache {self.path} cleared.")
+
+    def close(self):
+        self.file.close()
+        logger.info(f"Embedding cache: {self.hits} hits, {self.misses} misses.")
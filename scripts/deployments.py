@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+from ratelimit import DeploymentError, RateLimiter, RetryableError
+
+logger = logging.getLogger(__name__)
+
+# Weight of the latest call in a deployment's moving average latency
+LATENCY_SMOOTHING = 0.2
+
+
+# One Azure OpenAI deployment, with its own request and token budgets and a circuit breaker. After
+# failure_threshold failures in a row the circuit opens and the deployment gets no traffic for cooldown
+# seconds. Then a single probe request is let through, and its result closes or reopens the circuit.
+# model names the model the deployment serves, which defaults to the deployment name.
+class Deployment:
+    def __init__(self, name, endpoint, api_key, deployment, requests_per_minute, tokens_per_minute, max_concurrency, failure_threshold=5, cooldown=30.0, model=None):
+        self.name = name
+        self.endpoint = endpoint if endpoint.endswith("/") else f"{endpoint}/"
+        self.api_key = api_key
+        self.deployment = deployment
+        self.model = model or deployment
+        self.max_concurrency = max_concurrency
+        self.limiter = RateLimiter(name, requests_per_minute, tokens_per_minute, max_concurrency)
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.latency = None
+        self.failures = 0
+        self.open_until = 0
+        self.probing = False
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.trips = 0
+        # Client for the openai package, set by whoever makes calls through it
+        self.client = None
+
+    def url(self, operation, api_version):
+        return f"{self.endpoint}openai/deployments/{self.deployment}/{operation}?api-version={api_version}"
+
+    @property
+    def is_open(self):
+        return self.failures >= self.failure_threshold
+
+    # Whether the deployment can take a request now: its circuit is closed, or open past its cooldown
+    # with no probe in flight
+    def available(self, now):
+        if not self.is_open:
+            return True
+        return now >= self.open_until and not self.probing
+
+    # Share of the request and token budgets left, from 0 to 1, and 0 while the service has paused it
+    def headroom(self, now):
+        if self.limiter.paused_until > now:
+            return 0.0
+        requests, tokens = self.limiter.requests, self.limiter.tokens
+        requests.refill()
+        tokens.refill()
+        return max(0.0, min(requests.tokens / requests.capacity, tokens.tokens / tokens.capacity))
+
+    def record_success(self, seconds):
+        self.latency = seconds if self.latency is None else (1 - LATENCY_SMOOTHING) * self.latency + LATENCY_SMOOTHING * seconds
+        if self.is_open:
+            logger.info(f"Deployment {self.name} recovered, its circuit is closed.")
+        self.failures = 0
+
+    # A failure counts towards opening the circuit, and open_circuit opens it straight away
+    def record_failure(self, open_circuit=False):
+        self.errors += 1
+        self.failures = max(self.failures + 1, self.failure_threshold) if open_circuit else self.failures + 1
+        if self.failures == self.failure_threshold or (self.failures > self.failure_threshold and self.probing):
+            self.trips += 1
+            self.open_until = time.monotonic() + self.cooldown
+            logger.warning(f"Deployment {self.name} failed {self.failures} times in a row, its circuit is open for {self.cooldown:g}s.")
+
+
+# Spreads requests over several deployments of the same model, possibly in different regions, so
+# throughput adds up across their quotas. Each request goes to a deployment picked at random, weighted by
+# its quota, its remaining headroom and its recent latency. Throttled or failed requests are retried on
+# another deployment when one is free, and unhealthy deployments are skipped until their circuit closes.
+class DeploymentPool:
+    def __init__(self, name, deployments, max_retries=6):
+        self.name = name
+        self.deployments = deployments
+        self.max_retries = max_retries
+        self.retries = 0
+        # Cached results are keyed by the model rather than by whichever deployment served them
+        self.model = deployments[0].model
+
+    def weight(self, deployment, now, default_latency):
+        # Quota sets the share a deployment gets when all have room, headroom and latency shift it
+        headroom = deployment.headroom(now)
+        free = 1 - deployment.in_flight / deployment.max_concurrency
+        return deployment.limiter.tokens.rate * (0.05 + headroom) * max(free, 0.05) / (deployment.latency or default_latency)
+
+    def choose(self, exclude=None):
+        now = time.monotonic()
+        candidates = [deployment for deployment in self.deployments if deployment.available(now) and deployment is not exclude]
+        if not candidates:
+            candidates = [deployment for deployment in self.deployments if deployment.available(now)]
+        if not candidates:
+            # Every circuit is open, so try the one that has been resting longest
+            return min(self.deployments, key=lambda deployment: deployment.open_until)
+        if len(candidates) == 1:
+            return candidates[0]
+        latencies = [deployment.latency for deployment in candidates if deployment.latency is not None]
+        default_latency = sum(latencies) / len(latencies) if latencies else 1.0
+        return random.choices(candidates, [self.weight(deployment, now, default_latency) for deployment in candidates])[0]
+
+    # Whether a deployment other than this one could take a request, straight away unless wait is set
+    def has_alternative(self, deployment, wait=False):
+        now = time.monotonic()
+        return any(other is not deployment and other.available(now) and (wait or other.headroom(now) > 0) for other in self.deployments)
+
+    # Run call(deployment) on a deployment within its budgets, retrying throttled or failed requests on the
+    # same or another deployment. This is the only retry loop, a single deployment is a pool of one.
+    async def run(self, estimated_tokens, call, label=""):
+        request = f"{self.name} request {label}".rstrip()
+        attempt = 0
+        deployment = None
+        while True:
+            deployment = self.choose(exclude=deployment)
+            # A request to a deployment whose circuit is open is the probe that decides whether it closes
+            probe = deployment.is_open
+            if probe:
+                deployment.probing = True
+            limiter = deployment.limiter
+            deployment.in_flight += 1
+            try:
+                async with limiter.semaphore:
+                    await limiter.acquire(estimated_tokens)
+                    deployment.requests += 1
+                    start = time.perf_counter()
+                    try:
+                        result = await call(deployment)
+                        deployment.record_success(time.perf_counter() - start)
+                        return result
+                    except DeploymentError as e:
+                        # A wrong key or deployment name will not fix itself, so the deployment is taken out
+                        # of rotation and the request moves to another one, if there is one
+                        deployment.record_failure(open_circuit=True)
+                        if attempt >= self.max_retries or not self.has_alternative(deployment, wait=True):
+                            logger.error(f"{request} was rejected by {deployment.name}: {e}")
+                            raise
+                        delay = 0
+                        logger.warning(f"{request} was rejected by {deployment.name} and will be retried on another deployment: {e}")
+                    except RetryableError as e:
+                        if e.retry_after is not None:
+                            # The service asked for a pause, which is about quota rather than health
+                            limiter.throttled += 1
+                            limiter.pause(e.retry_after)
+                            delay = e.retry_after
+                        else:
+                            # Server errors and dropped connections count against the deployment's health,
+                            # errors about the request itself, such as a 400, are not retried and do not
+                            deployment.record_failure()
+                            delay = limiter.backoff(attempt)
+                        if attempt >= self.max_retries:
+                            logger.error(f"{request} failed after {attempt + 1} attempts: {e}")
+                            raise
+                        if self.has_alternative(deployment):
+                            delay = 0
+                        logger.warning(f"{request} on {deployment.name} will be retried in {delay:.1f}s: {e}")
+            finally:
+                deployment.in_flight -= 1
+                if probe:
+                    deployment.probing = False
+
+            self.retries += 1
+            attempt += 1
+            if delay:
+                await asyncio.sleep(delay)
+
+    def report(self):
+        if len(self.deployments) < 2:
+            return
+        for deployment in self.deployments:
+            latency = f"{deployment.latency * 1000:.0f} ms" if deployment.latency is not None else "n/a"
+            logger.info(f"{self.name} deployment {deployment.name}: {deployment.requests} requests, {deployment.errors} errors, "
+                        f"{deployment.limiter.throttled} throttled, average latency {latency}, circuit opened {deployment.trips} times")
+
+
+# Read the deployments of each pool from a JSON file such as
+# {"vision": [{"endpoint": "https://eastus.openai.azure.com/", "deployment": "gpt-4o", "tpm": 80000, "rpm": 480}], "embedding": [...]}
+# model names the model a deployment serves, and defaults to default_model. A deployment's key is read from the environment variable named by api_key_env, or taken from api_key,
+# or defaults to default_api_key. rpm, tpm and concurrency default to the given values. quota_share scales
+# the rpm and tpm of every deployment, for a process that shares the quotas with others.
+def load_deployments(path, kind, default_api_key, rpm, tpm, concurrency, failure_threshold=5, cooldown=30.0, quota_share=1.0, default_model=None):
+    with open(path) as file:
+        config = json.load(file)
+
+    deployments = []
+    for entry in config.get(kind, []):
+        api_key = os.getenv(entry["api_key_env"]) if entry.get("api_key_env") else entry.get("api_key")
+        name = entry.get("name") or f"{entry['endpoint'].split('//')[-1].split('.')[0]}/{entry['deployment']}"
+        deployments.append(Deployment(name, entry["endpoint"], api_key or default_api_key, entry["deployment"],
+                                      entry.get("rpm", rpm) * quota_share, entry.get("tpm", tpm) * quota_share, entry.get("concurrency", concurrency),
+                                      failure_threshold, cooldown, entry.get("model") or default_model))
+    return deployments
@@ -0,0 +1,183 @@
+import os
+import ast
+import json
+import struct
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Fixed size of the .npy header, so the row count can be rewritten in place once the export is complete
+NPY_HEADER_SIZE = 128
+
+
+def npy_header(rows, dimensions):
+    header = repr({"descr": "<f4", "fortran_order": False, "shape": (rows, dimensions)})
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+# Streams processed cases to disk as they finish. Each case is a line of NDJSON without its vector,
+# and the vectors are appended as packed float32 rows to a .npy sidecar that can be memory-mapped.
+# A case's VectorRow field is its row in the sidecar. With resume the cases of an interrupted export
+# are kept and new cases are appended after them.
+class CaseExporter:
+    def __init__(self, base_path, resume=False):
+        self.records_path = f"{base_path}.ndjson"
+        self.vectors_path = f"{base_path}.npy"
+        self.rows = 0
+        self.dimensions = None
+        self.case_ids = set()
+
+        directory = os.path.dirname(self.records_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if resume and os.path.exists(self.records_path) and os.path.exists(self.vectors_path):
+            self.recover()
+            self.records_file = open(self.records_path, "a", encoding="utf-8")
+            self.vectors_file = open(self.vectors_path, "r+b")
+            self.vectors_file.seek(0, os.SEEK_END)
+        else:
+            self.records_file = open(self.records_path, "w", encoding="utf-8")
+            self.vectors_file = open(self.vectors_path, "wb")
+
+    # Keep the leading cases that made it to disk with both their record and their vector. The header row
+    # count is only written on close, so the vector count comes from the file size, and the two files are
+    # truncated to the cases they agree on.
+    def recover(self):
+        vectors_size = os.path.getsize(self.vectors_path)
+        if vectors_size < NPY_HEADER_SIZE:
+            open(self.vectors_path, "wb").close()
+            open(self.records_path, "w").close()
+            return
+        with open(self.vectors_path, "rb") as vectors_file:
+            header = vectors_file.read(NPY_HEADER_SIZE)[10:].decode("latin1")
+        dimensions = ast.literal_eval(header.strip())["shape"][1]
+        vector_rows = (vectors_size - NPY_HEADER_SIZE) // (4 * dimensions) if dimensions else 0
+
+        kept_bytes = 0
+        with open(self.records_path, "rb") as records_file:
+            for line in records_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b"\n") or record.get("VectorRow") != self.rows or self.rows >= vector_rows:
+                    break
+                self.case_ids.add(record["CaseID"])
+                self.rows += 1
+                kept_bytes += len(line)
+
+        with open(self.records_path, "r+b") as records_file:
+            records_file.truncate(kept_bytes)
+        with open(self.vectors_path, "r+b") as vectors_file:
+            vectors_file.truncate(NPY_HEADER_SIZE + self.rows * 4 * dimensions)
+        self.dimensions = dimensions or None
+        logger.info(f"Resuming the export in {self.records_path} after {self.rows} cases.")
+
+    def write(self, document):
+        document = dict(document)
+        vector = np.asarray(document.pop("Vector"), dtype="<f4")
+        if self.dimensions is None:
+            self.dimensions = len(vector)
+            self.vectors_file.seek(0)
+            self.vectors_file.truncate()
+            self.vectors_file.write(npy_header(0, self.dimensions))
+        elif len(vector) != self.dimensions:
+            raise ValueError(f"Vector for case {document.get('CaseID')} has {len(vector)} dimensions, expected {self.dimensions}")
+
+        self.vectors_file.write(vector.tobytes())
+        document["VectorRow"] = self.rows
+        self.records_file.write(json.dumps(document) + "\n")
+        self.rows += 1
+        self.case_ids.add(document.get("CaseID"))
+
+    def close(self):
+        if self.dimensions is None:
+            # No cases were written, but the sidecar should still load as an empty matrix
+            self.dimensions = 0
+            self.vectors_file.truncate(0)
+        self.vectors_file.seek(0)
+        self.vectors_file.write(npy_header(self.rows, self.dimensions))
+        self.vectors_file.close()
+        self.records_file.close()
+        logger.info(f"Exported {self.rows} cases to {self.records_path} and {self.vectors_path}.")
+
+
+# Load an export's records and its vectors. With mmap the vectors stay on disk and are paged in on demand.
+def load_export(base_path, mmap=True):
+    with open(f"{base_path}.ndjson", encoding="utf-8") as records_file:
+        records = [json.loads(line) for line in records_file if line.strip()]
+    vectors = np.load(f"{base_path}.npy", mmap_mode="r" if mmap else None)
+    return records, vectors
+
+
+# Load the older indented JSON export, such as scripts/indexdata.json, in the same shape as load_export
+def load_json_export(json_file_path):
+    with open(json_file_path, encoding="utf-8") as json_file:
+        documents = json.load(json_file)
+    records = []
+    vectors = []
+    for row, document in enumerate(documents):
+        record = {key: value for key, value in document.items() if key != "Vector"}
+        record["VectorRow"] = row
+        records.append(record)
+        vectors.append(document["Vector"])
+    return records, np.asarray(vectors, dtype=np.float32)
+
+
+# Load an export by its base path, or the older JSON export when the path ends in .json
+def load_records(path, mmap=True):
+    if path.endswith(".json"):
+        return load_json_export(path)
+    return load_export(path, mmap=mmap)
+
+
+# Yield search documents from an export one at a time, with their vectors restored as lists
+def iter_documents(base_path):
+    vectors = np.load(f"{base_path}.npy", mmap_mode="r")
+    with open(f"{base_path}.ndjson", encoding="utf-8") as records_file:
+        for line in records_file:
+            if not line.strip():
+                continue
+            document = json.loads(line)
+            document["Vector"] = vectors[document.pop("VectorRow")].tolist()
+            yield document
+
+
+# Combine exports, such as those of the shards of a run, into one at base_path. Each record's VectorRow is
+# moved past the rows of the exports before it, and the vectors are copied in blocks rather than decoded.
+# Exports that do not exist are skipped. Returns the number of cases in the combined export.
+def merge_exports(base_paths, base_path, block_rows=10000):
+    rows = 0
+    dimensions = 0
+    directory = os.path.dirname(base_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(f"{base_path}.ndjson", "w", encoding="utf-8") as records_out, open(f"{base_path}.npy", "wb") as vectors_out:
+        vectors_out.write(npy_header(0, 0))
+        for path in base_paths:
+            if not os.path.exists(f"{path}.ndjson") or not os.path.exists(f"{path}.npy"):
+                continue
+            vectors = np.load(f"{path}.npy", mmap_mode="r")
+            if not len(vectors):
+                continue
+            if dimensions and vectors.shape[1] != dimensions:
+                raise ValueError(f"Vectors in {path}.npy have {vectors.shape[1]} dimensions, expected {dimensions}")
+            dimensions = vectors.shape[1]
+
+            with open(f"{path}.ndjson", encoding="utf-8") as records_in:
+                for line in records_in:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    record["VectorRow"] += rows
+                    records_out.write(json.dumps(record) + "\n")
+            for start in range(0, len(vectors), block_rows):
+                vectors_out.write(np.ascontiguousarray(vectors[start:start + block_rows], dtype="<f4").tobytes())
+            rows += len(vectors)
+
+        vectors_out.seek(0)
+        vectors_out.write(npy_header(rows, dimensions))
+    logger.info(f"Merged {rows} cases from {len(base_paths)} exports into {base_path}.ndjson and {base_path}.npy.")
+    return rows
@@ -0,0 +1,77 @@
+import io
+import math
+import struct
+from PIL import Image, ImageOps
+
+# JPEG start-of-frame markers, which carry the image dimensions
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# GPT-4 Vision image token pricing in high detail mode
+IMAGE_BASE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+IMAGE_TILE_SIZE = 512
+# Used when the dimensions cannot be read, roughly a 768x1536 image
+IMAGE_DEFAULT_TOKENS = IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * 6
+
+
+# Read (width, height) from the header of a JPEG or PNG without decoding the image
+def image_dimensions(data):
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return struct.unpack(">II", data[16:24])
+
+    if data[:2] == b"\xff\xd8":
+        offset = 2
+        while offset + 9 < len(data):
+            if data[offset] != 0xFF:
+                offset += 1
+                continue
+            marker = data[offset + 1]
+            if marker in JPEG_SOF_MARKERS:
+                height, width = struct.unpack(">HH", data[offset + 5:offset + 9])
+                return width, height
+            if marker == 0xFF or 0xD0 <= marker <= 0xD9:
+                offset += 1 if marker == 0xFF else 2
+                continue
+            segment_length = struct.unpack(">H", data[offset + 2:offset + 4])[0]
+            offset += 2 + segment_length
+
+    return None
+
+
+# Estimate the prompt tokens an image costs: fit within 2048x2048, scale the short side down to 768,
+# then charge per 512px tile
+def estimate_image_tokens(width, height):
+    scale = min(1, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(height / IMAGE_TILE_SIZE)
+    return IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * tiles
+
+
+def estimate_image_tokens_from_bytes(data):
+    dimensions = image_dimensions(data)
+    if not dimensions:
+        return IMAGE_DEFAULT_TOKENS
+    return estimate_image_tokens(*dimensions)
+
+
+# Downscale an image to fit max_edge and re-encode it as a JPEG without its EXIF data.
+# Runs in a worker process, so it takes and returns plain bytes and tuples.
+def preprocess_image(data, max_edge, quality):
+    with Image.open(io.BytesIO(data)) as image:
+        # A small JPEG with no EXIF data gains nothing from a re-encode
+        if image.format == "JPEG" and max(image.size) <= max_edge and not image.getexif():
+            return data, image.size, image.size
+
+        # Apply the EXIF orientation before the EXIF data is dropped
+        image = ImageOps.exif_transpose(image)
+        original_size = image.size
+        if max(image.size) > max_edge:
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+        return output.getvalue(), original_size, image.size
@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from sqlbatch import BatchWriter
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("uploaded", "described", "embedded", "indexed")
+
+
+# Durable record of the stages each case has completed, kept in a local SQLite file so a run that stops
+# part way can be resumed. Tasks record stages without touching the database; the records are buffered
+# and written in one transaction per batch on a worker thread, so the journal never holds up the pipeline.
+# It also records the Batch API jobs in flight, so a resumed run can wait for them instead of resubmitting.
+class StageJournal:
+    def __init__(self, path, batch_size=1000, flush_interval=1.0):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS CaseStages (
+            CaseID TEXT NOT NULL,
+            Stage TEXT NOT NULL,
+            CompletedAt REAL NOT NULL,
+            PRIMARY KEY (CaseID, Stage)
+        ) WITHOUT ROWID
+        """)
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS BatchJobs (
+            BatchID TEXT PRIMARY KEY,
+            Name TEXT NOT NULL,
+            CustomIDs TEXT NOT NULL,
+            SubmittedAt REAL NOT NULL
+        )
+        """)
+        self.conn.commit()
+        # Batches are written on worker threads, and the connection must only be used by one at a time
+        self.lock = threading.Lock()
+        self.writer = BatchWriter("Stage journal", self.write_batch, batch_size, flush_interval)
+
+    def start(self):
+        self.writer.start()
+
+    async def record(self, case_ids, stage):
+        now = time.time()
+        for case_id in case_ids:
+            await self.writer.add((case_id, stage, now))
+
+    async def write_batch(self, rows):
+        await asyncio.to_thread(self.write_rows, rows)
+
+    def write_rows(self, rows):
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO CaseStages (CaseID, Stage, CompletedAt) VALUES (?, ?, ?)", rows)
+            self.conn.commit()
+
+    # CaseIDs that have completed a stage
+    def completed(self, stage):
+        with self.lock:
+            return {row[0] for row in self.conn.execute("SELECT CaseID FROM CaseStages WHERE Stage = ?", (stage,))}
+
+    # Jobs are rare and must be on disk before the run can be interrupted, so they are written straight away
+    def record_batch_job(self, name, batch_id, custom_ids):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO BatchJobs (BatchID, Name, CustomIDs, SubmittedAt) VALUES (?, ?, ?, ?)",
+                              (batch_id, name, json.dumps(custom_ids), time.time()))
+            self.conn.commit()
+
+    def remove_batch_job(self, batch_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM BatchJobs WHERE BatchID = ?", (batch_id,))
+            self.conn.commit()
+
+    # (batch ID, custom IDs) of each recorded job of a kind, oldest first
+    def batch_jobs(self, name):
+        with self.lock:
+            rows = self.conn.execute("SELECT BatchID, CustomIDs FROM BatchJobs WHERE Name = ? ORDER BY SubmittedAt", (name,)).fetchall()
+        return [(batch_id, json.loads(custom_ids)) for batch_id, custom_ids in rows]
+
+    # Number of cases that have completed each stage
+    def counts(self):
+        with self.lock:
+            counts = dict(self.conn.execute("SELECT Stage, COUNT(*) FROM CaseStages GROUP BY Stage").fetchall())
+        return {stage: counts.get(stage, 0) for stage in STAGES}
+
+    def summary(self):
+        counts = self.counts()
+        return ", ".join(f"{counts[stage]} {stage}" for stage in STAGES)
+
+    # Write out the buffered records now, so counts() includes them
+    async def flush(self):
+        await self.writer.flush()
+
+    def clear(self):
+        self.writer.rows = []
+        with self.lock:
+            self.conn.execute("DELETE FROM CaseStages")
+            self.conn.execute("DELETE FROM BatchJobs")
+            self.conn.commit()
+        logger.info(f"Stage journal {self.path} cleared.")
+
+    # Write out the buffered records and close. A run that completed clears the journal, since
+    # there is nothing left to resume.
+    async def close(self, clear=False):
+        await self.writer.close()
+        if clear:
+            self.clear()
+        self.conn.close()
@@ -0,0 +1,182 @@
+import time
+import logging
+import argparse
+import numpy as np
+from export import load_records
+
+logger = logging.getLogger(__name__)
+
+# A filter whose candidates fall into more runs of rows than this gathers them into one matrix instead
+MAX_CANDIDATE_RUNS = 64
+
+
+# Parse a DateOpened value into a numpy datetime, ignoring a trailing UTC designator
+def parse_date(value):
+    return np.datetime64(value.rstrip("Z"), "ms")
+
+
+# Order records by MouldDetected, JobAssigned and DateOpened, so the cases that pass any combination
+# of the filters lie in a few contiguous runs of rows
+def filter_order(records):
+    return sorted(records, key=lambda record: (bool(record.get("MouldDetected")), record.get("JobAssigned") or "", record.get("DateOpened") or ""))
+
+
+# Exact top-k cosine search over exported case vectors, with pre-filters on the index's filterable fields.
+# Runs entirely in memory with no network access.
+class LocalSearchIndex:
+    def __init__(self, records, vectors):
+        records = filter_order(records)
+        self.records = records
+        # Gather the rows in record order into one contiguous float32 matrix of unit vectors,
+        # so cosine similarity is a single matrix product
+        rows = np.fromiter((record["VectorRow"] for record in records), dtype=np.int64, count=len(records))
+        vectors = np.asarray(vectors, dtype=np.float32)[rows] if len(records) else np.zeros((0, vectors.shape[1] if vectors.ndim == 2 else 0), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        self.vectors = np.ascontiguousarray(vectors / norms)
+        self.index_fields(records)
+
+    # Build the lookup and filter arrays for the records' filterable fields
+    def index_fields(self, records):
+        self.case_rows = {record["CaseID"]: row for row, record in enumerate(records)}
+        self.mould_detected = np.array([bool(record.get("MouldDetected")) for record in records], dtype=bool)
+        self.job_assigned = np.array([record.get("JobAssigned") or "" for record in records])
+        self.date_opened = np.array([parse_date(record["DateOpened"]) if record.get("DateOpened") else np.datetime64("NaT", "ms") for record in records], dtype="datetime64[ms]")
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        return cls(*load_records(path, mmap))
+
+    def __len__(self):
+        return len(self.records)
+
+    # Boolean mask of the rows that pass the filters, or None when there are no filters
+    def filter_mask(self, mould_detected=None, job_assigned=None, opened_after=None, opened_before=None):
+        mask = None
+
+        def combine(condition):
+            return condition if mask is None else mask & condition
+
+        if mould_detected is not None:
+            mask = combine(self.mould_detected == bool(mould_detected))
+        if job_assigned is not None:
+            mask = combine(self.job_assigned == job_assigned)
+        if opened_after is not None:
+            mask = combine(self.date_opened >= parse_date(opened_after))
+        if opened_before is not None:
+            mask = combine(self.date_opened < parse_date(opened_before))
+        return mask
+
+    # Score the candidate rows against the query and return the top k as (row, score) pairs, best first
+    def top_k(self, query_vector, k=10, mask=None, exclude_row=None):
+        query = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+
+        if mask is None:
+            candidates = None
+            scores = self.vectors @ query
+        else:
+            # Only the candidate rows are scored. Each run of them is a slice of the matrix, so it is
+            # scored in place rather than copied out first.
+            candidates = np.flatnonzero(mask)
+            if not len(candidates):
+                return []
+            breaks = np.flatnonzero(np.diff(candidates) != 1) + 1
+            if len(breaks) < MAX_CANDIDATE_RUNS:
+                scores = np.concatenate([self.vectors[run[0]:run[-1] + 1] @ query for run in np.split(candidates, breaks)])
+            else:
+                scores = self.vectors[candidates] @ query
+
+        if exclude_row is not None:
+            if candidates is None:
+                scores[exclude_row] = -np.inf
+            else:
+                scores[candidates == exclude_row] = -np.inf
+
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        top = top[np.isfinite(scores[top])]
+        rows = top if candidates is None else candidates[top]
+        return list(zip(rows.tolist(), scores[top].tolist()))
+
+    def row_vector(self, row):
+        return self.vectors[row]
+
+    def search(self, query_vector, k=10, **filters):
+        return [(self.records[row], score) for row, score in self.top_k(query_vector, k, self.filter_mask(**filters))]
+
+    # Find the cases most similar to an existing case, excluding the case itself
+    def search_case(self, case_id, k=10, **filters):
+        row = self.case_rows[case_id]
+        matches = self.top_k(self.row_vector(row), k, self.filter_mask(**filters), exclude_row=row)
+        return [(self.records[match], score) for match, score in matches]
+
+
+# Perturbed copies of stored vectors, which stand in for new queries near the existing cases when
+# measuring the recall of approximate search
+def sample_queries(records, vectors, count, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(records), count)
+    queries = np.asarray(vectors, dtype=np.float32)[[records[row]["VectorRow"] for row in rows]]
+    return queries + rng.standard_normal(queries.shape, dtype=np.float32) * queries.std() * 0.5
+
+
+def print_matches(matches):
+    for record, score in matches:
+        print(f"{score:.4f}  {record['CaseID']}  {record['FileName']}  mould={record['MouldDetected']}  job={record['JobAssigned']}  opened={record['DateOpened']}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Query the exported maintenance cases offline.")
+    parser.add_argument("--index", default="scripts/indexdata", help="Export base path (without .ndjson/.npy) or an indexdata.json file.")
+    parser.add_argument("--case-id", help="Find the cases most similar to this case.")
+    parser.add_argument("-k", type=int, default=5, help="Number of results to return.")
+    parser.add_argument("--mould", choices=["yes", "no"], help="Only return cases with or without mould detected.")
+    parser.add_argument("--job-assigned", choices=["yes", "no"], help="Only return cases with this JobAssigned value.")
+    parser.add_argument("--opened-after", help="Only return cases opened on or after this ISO date.")
+    parser.add_argument("--opened-before", help="Only return cases opened before this ISO date.")
+    parser.add_argument("--benchmark", type=int, metavar="QUERIES", help="Time this many random queries instead of searching.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    start = time.perf_counter()
+    index = LocalSearchIndex.load(args.index)
+    logger.info(f"Loaded {len(index)} cases from {args.index} in {(time.perf_counter() - start) * 1000:.1f} ms.")
+
+    filters = {
+        "mould_detected": None if args.mould is None else args.mould == "yes",
+        "job_assigned": args.job_assigned,
+        "opened_after": args.opened_after,
+        "opened_before": args.opened_before,
+    }
+
+    if args.benchmark:
+        queries = np.random.default_rng(0).standard_normal((args.benchmark, index.vectors.shape[1]), dtype=np.float32)
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            index.search(query, args.k, **filters)
+            latencies.append((time.perf_counter() - start) * 1000)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        logger.info(f"{args.benchmark} queries over {len(index)} cases: p50 {p50:.3f} ms, p95 {p95:.3f} ms, p99 {p99:.3f} ms.")
+        return
+
+    if not args.case_id:
+        raise SystemExit("Pass --case-id to search, or --benchmark to time queries.")
+    if args.case_id not in index.case_rows:
+        raise SystemExit(f"Case {args.case_id} is not in the export {args.index}.")
+
+    print_matches(index.search_case(args.case_id, args.k, **filters))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import os
+import math
+import time
+import bisect
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Bucket bounds in seconds for the exported latency histograms, the Prometheus client defaults
+# stretched out to cover multi-second model calls
+EXPORT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Percentiles are read from log spaced buckets, each 2^(1/16) or about 4.4% wider than the last,
+# so a percentile is within that much of the true value however many calls are recorded
+BUCKET_GROWTH = 2 ** (1 / 16)
+BUCKET_MIN_SECONDS = 1e-4
+
+
+# Latency histogram that holds bucket counts rather than samples, so its memory does not grow with the run
+class Histogram:
+    def __init__(self):
+        self.buckets = {}
+        self.export_counts = [0] * len(EXPORT_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        seconds = max(seconds, 0.0)
+        index = 0 if seconds <= BUCKET_MIN_SECONDS else math.ceil(math.log(seconds / BUCKET_MIN_SECONDS, BUCKET_GROWTH))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        position = bisect.bisect_left(EXPORT_BUCKETS, seconds)
+        if position < len(EXPORT_BUCKETS):
+            self.export_counts[position] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    # The upper bound of the bucket holding the q-th quantile, capped at the largest value seen
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(q * self.count))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(BUCKET_MIN_SECONDS * BUCKET_GROWTH ** index, self.max)
+        return self.max
+
+    # Cumulative counts at each export bound, as Prometheus expects
+    def cumulative(self):
+        counts = []
+        running = 0
+        for count in self.export_counts:
+            running += count
+            counts.append(running)
+        return counts
+
+
+# Times one call into a stage. A call that raises is counted as an error.
+class Timer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        if exc_type is not None:
+            self.metrics.count(self.stage, "errors")
+        return False
+
+
+class StageMetrics:
+    def __init__(self):
+        self.latency = Histogram()
+        self.counters = {}
+
+
+def format_seconds(seconds):
+    if seconds < 1:
+        return f"{seconds * 1000:.0f} ms"
+    return f"{seconds:.2f} s"
+
+
+def format_counter(name, value):
+    if name.startswith("bytes") and value >= 1024 * 1024:
+        return f"{name}={value / (1024 * 1024):.1f}MiB"
+    return f"{name}={value:g}"
+
+
+# Latency histograms and counters (retries, bytes, tokens and so on) for each stage of a run. Recording
+# is a few dictionary updates, so it is always on. At the end of the run it logs a summary, and can
+# write the Prometheus text format or export live to OpenTelemetry when the SDK is installed.
+class RunMetrics:
+    def __init__(self, prefix="prepdata"):
+        self.prefix = prefix
+        self.stages = {}
+        self.started = time.perf_counter()
+        self.meter_provider = None
+        self.instruments = {}
+
+    def stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = StageMetrics()
+        return stage
+
+    def timer(self, stage):
+        return Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        self.stage(stage).latency.observe(seconds)
+        if self.meter_provider is not None:
+            self.instrument("duration").record(seconds, {"stage": stage})
+
+    def count(self, stage, name, amount=1):
+        if not amount:
+            return
+        counters = self.stage(stage).counters
+        counters[name] = counters.get(name, 0) + amount
+        if self.meter_provider is not None:
+            self.instrument(name).add(amount, {"stage": stage})
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        logger.info(f"Run metrics after {elapsed:.1f} s:")
+        logger.info(f"  {'stage':<16}{'calls':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+        for name, stage in self.stages.items():
+            latency = stage.latency
+            counters = " ".join(format_counter(counter, value) for counter, value in sorted(stage.counters.items()))
+            logger.info(f"  {name:<16}{latency.count:>8}"
+                        f"{format_seconds(latency.percentile(0.5)):>10}{format_seconds(latency.percentile(0.95)):>10}"
+                        f"{format_seconds(latency.percentile(0.99)):>10}{format_seconds(latency.max):>10}  {counters}")
+
+    # The metrics in the Prometheus text exposition format
+    def prometheus_text(self):
+        name = f"{self.prefix}_stage_duration_seconds"
+        lines = [
+            f"# HELP {name} Duration of the calls made by each stage.",
+            f"# TYPE {name} histogram",
+        ]
+        for stage_name, stage in self.stages.items():
+            latency = stage.latency
+            if not latency.count:
+                continue
+            for bound, count in zip(EXPORT_BUCKETS, latency.cumulative()):
+                lines.append(f'{name}_bucket{{stage="{stage_name}",le="{bound:g}"}} {count}')
+            lines.append(f'{name}_bucket{{stage="{stage_name}",le="+Inf"}} {latency.count}')
+            lines.append(f'{name}_sum{{stage="{stage_name}"}} {latency.total:.6f}')
+            lines.append(f'{name}_count{{stage="{stage_name}"}} {latency.count}')
+
+        counter_names = sorted({counter for stage in self.stages.values() for counter in stage.counters})
+        for counter in counter_names:
+            name = f"{self.prefix}_stage_{counter}_total"
+            lines.append(f"# TYPE {name} counter")
+            for stage_name, stage in self.stages.items():
+                if counter in stage.counters:
+                    lines.append(f'{name}{{stage="{stage_name}"}} {stage.counters[counter]:g}')
+        return "\n".join(lines) + "\n"
+
+    # Written to a temporary file and renamed, so a node exporter textfile collector never reads half a file
+    def write_prometheus(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write(self.prometheus_text())
+        os.replace(temp_path, path)
+        logger.info(f"Wrote run metrics to {path}.")
+
+    # Export to Application Insights when a connection string is given and the Azure Monitor exporter is
+    # installed, otherwise to the OTLP endpoint in OTEL_EXPORTER_OTLP_ENDPOINT. Both are optional extras.
+    def enable_opentelemetry(self, connection_string=None, export_interval=15.0):
+        try:
+            from opentelemetry.sdk.metrics import MeterProvider
+            from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+            from opentelemetry.sdk.resources import Resource
+        except ImportError:
+            logger.warning("The opentelemetry-sdk package is not installed, metrics will not be exported.")
+            return False
+
+        try:
+            if connection_string:
+                from azure.monitor.opentelemetry.exporter import AzureMonitorMetricExporter
+                exporter = AzureMonitorMetricExporter(connection_string=connection_string)
+                destination = "Application Insights"
+            else:
+                from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
+                exporter = OTLPMetricExporter()
+                destination = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT") or "the default OTLP endpoint"
+        except ImportError as e:
+            logger.warning(f"The metrics exporter is not installed, metrics will not be exported: {e}")
+            return False
+
+        reader = PeriodicExportingMetricReader(exporter, export_interval_millis=export_interval * 1000)
+        self.meter_provider = MeterProvider(metric_readers=[reader], resource=Resource.create({"service.name": self.prefix}))
+        self.meter = self.meter_provider.get_meter(self.prefix)
+        logger.info(f"Exporting run metrics to {destination}.")
+        return True
+
+    def instrument(self, name):
+        instrument = self.instruments.get(name)
+        if instrument is None:
+            if name == "duration":
+                instrument = self.meter.create_histogram(f"{self.prefix}.stage.duration", unit="s", description="Duration of the calls made by each stage.")
+            else:
+                instrument = self.meter.create_counter(f"{self.prefix}.stage.{name}")
+            self.instruments[name] = instrument
+        return instrument
+
+    # Flush the last readings to the exporter
+    def shutdown(self):
+        if self.meter_provider is not None:
+            try:
+                self.meter_provider.shutdown()
+            except Exception as e:
+                logger.error(f"An error occurred while exporting the final metrics: {e}")
+            self.meter_provider = None
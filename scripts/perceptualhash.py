@@ -0,0 +1,126 @@
+import io
+import numpy as np
+from PIL import Image, ImageOps
+
+HASH_SIZE = 8
+PHASH_SAMPLE_SIZE = 32
+
+
+def dct_matrix(size):
+    n = np.arange(size)
+    return np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size))
+
+
+DCT_MATRIX = dct_matrix(PHASH_SAMPLE_SIZE)
+
+
+def bits_to_int(bits):
+    value = 0
+    for bit in bits.ravel().tolist():
+        value = (value << 1) | int(bit)
+    return value
+
+
+# pHash: the low frequency 8x8 corner of the DCT of a 32x32 grayscale thumbnail, one bit per
+# coefficient above the median. Robust to rescaling, recompression and small exposure changes.
+def phash(image):
+    pixels = np.asarray(image.convert("L").resize((PHASH_SAMPLE_SIZE, PHASH_SAMPLE_SIZE), Image.LANCZOS), dtype=np.float64)
+    low = (DCT_MATRIX @ pixels @ DCT_MATRIX.T)[:HASH_SIZE, :HASH_SIZE]
+    # The DC term is the overall brightness, so it is left out of the median
+    return bits_to_int(low > np.median(low.ravel()[1:]))
+
+
+# dHash: one bit per horizontally adjacent pair of a 9x8 grayscale thumbnail, set where brightness increases
+def dhash(image):
+    pixels = np.asarray(image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS), dtype=np.int16)
+    return bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+# Both 64 bit hashes of an encoded image. Runs in a worker process, so it takes bytes and returns a tuple.
+def perceptual_hashes(data):
+    with Image.open(io.BytesIO(data)) as image:
+        # Apply the EXIF orientation, so a photo and a rotated copy of it hash alike
+        image = ImageOps.exif_transpose(image)
+        return phash(image), dhash(image)
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+# The hashes as stored in the PerceptualHash column, 32 hex digits of pHash then dHash
+def format_hashes(hashes):
+    return f"{hashes[0]:016x}{hashes[1]:016x}"
+
+
+def parse_hashes(value):
+    if not value or len(value) != 32:
+        return None
+    return int(value[:16], 16), int(value[16:], 16)
+
+
+# Burkhard-Keller tree over 64 bit hashes. Children are keyed by their Hamming distance to the parent,
+# and the triangle inequality limits a radius search to the children within that radius of the distance.
+class BKTree:
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = (value, [item], {})
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (value, [item], {})
+                return
+            node = child
+
+    # Return (distance, value, item) for every item within max_distance of value
+    def search(self, value, max_distance):
+        matches = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node_value, items, children = stack.pop()
+            distance = hamming_distance(value, node_value)
+            if distance <= max_distance:
+                matches.extend((distance, node_value, item) for item in items)
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return matches
+
+
+# Finds the case whose image is a near duplicate of another. Candidates come from a BK-tree over the
+# pHash and must also be within max_distance on the dHash, which weeds out chance pHash collisions.
+class DuplicateIndex:
+    def __init__(self, max_distance=6):
+        self.max_distance = max_distance
+        self.tree = BKTree()
+        self.dhashes = {}
+
+    def __len__(self):
+        return len(self.tree)
+
+    def add(self, hashes, case_id):
+        self.tree.add(hashes[0], case_id)
+        self.dhashes[case_id] = hashes[1]
+
+    # The closest earlier case within the threshold, or None
+    def find(self, hashes):
+        best = None
+        for distance, _, case_id in self.tree.search(hashes[0], self.max_distance):
+            dhash_distance = hamming_distance(hashes[1], self.dhashes[case_id])
+            if dhash_distance <= self.max_distance and (best is None or distance + dhash_distance < best[0]):
+                best = (distance + dhash_distance, case_id)
+        return best[1] if best else None
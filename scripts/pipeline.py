@@ -0,0 +1,96 @@
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of a stage's input
+STOP = object()
+
+
+# One step of a pipeline: concurrency workers that take items from a bounded queue and pass results on
+# by awaiting emit(item). close(emit) runs once every worker has finished, before the next stage is told
+# its input has ended, so a stage can flush buffered work or feed in extra items.
+class Stage:
+    def __init__(self, name, handle, concurrency=1, queue_size=64, close=None):
+        self.name = name
+        self.handle = handle
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.close = close
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+
+
+async def discard(item):
+    pass
+
+
+# Runs stages as worker pools connected by bounded asyncio queues. A full queue holds up the stage
+# feeding it, so the slowest stage sets the pace and the number of items in flight stays bounded.
+# When given a RunMetrics, the time each stage spends on each item is recorded under the stage's name.
+class Pipeline:
+    def __init__(self, stages, metrics=None):
+        self.stages = stages
+        self.metrics = metrics
+        self.queues = [asyncio.Queue(maxsize=stage.queue_size) for stage in stages]
+
+    def emitter(self, index):
+        if index + 1 < len(self.stages):
+            return self.queues[index + 1].put
+        return discard
+
+    async def work(self, index):
+        stage = self.stages[index]
+        queue = self.queues[index]
+        emit = self.emitter(index)
+        while True:
+            item = await queue.get()
+            if item is STOP:
+                return
+            start = time.perf_counter()
+            try:
+                await stage.handle(item, emit)
+                stage.processed += 1
+            except Exception as e:
+                stage.failed += 1
+                logger.error(f"An error occurred in the {stage.name} stage: {e}")
+            elapsed = time.perf_counter() - start
+            stage.busy_seconds += elapsed
+            if self.metrics is not None:
+                self.metrics.observe(stage.name, elapsed)
+
+    async def run_stage(self, index):
+        stage = self.stages[index]
+        await asyncio.gather(*(self.work(index) for _ in range(stage.concurrency)))
+        if stage.close is not None:
+            try:
+                await stage.close(self.emitter(index))
+            except Exception as e:
+                logger.error(f"An error occurred while closing the {stage.name} stage: {e}")
+        if index + 1 < len(self.stages):
+            for _ in range(self.stages[index + 1].concurrency):
+                await self.queues[index + 1].put(STOP)
+
+    # Feed the items into the first stage and wait for every stage to drain
+    async def run(self, items):
+        start = time.perf_counter()
+        runners = [asyncio.create_task(self.run_stage(index)) for index in range(len(self.stages))]
+        try:
+            for item in items:
+                await self.queues[0].put(item)
+            for _ in range(self.stages[0].concurrency):
+                await self.queues[0].put(STOP)
+            await asyncio.gather(*runners)
+        except BaseException:
+            for runner in runners:
+                runner.cancel()
+            raise
+
+        elapsed = time.perf_counter() - start
+        logger.info(f"Pipeline finished in {elapsed:.1f} s:")
+        for stage in self.stages:
+            # Utilization is the share of the run that the stage's workers spent handling items
+            utilization = stage.busy_seconds / (elapsed * stage.concurrency) if elapsed else 0
+            logger.info(f"  {stage.name}: {stage.processed} items, {stage.failed} failed, {stage.concurrency} workers {utilization:.0%} busy")
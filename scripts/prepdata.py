@@ -4,14 +4,20 @@ import json
 import logging
 import asyncio
 import aiohttp
+import httpx
 import aiofiles
 import aioodbc
 import random
 import datetime
-from openai import AsyncAzureOpenAI
+import hashlib
+import argparse
+import time
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from openai import AsyncAzureOpenAI, APIConnectionError, APIStatusError, APITimeoutError
 from azure.core.credentials import AzureKeyCredential
 from azure.storage.blob.aio import BlobServiceClient
-from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import (
     SimpleField,
@@ -30,19 +36,127 @@ from azure.search.documents.indexes.models import (
     AzureOpenAIParameters
 )
 from azure.identity import DefaultAzureCredential
+from assessment import ASSESSMENT_SCHEMA, BATCH_ASSESSMENT_SCHEMA, MOULD_SEVERITIES, TRADES, parse_assessment, split_assessments
+from cache import DescriptionCache, EmbeddingCache
+from images import estimate_image_tokens, estimate_image_tokens_from_bytes, preprocess_image
+from ratelimit import DEPLOYMENT_ERROR_STATUSES, DeploymentError, RetryableError, parse_retry_after
+from deployments import Deployment, DeploymentPool, load_deployments
+from sqlbatch import BatchWriter
+from export import CaseExporter, iter_documents, merge_exports
+from quantize import QUANTIZERS, report_export
+from journal import StageJournal
+from metrics import RunMetrics
+from batchjobs import BatchJobs
+from shards import parse_shard, read_status, run_workers, shard_of, shard_path, write_status
+from pipeline import Pipeline, Stage
+from perceptualhash import DuplicateIndex, perceptual_hashes, format_hashes, parse_hashes
 
 # Configuration
 OAI_API_ENDPOINT = os.getenv("AZURE_OAI_ENDPOINT")
 OAI_API_KEY = os.getenv("AZURE_OAI_API_KEY")
 OAI_EMBED_DEPLOYMENT_NAME = os.getenv("AZURE_OAI_EMBED_DEPLOYMENT_NAME") or "text-embedding-ada-002"
 OAI_GPTVISION_DEPLOYMENT_NAME = os.getenv("AZURE_OAI_GPTVISION_DEPLOYMENT_NAME") or "gpt-4-turbo"
-OAI_GPT4V_API_ENDPOINT = f"{os.getenv("AZURE_OAI_ENDPOINT")}openai/deployments/gpt-4-turbo/chat/completions?api-version=2024-02-15-preview"
+# Vision responses are structured: json_object uses JSON mode, which gpt-4-turbo supports, and json_schema
+# needs a model and API version with structured outputs, such as gpt-4o
+VISION_RESPONSE_FORMAT = "json_schema" if os.getenv("PREPDATA_VISION_RESPONSE_FORMAT") == "json_schema" else "json_object"
+OAI_BATCH_GPTVISION_DEPLOYMENT_NAME = os.getenv("AZURE_OAI_BATCH_GPTVISION_DEPLOYMENT_NAME") or OAI_GPTVISION_DEPLOYMENT_NAME
+OAI_BATCH_EMBED_DEPLOYMENT_NAME = os.getenv("AZURE_OAI_BATCH_EMBED_DEPLOYMENT_NAME") or OAI_EMBED_DEPLOYMENT_NAME
+BATCH_API_VERSION = "2024-10-21"
+VISION_API_VERSION = "2024-08-01-preview" if VISION_RESPONSE_FORMAT == "json_schema" else "2024-02-15-preview"
+EMBED_API_VERSION = "2024-02-01"
 SEARCH_SERVICE_ENDPOINT = os.getenv("AZURE_SEARCH_SERVICE_ENDPOINT")
 SEARCH_INDEX_NAME = os.getenv("AZURE_SEARCH_INDEX_NAME") or "maintenance-requests"
 SEARCH_API_KEY = os.getenv("AZURE_SEARCH_API_KEY")
 BLOB_CONNECTION_STRING = os.getenv("AZURE_BLOB_CONNECTION_STRING")
 STORAGE_CONTAINER = os.getenv("AZURE_STORAGE_CONTAINER") or "images"
 SQL_CONNECTION_STRING = os.getenv("AZURE_PYTHON_SQL_CONNECTION_STRING")
+DESCRIPTION_CACHE_PATH = os.getenv("PREPDATA_DESCRIPTION_CACHE_PATH") or "scripts/.cache/descriptions.sqlite3"
+DESCRIPTION_CACHE_MAX_ENTRIES = int(os.getenv("PREPDATA_DESCRIPTION_CACHE_MAX_ENTRIES") or 50000)
+DESCRIPTION_CACHE_MAX_AGE_DAYS = int(os.getenv("PREPDATA_DESCRIPTION_CACHE_MAX_AGE_DAYS") or 30)
+EMBEDDING_CACHE_PATH = os.getenv("PREPDATA_EMBEDDING_CACHE_PATH") or "scripts/.cache/embeddings.bin"
+EMBEDDING_CACHE_MEMORY_ENTRIES = int(os.getenv("PREPDATA_EMBEDDING_CACHE_MEMORY_ENTRIES") or 10000)
+JOURNAL_PATH = os.getenv("PREPDATA_JOURNAL_PATH") or "scripts/.cache/journal.sqlite3"
+EMBED_BATCH_MAX_TOKENS = int(os.getenv("PREPDATA_EMBED_BATCH_MAX_TOKENS") or 64000)
+EMBED_BATCH_MAX_SIZE = int(os.getenv("PREPDATA_EMBED_BATCH_MAX_SIZE") or 256)
+EMBED_BATCH_MAX_WAIT = float(os.getenv("PREPDATA_EMBED_BATCH_MAX_WAIT") or 0.1)
+HTTP_CONNECTION_LIMIT = int(os.getenv("PREPDATA_HTTP_CONNECTION_LIMIT") or 100)
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("PREPDATA_HTTP_KEEPALIVE_TIMEOUT") or 30)
+HTTP_DNS_CACHE_TTL = int(os.getenv("PREPDATA_HTTP_DNS_CACHE_TTL") or 300)
+VISION_REQUESTS_PER_MINUTE = int(os.getenv("PREPDATA_VISION_RPM") or 480)
+VISION_TOKENS_PER_MINUTE = int(os.getenv("PREPDATA_VISION_TPM") or 80000)
+VISION_CONCURRENCY = int(os.getenv("PREPDATA_VISION_CONCURRENCY") or 16)
+OPENAI_DEPLOYMENTS_FILE = os.getenv("PREPDATA_OPENAI_DEPLOYMENTS_FILE")
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("PREPDATA_CIRCUIT_FAILURES") or 5)
+CIRCUIT_COOLDOWN = float(os.getenv("PREPDATA_CIRCUIT_COOLDOWN") or 30)
+VISION_IMAGES_PER_REQUEST = int(os.getenv("PREPDATA_VISION_IMAGES_PER_REQUEST") or 4)
+VISION_BATCH_MAX_WAIT = float(os.getenv("PREPDATA_VISION_BATCH_MAX_WAIT") or 0.5)
+VISION_BATCH_MAX_BYTES = int(float(os.getenv("PREPDATA_VISION_BATCH_MAX_MB") or 15) * 1024 * 1024)
+VISION_BATCH_MAX_TOKENS = int(os.getenv("PREPDATA_VISION_BATCH_MAX_TOKENS") or 4096)
+EMBED_REQUESTS_PER_MINUTE = int(os.getenv("PREPDATA_EMBED_RPM") or 720)
+EMBED_TOKENS_PER_MINUTE = int(os.getenv("PREPDATA_EMBED_TPM") or 120000)
+EMBED_CONCURRENCY = int(os.getenv("PREPDATA_EMBED_CONCURRENCY") or 8)
+SEED_CONCURRENCY = int(os.getenv("PREPDATA_SEED_CONCURRENCY") or 16)
+SQL_INSERT_BATCH_SIZE = int(os.getenv("PREPDATA_SQL_INSERT_BATCH_SIZE") or 1000)
+SQL_INSERT_FLUSH_INTERVAL = float(os.getenv("PREPDATA_SQL_INSERT_FLUSH_INTERVAL") or 1)
+SQL_UPDATE_BATCH_SIZE = int(os.getenv("PREPDATA_SQL_UPDATE_BATCH_SIZE") or 500)
+SQL_UPDATE_FLUSH_INTERVAL = float(os.getenv("PREPDATA_SQL_UPDATE_FLUSH_INTERVAL") or 5)
+SEARCH_BATCH_SIZE = int(os.getenv("PREPDATA_SEARCH_BATCH_SIZE") or 1000)
+SEARCH_BATCH_MAX_BYTES = int(float(os.getenv("PREPDATA_SEARCH_BATCH_MAX_MB") or 12) * 1024 * 1024)
+SEARCH_UPLOAD_CONCURRENCY = int(os.getenv("PREPDATA_SEARCH_UPLOAD_CONCURRENCY") or 4)
+SEARCH_UPLOAD_MAX_RETRIES = int(os.getenv("PREPDATA_SEARCH_UPLOAD_MAX_RETRIES") or 5)
+DOWNLOAD_CONCURRENCY = int(os.getenv("PREPDATA_DOWNLOAD_CONCURRENCY") or 8)
+DOWNLOAD_WINDOW = int(os.getenv("PREPDATA_DOWNLOAD_WINDOW") or 16)
+CASE_CONCURRENCY = int(os.getenv("PREPDATA_CASE_CONCURRENCY") or 32)
+EMBED_WORKERS = int(os.getenv("PREPDATA_EMBED_WORKERS") or 256)
+PIPELINE_QUEUE_SIZE = int(os.getenv("PREPDATA_PIPELINE_QUEUE_SIZE") or 64)
+IMAGE_MAX_EDGE = int(os.getenv("PREPDATA_IMAGE_MAX_EDGE") or 1024)
+IMAGE_QUALITY = int(os.getenv("PREPDATA_IMAGE_QUALITY") or 85)
+IMAGE_WORKERS = int(os.getenv("PREPDATA_IMAGE_WORKERS") or os.cpu_count() or 1)
+# Quantization methods to report on for the export at the end of a run, such as "int8,pq" or "all"
+QUANTIZATION_REPORT = os.getenv("PREPDATA_QUANTIZATION_REPORT")
+DUPLICATE_MAX_DISTANCE = int(os.getenv("PREPDATA_DUPLICATE_MAX_DISTANCE") or 6)
+BATCH_FOLDER = os.getenv("PREPDATA_BATCH_FOLDER") or "scripts/.cache/batch"
+BATCH_MAX_REQUESTS = int(os.getenv("PREPDATA_BATCH_MAX_REQUESTS") or 50000)
+BATCH_MAX_BYTES = int(float(os.getenv("PREPDATA_BATCH_MAX_MB") or 190) * 1024 * 1024)
+BATCH_POLL_INTERVAL = float(os.getenv("PREPDATA_BATCH_POLL_INTERVAL") or 60)
+BATCH_CONCURRENCY = int(os.getenv("PREPDATA_BATCH_CONCURRENCY") or 4)
+# Share of the Azure OpenAI quotas this process may use, set for each worker of a sharded run
+QUOTA_SHARE = float(os.getenv("PREPDATA_QUOTA_SHARE") or 1)
+SHARD_STATUS_PATH = os.getenv("PREPDATA_SHARD_STATUS_PATH") or "scripts/.cache/status.json"
+SHARD_STATUS_INTERVAL = float(os.getenv("PREPDATA_SHARD_STATUS_INTERVAL") or 10)
+METRICS_FILE = os.getenv("PREPDATA_METRICS_FILE")
+APPLICATIONINSIGHTS_CONNECTION_STRING = os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING")
+VISION_MAX_TOKENS = 2000
+EXPORT_PATH = "scripts/indexdata"
+
+# The fields of a structured response, as described to the model
+ASSESSMENT_FIELDS_PROMPT = (
+    "description, a short description of the image; repair, the repair that is needed; "
+    f"tradesman, the tradesman needed to complete the job, one of {', '.join(TRADES)}; "
+    "mould_detected, true if mould is present in the image and false otherwise; "
+    f"mould_severity, one of {', '.join(MOULD_SEVERITIES)}, which is none when no mould is present. "
+)
+ASSESSMENT_GUIDANCE_PROMPT = (
+    "Do not format the text with any special characters. Remember to provide accurate and concise answers based on the information present "
+    "in the image and use external knowledge of building maintenance. Your response should not provide a request for more info as this info "
+    "will be injected into an AI Search index field."
+)
+
+# System prompt for GPT-4 Vision, also part of the description cache key
+VISION_SYSTEM_PROMPT = (
+    "As an AI assistant for a housing association, your primary task is to assess a photo of a maintenance problem. "
+    "A key focus is the identification of mould, which should be rated according to severity. "
+    "Respond with a JSON object with these fields: " + ASSESSMENT_FIELDS_PROMPT + ASSESSMENT_GUIDANCE_PROMPT
+)
+
+# System prompt for a request carrying several photos, each introduced by its case ID
+BATCH_SYSTEM_PROMPT = (
+    "As an AI assistant for a housing association, your primary task is to assess photos of maintenance problems. "
+    "A key focus is the identification of mould, which should be rated according to severity. "
+    "Each photo follows a line giving its case ID, and each photo is assessed on its own. "
+    "Respond with a JSON object with one field, assessments, a list with one object for each photo in the order given. "
+    "Each object has case_id, the case ID given before the photo, and these fields: " + ASSESSMENT_FIELDS_PROMPT + ASSESSMENT_GUIDANCE_PROMPT
+)
 
 # Setup logging
 logger = logging.getLogger()
@@ -67,6 +181,63 @@ credential = DefaultAzureCredential()
 blob_service_client = BlobServiceClient.from_connection_string(BLOB_CONNECTION_STRING)
 container_client = blob_service_client.get_container_client(STORAGE_CONTAINER)
 
+# Description and embedding caches, opened in main() unless bypassed with --no-cache
+description_cache = None
+embedding_cache = None
+
+# Process pool for image preprocessing, started in main() unless disabled with --no-preprocess
+image_executor = None
+image_stats = {"images": 0, "bytes_saved": 0, "tokens_saved": 0}
+
+# Perceptual hashes of the images seeded so far, created in main() unless disabled with --no-dedupe
+duplicate_index = None
+
+# Per-case stage journal for resuming an interrupted run, opened in main()
+journal = None
+
+# (index, count) of a worker of a sharded run, set in main() from --shard. A worker only processes the
+# new images whose file name falls in its shard and the existing cases whose CaseID does.
+shard = None
+
+
+# Whether a file name or CaseID belongs to this process, which is every one outside a sharded run
+def in_shard(key):
+    return shard is None or shard_of(key, shard[1]) == shard[0]
+
+
+# The Azure OpenAI deployments of one kind from PREPDATA_OPENAI_DEPLOYMENTS_FILE, or else the single
+# deployment configured by the AZURE_OAI_* settings. The budgets given are the defaults for each deployment,
+# and each is cut to this process's PREPDATA_QUOTA_SHARE. Deployments in the file that do not name their model
+# are taken to serve the model of the configured deployment.
+def openai_deployments(kind, deployment_name, requests_per_minute, tokens_per_minute, concurrency):
+    if OPENAI_DEPLOYMENTS_FILE:
+        deployments = load_deployments(OPENAI_DEPLOYMENTS_FILE, kind, OAI_API_KEY, requests_per_minute, tokens_per_minute, concurrency,
+                                       CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_COOLDOWN, QUOTA_SHARE, deployment_name)
+        models = {deployment.model for deployment in deployments}
+        if len(models) > 1:
+            # Vectors from different models cannot be compared, and cached results would be mixed up
+            raise SystemExit(f"The {kind} deployments in {OPENAI_DEPLOYMENTS_FILE} serve different models: {', '.join(sorted(models))}.")
+        if deployments:
+            return deployments
+    return [Deployment(kind.capitalize(), OAI_API_ENDPOINT or "", OAI_API_KEY, deployment_name, requests_per_minute * QUOTA_SHARE, tokens_per_minute * QUOTA_SHARE,
+                       concurrency, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_COOLDOWN)]
+
+
+# Pools of the Azure OpenAI deployments, each deployment with its own request and token budgets
+vision_pool = DeploymentPool("Vision", openai_deployments("vision", OAI_GPTVISION_DEPLOYMENT_NAME, VISION_REQUESTS_PER_MINUTE, VISION_TOKENS_PER_MINUTE, VISION_CONCURRENCY))
+embedding_pool = DeploymentPool("Embedding", openai_deployments("embedding", OAI_EMBED_DEPLOYMENT_NAME, EMBED_REQUESTS_PER_MINUTE, EMBED_TOKENS_PER_MINUTE, EMBED_CONCURRENCY))
+
+# Latency, counts, bytes and tokens for the calls each stage makes, reported at the end of the run
+metrics = RunMetrics()
+
+# Shared HTTP clients, created once per run by init_clients(). Each embedding deployment gets an Azure
+# OpenAI client on the shared httpx client.
+openai_http_client = None
+http_session = None
+# Azure OpenAI clients for the Batch API, which needs a later API version, created for --batch runs
+vision_batch_client = None
+embedding_batch_client = None
+
 # Create a connection pool
 async def create_pool():
     try:
@@ -87,8 +258,8 @@ def generate_random_job_assigned():
     return random.choice(["yes", "no"])
 
 
-# Create the Azure SQL table
-async def create_sql_table(pool):
+# Create the Azure SQL table. In incremental mode an existing table is kept and only gains any missing columns.
+async def create_sql_table(pool, incremental=False):
     logger.info("Starting to create the Azure SQL table 'MaintenanceRequests'.")
     async with pool.acquire() as conn:
         async with conn.cursor() as cursor:
@@ -102,6 +273,27 @@ async def create_sql_table(pool):
                 """)
                 table_exists = await cursor.fetchone()
                 
+                if table_exists[0] == 1 and incremental:
+                    # Tables from earlier versions of this script lack the change tracking columns
+                    await cursor.execute("""
+                    IF COL_LENGTH('dbo.MaintenanceRequests', 'ImageHash') IS NULL
+                        ALTER TABLE dbo.MaintenanceRequests ADD ImageHash NVARCHAR(64) NULL;
+                    IF COL_LENGTH('dbo.MaintenanceRequests', 'DescribedHash') IS NULL
+                        ALTER TABLE dbo.MaintenanceRequests ADD DescribedHash NVARCHAR(64) NULL;
+                    IF COL_LENGTH('dbo.MaintenanceRequests', 'RowVer') IS NULL
+                        ALTER TABLE dbo.MaintenanceRequests ADD RowVer ROWVERSION;
+                    IF COL_LENGTH('dbo.MaintenanceRequests', 'PerceptualHash') IS NULL
+                        ALTER TABLE dbo.MaintenanceRequests ADD PerceptualHash NVARCHAR(32) NULL;
+                    IF COL_LENGTH('dbo.MaintenanceRequests', 'DuplicateOf') IS NULL
+                        ALTER TABLE dbo.MaintenanceRequests ADD DuplicateOf NVARCHAR(50) NULL;
+                    IF COL_LENGTH('dbo.MaintenanceRequests', 'Repair') IS NULL
+                        ALTER TABLE dbo.MaintenanceRequests ADD Repair NVARCHAR(MAX) NULL, Tradesman NVARCHAR(50) NULL, MouldSeverity NVARCHAR(10) NULL;
+                    """)
+                    await create_state_table(cursor)
+                    await conn.commit()
+                    logger.info("Keeping existing table 'MaintenanceRequests' for an incremental run.")
+                    return
+
                 if table_exists[0] == 1:
                     # Drop the table if it exists
                     await cursor.execute("DROP TABLE dbo.MaintenanceRequests")
@@ -117,15 +309,63 @@ async def create_sql_table(pool):
                     MouldDetected BIT,
                     FileName NVARCHAR(2083),
                     DateOpened Datetime2,
-                    JobAssigned NVARCHAR(3)
+                    JobAssigned NVARCHAR(3),
+                    ImageHash NVARCHAR(64),
+                    DescribedHash NVARCHAR(64),
+                    PerceptualHash NVARCHAR(32),
+                    DuplicateOf NVARCHAR(50),
+                    Repair NVARCHAR(MAX),
+                    Tradesman NVARCHAR(50),
+                    MouldSeverity NVARCHAR(10),
+                    RowVer ROWVERSION
                 )
                 """)
+
+                # A fresh table invalidates any watermark left by an earlier incremental run
+                await create_state_table(cursor)
+                await cursor.execute("DELETE FROM dbo.PrepdataState WHERE Name = 'MaintenanceRequests'")
                 await conn.commit()
                 logger.info("Azure SQL table 'MaintenanceRequests' created successfully.")
             except aioodbc.Error as e:
                 logger.error(f"Error occurred while creating the SQL table: {e}")
 
 
+# Create the table holding the rowversion watermark of the last complete incremental run
+async def create_state_table(cursor):
+    await cursor.execute("""
+    IF OBJECT_ID('dbo.PrepdataState', 'U') IS NULL
+    CREATE TABLE dbo.PrepdataState (
+        Name NVARCHAR(50) PRIMARY KEY,
+        RowVersion BINARY(8) NOT NULL
+    )
+    """)
+
+
+# Read the watermark of the last complete run, None when every row should be processed
+async def read_watermark(pool):
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("SELECT RowVersion FROM dbo.PrepdataState WHERE Name = 'MaintenanceRequests'")
+            row = await cursor.fetchone()
+            return row[0] if row else None
+
+
+# Record the current database rowversion as the watermark. This runs after our own description updates
+# so they are not picked up as changes next time.
+async def save_watermark(pool):
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("""
+            MERGE dbo.PrepdataState AS s
+            USING (SELECT 'MaintenanceRequests' AS Name, CAST(@@DBTS AS BINARY(8)) AS RowVersion) AS w
+            ON s.Name = w.Name
+            WHEN MATCHED THEN UPDATE SET RowVersion = w.RowVersion
+            WHEN NOT MATCHED THEN INSERT (Name, RowVersion) VALUES (w.Name, w.RowVersion);
+            """)
+            await conn.commit()
+    logger.info("Saved the incremental processing watermark.")
+
+
 # Create the container if it does not exist
 async def create_container_if_not_exists(container_client):
     try:
@@ -138,123 +378,454 @@ async def create_container_if_not_exists(container_client):
         logger.error(f"An error occurred while checking/creating the container: {e}")
 
 
-# Upload an image to Azure Blob Storage
-async def upload_image_to_blob(image_path, filename):
+# Upload an image to Azure Blob Storage, unless a blob with the same content is already there
+async def upload_image_to_blob(file_data, filename):
     try:
-        async with container_client:
-            # Create a BlobClient for the specific file
-            blob_client = container_client.get_blob_client(filename)
+        # Create a BlobClient for the specific file, reusing the shared container client's connections
+        blob_client = container_client.get_blob_client(filename)
 
-            try:
-                # Check if the blob exists
-                await blob_client.get_blob_properties()
+        try:
+            # Check if the blob exists and still matches the local file
+            properties = await blob_client.get_blob_properties()
+            if properties.content_settings.content_md5 == hashlib.md5(file_data).digest():
                 logger.info(f"Image {filename} already exists in blob storage.")
                 return blob_client.url
-            except Exception as e:
-                if "BlobNotFound" in str(e):
-                    logger.info(f"Blob {filename} not found, proceeding with upload.")
-                else:
-                    logger.error(f"An error occurred while checking if {filename} exists: {e}")
-                    return None
+            logger.info(f"Image {filename} has changed, proceeding with upload.")
+        except Exception as e:
+            if "BlobNotFound" in str(e):
+                logger.info(f"Blob {filename} not found, proceeding with upload.")
+            else:
+                logger.error(f"An error occurred while checking if {filename} exists: {e}")
+                return None
 
-            # Blob does not exist, proceed with upload
-            async with aiofiles.open(image_path, "rb") as file:
-                file_data = await file.read()
-            
-            try:
+        try:
+            with metrics.timer("blob_upload"):
                 await blob_client.upload_blob(file_data, overwrite=True)
-                logger.info(f"Image {filename} uploaded successfully.")
-            except Exception as upload_error:
-                logger.error(f"An error occurred while uploading {filename} to blob storage: {upload_error}")
-                return None
-            
-            # Return the URL of the uploaded blob
-            return blob_client.url
+            metrics.count("blob_upload", "bytes_out", len(file_data))
+            logger.info(f"Image {filename} uploaded successfully.")
+        except Exception as upload_error:
+            logger.error(f"An error occurred while uploading {filename} to blob storage: {upload_error}")
+            return None
+        
+        # Return the URL of the uploaded blob
+        return blob_client.url
 
     except Exception as e:
         logger.error(f"An error occurred while processing {filename}: {e}")
         return None
 
 
-# Insert a record into the MaintenanceRequests table
-async def insert_into_sql_table(pool, customer_id, case_id, description, image_url, mould_detected, file_name, date_opened, job_assigned):
+# aioodbc does not expose fast_executemany, so set it on the underlying pyodbc cursor. _impl is private,
+# so a cursor without it falls back to a plain executemany.
+def enable_fast_executemany(cursor):
+    impl = getattr(cursor, "_impl", None)
+    if impl is not None:
+        impl.fast_executemany = True
+
+
+# Insert a batch of records into the MaintenanceRequests table with one round trip and one commit
+async def insert_into_sql_table_batch(pool, rows):
     async with pool.acquire() as conn:
         async with conn.cursor() as cursor:
             try:
-                await cursor.execute("""
-                INSERT INTO MaintenanceRequests (CustomerID, CaseID, Description, ImageURL, MouldDetected, FileName, DateOpened, JobAssigned)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """, (customer_id, case_id, description, image_url, mould_detected, file_name, date_opened, job_assigned))
-                await conn.commit()
-            except Exception as e:
-                logger.error(f"An error occurred: {e}")
-
-
-# Update a record in the MaintenanceRequests table
-async def update_maintenance_request(pool, case_id, description, mould_detected):
+                enable_fast_executemany(cursor)
+                with metrics.timer("sql_insert"):
+                    await cursor.executemany("""
+                    INSERT INTO MaintenanceRequests (CustomerID, CaseID, Description, ImageURL, MouldDetected, FileName, DateOpened, JobAssigned, ImageHash, PerceptualHash, DuplicateOf)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """, rows)
+                    await conn.commit()
+                metrics.count("sql_insert", "rows", len(rows))
+                logger.info(f"Inserted {len(rows)} rows into MaintenanceRequests.")
+                await record_stage([row[1] for row in rows], "uploaded")
+            except Exception:
+                await conn.rollback()
+                raise
+
+
+# Update a batch of records in the MaintenanceRequests table. The rows are bulk loaded into a temp table
+# and applied with one set-based UPDATE, so the batch costs one commit instead of one per case.
+async def update_maintenance_requests_batch(pool, rows):
+    # Keep the latest result for each case, the staging table is keyed on CaseID
+    rows = list({row[0]: row for row in rows}.values())
     async with pool.acquire() as conn:
         async with conn.cursor() as cursor:
             try:
-                await cursor.execute("""
-                UPDATE MaintenanceRequests
-                SET Description = ?, MouldDetected = ?
-                WHERE CaseID = ?
-                """, (description, mould_detected, case_id))
+                with metrics.timer("sql_update"):
+                    await cursor.execute("""
+                    IF OBJECT_ID('tempdb..#DescriptionUpdates') IS NOT NULL DROP TABLE #DescriptionUpdates;
+                    CREATE TABLE #DescriptionUpdates (
+                        CaseID NVARCHAR(50) PRIMARY KEY,
+                        Description NVARCHAR(MAX),
+                        MouldDetected BIT,
+                        DescribedHash NVARCHAR(64),
+                        Repair NVARCHAR(MAX),
+                        Tradesman NVARCHAR(50),
+                        MouldSeverity NVARCHAR(10)
+                    )
+                    """)
+                    enable_fast_executemany(cursor)
+                    await cursor.executemany("""
+                    INSERT INTO #DescriptionUpdates (CaseID, Description, MouldDetected, DescribedHash, Repair, Tradesman, MouldSeverity)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """, rows)
+                    await cursor.execute("""
+                    UPDATE m
+                    SET m.Description = u.Description, m.MouldDetected = u.MouldDetected, m.DescribedHash = u.DescribedHash,
+                        m.Repair = u.Repair, m.Tradesman = u.Tradesman, m.MouldSeverity = u.MouldSeverity
+                    FROM MaintenanceRequests AS m
+                    INNER JOIN #DescriptionUpdates AS u ON m.CaseID = u.CaseID;
+                    DROP TABLE #DescriptionUpdates;
+                    """)
+                    await conn.commit()
+                metrics.count("sql_update", "rows", len(rows))
+                logger.info(f"Updated {len(rows)} rows in MaintenanceRequests.")
+                await record_stage([row[0] for row in rows], "described")
+            except Exception:
+                await conn.rollback()
+                raise
+
+
+# Record in the journal that cases completed a stage
+async def record_stage(case_ids, stage):
+    if journal is not None:
+        await journal.record(case_ids, stage)
+
+
+# Load the images already in the table, which is only non-empty for an incremental or resumed run. Returns
+# their case, content hash and perceptual hash by file name, and the stored descriptions by CaseID.
+async def load_existing_cases(pool):
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("SELECT FileName, CaseID, ImageHash, PerceptualHash, DuplicateOf, Description FROM MaintenanceRequests")
+            rows = await cursor.fetchall()
+    existing = {file_name: (case_id, image_hash, perceptual_hash) for file_name, case_id, image_hash, perceptual_hash, _, _ in rows}
+    descriptions = {case_id: description for _, case_id, _, _, _, description in rows if description}
+
+    # Earlier originals are candidates for new images to duplicate. Duplicates are left out, so a
+    # link always points at a case with its own description.
+    if duplicate_index is not None:
+        for _, case_id, _, perceptual_hash, duplicate_of, _ in rows:
+            hashes = parse_hashes(perceptual_hash)
+            if hashes and not duplicate_of:
+                duplicate_index.add(hashes, case_id)
+    return existing, descriptions
+
+
+# Record the new content and perceptual hashes of images that changed since they were added
+async def update_image_hashes(pool, rows):
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            try:
+                await cursor.executemany("UPDATE MaintenanceRequests SET ImageHash = ?, PerceptualHash = ? WHERE FileName = ?", rows)
                 await conn.commit()
+                logger.info(f"Updated the image hash of {len(rows)} changed images.")
             except Exception as e:
-                logger.error(f"An error occurred while updating case {case_id}: {e}")
+                await conn.rollback()
+                logger.error(f"An error occurred while updating image hashes: {e}")
+
+# A pool's client for the Batch API. A batch job runs on a single resource, so the jobs go to the resource
+# of the pool's first deployment, which must also hold the Global Batch deployment.
+def batch_openai_client(pool):
+    deployment = pool.deployments[0]
+    return AsyncAzureOpenAI(api_key=deployment.api_key, api_version=BATCH_API_VERSION, azure_endpoint=deployment.endpoint)
+
+
+# Create the Azure OpenAI client and HTTP session shared by every request in the run
+async def init_clients(batch=False):
+    global openai_http_client, http_session, vision_batch_client, embedding_batch_client
+    openai_http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_CONNECTION_LIMIT,
+            max_keepalive_connections=HTTP_CONNECTION_LIMIT,
+            keepalive_expiry=HTTP_KEEPALIVE_TIMEOUT
+        )
+    )
+    for deployment in embedding_pool.deployments:
+        deployment.client = AsyncAzureOpenAI(
+            api_key=deployment.api_key,
+            api_version=EMBED_API_VERSION,
+            azure_endpoint=deployment.endpoint,
+            max_retries=0,  # Retries are scheduled by the deployment pool
+            http_client=openai_http_client
+        )
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_CONNECTION_LIMIT,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        use_dns_cache=True,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL
+    )
+    http_session = aiohttp.ClientSession(connector=connector)
+    logger.info(f"Shared HTTP clients created with a limit of {HTTP_CONNECTION_LIMIT} connections.")
+    if batch:
+        vision_batch_client = batch_openai_client(vision_pool)
+        embedding_batch_client = batch_openai_client(embedding_pool)
+
+
+# Close the shared clients, releasing their pooled connections
+async def close_clients():
+    global openai_http_client, http_session, vision_batch_client, embedding_batch_client
+    if http_session is not None:
+        await http_session.close()
+        http_session = None
+    if openai_http_client is not None:
+        # The embedding deployments' clients share this one, closing it closes them
+        await openai_http_client.aclose()
+        openai_http_client = None
+        for deployment in embedding_pool.deployments:
+            deployment.client = None
+    for client in (vision_batch_client, embedding_batch_client):
+        if client is not None:
+            await client.close()
+    vision_batch_client = embedding_batch_client = None
+
+
+# Rough token estimate for text, about four characters per token for English
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+# Generate vector representations for a batch of descriptions in a single embedding request
+async def generate_vectors(descriptions):
+    async def request_vectors(deployment):
+        try:
+            with metrics.timer("embedding"):
+                return await deployment.client.embeddings.create(
+                    input=descriptions,
+                    model=deployment.deployment
+                )
+        except APIStatusError as e:
+            if e.status_code == 429:
+                metrics.count("embedding", "throttled")
+            if e.status_code == 429 or e.status_code >= 500:
+                raise RetryableError(str(e), parse_retry_after(e.response.headers))
+            if e.status_code in DEPLOYMENT_ERROR_STATUSES:
+                raise DeploymentError(str(e))
+            raise
+        except (APIConnectionError, APITimeoutError) as e:
+            raise RetryableError(str(e))
 
+    try:
+        estimated_tokens = sum(estimate_tokens(description) for description in descriptions)
+        response = await embedding_pool.run(estimated_tokens, request_vectors, f"for {len(descriptions)} descriptions")
+        metrics.count("embedding", "inputs", len(descriptions))
+        if getattr(response, "usage", None) is not None:
+            metrics.count("embedding", "tokens", response.usage.prompt_tokens)
+        # Results carry the position of their input, so order by it rather than trusting the response order
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+    except Exception as e:
+        logger.error(f"An error occurred while generating vectors for a batch of {len(descriptions)} descriptions: {e}")
+        metrics.count("embedding", "failed", len(descriptions))
+        return [None] * len(descriptions)
+
+
+# Collects descriptions from concurrent cases into token-bounded batches, sends one embedding request
+# per batch and hands each vector back to the case that asked for it. Descriptions already in the
+# embedding cache, or identical to one already queued, are not sent again.
+class EmbeddingBatcher:
+    def __init__(self, max_batch_tokens=EMBED_BATCH_MAX_TOKENS, max_batch_size=EMBED_BATCH_MAX_SIZE, max_wait=EMBED_BATCH_MAX_WAIT):
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending = []
+        self.pending_tokens = 0
+        self.flush_handle = None
+        self.tasks = set()
+        self.in_flight = {}
+        self.deduplicated = 0
+
+    async def embed(self, case_id, description):
+        if not description:
+            return None
+
+        key = EmbeddingCache.make_key(description, embedding_pool.model)
+        if embedding_cache is not None:
+            vector = embedding_cache.get(key)
+            if vector is not None:
+                metrics.count("embedding", "cache_hits")
+                return vector
+        if key in self.in_flight:
+            # Share the request of an identical description instead of embedding it twice
+            self.deduplicated += 1
+            metrics.count("embedding", "deduplicated")
+            return await asyncio.shield(self.in_flight[key])
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.in_flight[key] = future
+        tokens = estimate_tokens(description)
+        if self.pending and self.pending_tokens + tokens > self.max_batch_tokens:
+            self.flush()
+
+        self.pending.append((case_id, description, key, future))
+        self.pending_tokens += tokens
+        if len(self.pending) >= self.max_batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            # Give other cases a moment to join the batch before sending it
+            self.flush_handle = loop.call_later(self.max_wait, self.flush)
+
+        return await future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.pending:
+            return
+
+        batch = self.pending
+        self.pending = []
+        self.pending_tokens = 0
+        task = asyncio.create_task(self.send(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send(self, batch):
+        vectors = {}
+        try:
+            results = await generate_vectors([description for _, description, _, _ in batch])
+            vectors = {key: vector for (_, _, key, _), vector in zip(batch, results)}
+            for case_id, _, key, _ in batch:
+                if vectors[key] is None:
+                    logger.error(f"No vector generated for case {case_id}")
+                elif embedding_cache is not None:
+                    embedding_cache.put(key, vectors[key])
+            logger.info(f"Generated vectors for a batch of {len(batch)} descriptions")
+        except Exception as e:
+            logger.error(f"An error occurred while handling the vectors of a batch of {len(batch)} descriptions: {e}")
+        finally:
+            # Every case waiting on the batch gets an answer, even when caching a vector failed
+            for _, _, key, future in batch:
+                self.in_flight.pop(key, None)
+                if not future.done():
+                    future.set_result(vectors.get(key))
+
+    async def close(self):
+        self.flush()
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+        if self.deduplicated:
+            logger.info(f"{self.deduplicated} descriptions shared the embedding of an identical description.")
+
+
+# Writes embedding requests to batch jobs for --batch runs and hands each vector back once its job has
+# completed. As in EmbeddingBatcher, cached descriptions and descriptions identical to one already
+# queued are not sent again.
+class BatchEmbedder:
+    def __init__(self, batch_jobs):
+        self.batch_jobs = batch_jobs
+        self.waiting = {}
+        self.deduplicated = 0
+
+    # on_vector is awaited with the vector, or None when it could not be generated
+    async def embed(self, case_id, description, on_vector):
+        key = EmbeddingCache.make_key(description, embedding_pool.model)
+        if embedding_cache is not None:
+            vector = embedding_cache.get(key)
+            if vector is not None:
+                metrics.count("embedding", "cache_hits")
+                await on_vector(vector)
+                return
+        if key in self.waiting:
+            self.deduplicated += 1
+            metrics.count("embedding", "deduplicated")
+            self.waiting[key].append(on_vector)
+            return
+        self.waiting[key] = [on_vector]
+
+        async def on_result(body):
+            vector = None
+            if body and body.get("data"):
+                vector = body["data"][0]["embedding"]
+                usage = body.get("usage") or {}
+                metrics.count("embedding", "inputs")
+                metrics.count("embedding", "tokens", usage.get("prompt_tokens", 0))
+            if vector is None:
+                logger.error(f"No vector generated for case {case_id}")
+            elif embedding_cache is not None:
+                embedding_cache.put(key, vector)
+            for callback in self.waiting.pop(key, []):
+                await callback(vector)
+
+        await self.batch_jobs.add(f"embedding-{case_id}", {"model": OAI_BATCH_EMBED_DEPLOYMENT_NAME, "input": description}, on_result)
+
+    async def close(self):
+        await self.batch_jobs.drain()
+        if self.deduplicated:
+            logger.info(f"{self.deduplicated} descriptions shared the embedding of an identical description.")
+
+
+# The response_format of a vision request, held to the schema when the deployment supports structured outputs
+def vision_response_format(name, schema):
+    if VISION_RESPONSE_FORMAT == "json_schema":
+        return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+    return {"type": "json_object"}
+
+
+# Send a chat completions request to a GPT-4 Vision deployment in the pool within its rate limits,
+# returning the content of the response or None when it failed
+async def request_vision(payload, estimated_tokens, bytes_out, label=""):
+    async def request_description(deployment):
+        headers = {
+            "Content-Type": "application/json",
+            "api-key": deployment.api_key,
+        }
+        try:
+            with metrics.timer("vision"):
+                metrics.count("vision", "bytes_out", bytes_out)
+                async with http_session.post(deployment.url("chat/completions", VISION_API_VERSION), headers=headers, json=payload) as response:
+                    if response.status == 429:
+                        metrics.count("vision", "throttled")
+                    if response.status == 429 or response.status >= 500:
+                        raise RetryableError(f"HTTP {response.status} {response.reason}", parse_retry_after(response.headers))
+                    if response.status in DEPLOYMENT_ERROR_STATUSES:
+                        raise DeploymentError(f"HTTP {response.status} {response.reason}")
+                    response.raise_for_status()
+                    return await response.json()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            raise RetryableError(f"{type(e).__name__}: {e}")
 
-# Create dummy database with images from the data folder
-async def create_dummy_database(pool, data_folder):
     try:
-        tasks = []
-        for entry in os.scandir(data_folder):
-            if entry.is_file() and entry.name.lower().endswith(('.png', '.jpg', '.jpeg')):
-                image_path = os.path.join(data_folder, entry.name)
-                tasks.append(asyncio.create_task(process_image(pool, image_path, entry.name)))
-        
-        await asyncio.gather(*tasks)
+        response_json = await vision_pool.run(estimated_tokens, request_description, label)
+        usage = response_json.get('usage') or {}
+        metrics.count("vision", "prompt_tokens", usage.get('prompt_tokens', 0))
+        metrics.count("vision", "completion_tokens", usage.get('completion_tokens', 0))
+
+        # Check if the response contains the expected data
+        if 'choices' in response_json and len(response_json['choices']) > 0:
+            return response_json['choices'][0]['message']['content']
+        else:
+            raise ValueError("The response does not contain the expected 'choices' data.")
+
+    except RetryableError as e:
+        logger.error(f"The description request was abandoned after retries: {e}")
+    except aiohttp.ClientError as e:
+        logger.error(f"An HTTP error occurred: {e}")
+    except ValueError as e:
+        logger.error(f"An error occurred while processing the response: {e}")
     except Exception as e:
-        logger.error(f"An error occurred while accessing the data folder {data_folder}: {e}")
+        logger.error(f"An unexpected error occurred: {e}")
 
-async def init_openai_client():
-    return AsyncAzureOpenAI(
-        api_key=OAI_API_KEY,
-        api_version="2024-02-01",
-        azure_endpoint=OAI_API_ENDPOINT
-    )
+    metrics.count("vision", "failed")
+    return None  # Return None if an error occurred or the description was not generated
 
 
-# Generate vector representation using Azure OpenAI embedding model
-async def generate_vector(description):
-    client = await init_openai_client()
-    try:
-        response = await client.embeddings.create(
-            input=description,
-            model=OAI_EMBED_DEPLOYMENT_NAME
-        )
-        vector = response.data[0].embedding
-        return vector
-    except Exception as e:
-        logger.error(f"An error occurred while generating the vector for the description: {e}")
-        return None
+# Azure counts the image tiles against the token budget, estimated from the image header
+def estimate_image_data_tokens(image_data):
+    return estimate_image_tokens_from_bytes(base64.b64decode(image_data[:87384]))
 
 
-# Generate a description using GPT-4 Vision
-async def generate_image_description(image_data):
-    headers = {
-        "Content-Type": "application/json",
-        "api-key": OAI_API_KEY,
-    }
-    payload = {
+# The chat completions request for one image, as sent directly or written to a batch job
+def image_description_payload(image_data):
+    return {
         "messages": [
             {
                 "role": "system",
                 "content": [
                     {
                         "type": "text",
-                        "text": "As an AI assistant for a housing association, your primary task is to provide a short description of the image, the repair thats needed, and the tradesman needed to complete the job. In addition, a key focus is the identification of mould which should be rated according to severity in all responses. Therefore, if mould is present in the image always add the words MOULD DETECTED. If no mould is present in the image always add the words MOULD NOT DETECTED. Your response should always follow the heading order and content of, Image Description, Repair needed, Tradesman Required, and finally Mould Status. Always in that order, no exceptions. Do not format with any special characters. Remember to provide accurate and concise answers based on the information present in the image and use external knowledge of building maintenance. Your response should not provide a request for more info as this info will be injected into an AI Search index field."
+                        "text": VISION_SYSTEM_PROMPT
                     }
                 ]
             },
@@ -276,74 +847,203 @@ async def generate_image_description(image_data):
         ],
         "temperature": 0.7,
         "top_p": 0.95,
-        "max_tokens": 2000
+        "max_tokens": VISION_MAX_TOKENS,
+        "response_format": vision_response_format("maintenance_assessment", ASSESSMENT_SCHEMA),
     }
-    
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(OAI_GPT4V_API_ENDPOINT, headers=headers, json=payload) as response:
-                response.raise_for_status()
-                response_json = await response.json()
-                
-                # Check if the response contains the expected data
-                if 'choices' in response_json and len(response_json['choices']) > 0:
-                    description = response_json['choices'][0]['message']['content']
-                    return description
-                else:
-                    raise ValueError("The response does not contain the expected 'choices' data.")
-                    
-        except aiohttp.ClientError as e:
-            logger.error(f"An HTTP error occurred: {e}")
-        except ValueError as e:
-            logger.error(f"An error occurred while processing the response: {e}")
-        except Exception as e:
-            logger.error(f"An unexpected error occurred: {e}")
-    
-    return None  # Return None if an error occurred or the description was not generated
 
 
-# Function to detect mould status from description
-def detect_mould_status(description):
-    try:
-        description_upper = description.upper()  # Convert description to uppercase for case-insensitive matching
-        if "MOULD DETECTED" in description_upper:
-            return True
-        elif "MOULD NOT DETECTED" in description_upper:
-            return False
-        else:
-            # Default to False if the specific phrases are not found
-            return False
-    except Exception as e:
-        logger.error(f"An error occurred while detecting mould status: {e}")
-        return False
+# Generate a description using GPT-4 Vision
+async def generate_image_description(image_data):
+    payload = image_description_payload(image_data)
+    # Azure counts max_tokens against the token budget, along with the prompt and the image tiles
+    estimated_tokens = estimate_tokens(VISION_SYSTEM_PROMPT) + estimate_image_data_tokens(image_data) + VISION_MAX_TOKENS
+    return await request_vision(payload, estimated_tokens, len(image_data))
+
 
+# Generate descriptions for several images in one GPT-4 Vision request, each image introduced by its
+# case ID. Returns the content of the response, split into the response for each case by split_assessments.
+async def generate_batch_descriptions(images):
+    content = [{"type": "text", "text": "Do as your system message instructs for each of the provided images."}]
+    for case_id, image_data in images:
+        content.append({"type": "text", "text": f"Case ID: {case_id}"})
+        content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}})
 
-# Process image for uploading to Azure Blob Storage and inserting into SQL table
-async def process_image(pool, image_path, filename):
+    max_tokens = min(VISION_MAX_TOKENS * len(images), VISION_BATCH_MAX_TOKENS)
+    payload = {
+        "messages": [
+            {"role": "system", "content": [{"type": "text", "text": BATCH_SYSTEM_PROMPT}]},
+            {"role": "user", "content": content},
+        ],
+        "temperature": 0.7,
+        "top_p": 0.95,
+        "max_tokens": max_tokens,
+        "response_format": vision_response_format("maintenance_assessments", BATCH_ASSESSMENT_SCHEMA),
+    }
+
+    # The system prompt and max_tokens are counted once for the request rather than once per image
+    estimated_tokens = estimate_tokens(BATCH_SYSTEM_PROMPT) + sum(estimate_image_data_tokens(image_data) for _, image_data in images) + max_tokens
+    return await request_vision(payload, estimated_tokens, sum(len(image_data) for _, image_data in images), f"for {len(images)} images")
+
+
+# Collects the images of concurrent cases into vision requests of up to VISION_IMAGES_PER_REQUEST images,
+# so the long system prompt is sent and billed once per request rather than once per image. Each case gets
+# the assessment given with its case ID, and a case without a valid one is described in a request of its own.
+class VisionBatcher:
+    def __init__(self, max_images=VISION_IMAGES_PER_REQUEST, max_bytes=VISION_BATCH_MAX_BYTES, max_wait=VISION_BATCH_MAX_WAIT):
+        self.max_images = max_images
+        self.max_bytes = max_bytes
+        self.max_wait = max_wait
+        self.pending = []
+        self.pending_bytes = 0
+        self.flush_handle = None
+        self.tasks = set()
+        self.requests = 0
+        self.fallbacks = 0
+
+    async def describe(self, case_id, image_data):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if self.pending and self.pending_bytes + len(image_data) > self.max_bytes:
+            self.flush()
+
+        self.pending.append((case_id, image_data, future))
+        self.pending_bytes += len(image_data)
+        if len(self.pending) >= self.max_images:
+            self.flush()
+        elif self.flush_handle is None:
+            # Give other cases a moment to join the request before sending it
+            self.flush_handle = loop.call_later(self.max_wait, self.flush)
+
+        return await future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.pending:
+            return
+
+        batch = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+        task = asyncio.create_task(self.send(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send(self, batch):
+        descriptions = {}
+        try:
+            if len(batch) == 1:
+                case_id, image_data, _ = batch[0]
+                descriptions[case_id] = await generate_image_description(image_data)
+                return
+
+            self.requests += 1
+            metrics.count("vision", "batched_images", len(batch))
+            content = await generate_batch_descriptions([(case_id, image_data) for case_id, image_data, _ in batch])
+            if content:
+                descriptions = split_assessments(content, [case_id for case_id, _, _ in batch])
+            missing = [(case_id, image_data) for case_id, image_data, _ in batch if case_id not in descriptions]
+            if missing:
+                logger.warning(f"{len(missing)} of {len(batch)} images had no valid assessment in the batched response, describing them separately")
+                self.fallbacks += len(missing)
+                metrics.count("vision", "batch_fallbacks", len(missing))
+                results = await asyncio.gather(*(generate_image_description(image_data) for _, image_data in missing))
+                descriptions.update((case_id, description) for (case_id, _), description in zip(missing, results))
+        except Exception as e:
+            logger.error(f"An error occurred while describing a batch of {len(batch)} images: {e}")
+        finally:
+            for case_id, _, future in batch:
+                if not future.done():
+                    future.set_result(descriptions.get(case_id))
+
+    async def close(self):
+        self.flush()
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+        if self.requests:
+            logger.info(f"Sent {self.requests} batched vision requests, {self.fallbacks} images were described separately after them.")
+
+
+# Upload an image to Azure Blob Storage and create its case. Returns the new case, or None for an image
+# that is already in the table or could not be processed.
+async def process_image(image_path, filename, case_ids, existing, changed_images):
     try:
+        async with aiofiles.open(image_path, "rb") as file:
+            file_data = await file.read()
+        image_hash = hashlib.sha256(file_data).hexdigest()
+        perceptual_hash = await hash_image(file_data, filename)
+
         # Upload image to Azure Blob Storage and get the URL
-        image_url = await upload_image_to_blob(image_path, filename)
+        image_url = await upload_image_to_blob(file_data, filename)
+
+        # Images already in the table keep their case, and only a change of content is recorded
+        if filename in existing:
+            if existing[filename][1] != image_hash or (perceptual_hash and existing[filename][2] != perceptual_hash):
+                changed_images.append((image_hash, perceptual_hash or existing[filename][2], filename))
+            return None
 
         # Generate dummy data for CustomerID and CaseID
         customer_id = str(random.randint(1000, 9999))
+        # In a sharded run the CaseID is drawn from this shard's share, so later runs give the case to the same shard
         case_id = str(random.randint(100000, 999999))
+        while case_id in case_ids or not in_shard(case_id):
+            case_id = str(random.randint(100000, 999999))
+        case_ids.add(case_id)
         date_opened = generate_random_date_within_last_6_months()
         job_assigned = generate_random_job_assigned()
 
-        # Insert data into SQL table using the helper function
-        await insert_into_sql_table(pool, customer_id, case_id, "", image_url, False, filename, date_opened, job_assigned)
+        # Link a near duplicate of an earlier image to that image's case, so it can reuse its description
+        duplicate_of = None
+        if perceptual_hash:
+            hashes = parse_hashes(perceptual_hash)
+            duplicate_of = duplicate_index.find(hashes)
+            if duplicate_of:
+                logger.info(f"Image {filename} is a near duplicate of case {duplicate_of}")
+            else:
+                duplicate_index.add(hashes, case_id)
 
         logger.info(f"Processed {filename}")
+        return {
+            "CustomerID": customer_id,
+            "CaseID": case_id,
+            "Description": "",
+            "ImageURL": image_url,
+            "MouldDetected": False,
+            "FileName": filename,
+            "DateOpened": date_opened,
+            "JobAssigned": job_assigned,
+            "ImageHash": image_hash,
+            "PerceptualHash": perceptual_hash,
+            "DuplicateOf": duplicate_of,
+            "ImagePath": image_path,
+        }
     except Exception as e:
         logger.error(f"An error occurred while processing {filename}: {e}")
+        return None
+
+
+# Perceptual hash of an image for near duplicate detection, computed in the image process pool when there is one
+async def hash_image(file_data, filename):
+    if duplicate_index is None:
+        return None
+
+    loop = asyncio.get_running_loop()
+    try:
+        return format_hashes(await loop.run_in_executor(image_executor, perceptual_hashes, file_data))
+    except Exception as e:
+        logger.error(f"An error occurred while computing the perceptual hash of {filename}: {e}")
+        return None
 
 
 # Read blob data from Azure Blob Storage to avoid service to service authentication
 async def read_blob_data(container_client, blob_name):
     try:
         blob_client = container_client.get_blob_client(blob=blob_name)
-        blob_data = await blob_client.download_blob()
-        image_data = await blob_data.readall()
+        with metrics.timer("blob_read"):
+            blob_data = await blob_client.download_blob()
+            image_data = await blob_data.readall()
+        metrics.count("blob_read", "bytes_in", len(image_data))
 
         return image_data
 
@@ -355,68 +1055,456 @@ async def read_blob_data(container_client, blob_name):
         await blob_client.close()
 
 
-# Processes cases for indexing adding GenAI generated descriptions. Outputs a JSON file with the index data.    
-async def process_cases_for_indexing(pool, json_file_path):
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cursor:
-            try:
-                await cursor.execute("SELECT * FROM MaintenanceRequests")
-                rows = await cursor.fetchall()
-                data = []
-                tasks = []
-                for row in rows:
-                    customer_id, case_id, description, image_url, mould_detected, file_name, date_opened, job_assigned = row
-                    blob_name = image_url.split('/')[-1]
-                    image_data = await read_blob_data(container_client, blob_name)
-                    blob_base64 = base64.b64encode(image_data).decode('utf-8')
-                    tasks.append(asyncio.create_task(process_case(pool, blob_base64, case_id, customer_id, file_name, image_url, date_opened, job_assigned, data)))
-                
-                await asyncio.gather(*tasks)
-                
-                # Write data to JSON file
-                async with aiofiles.open(json_file_path, 'w') as json_file:
-                    await json_file.write(json.dumps(data, indent=4))
-                logger.info(f"JSON file {json_file_path} created successfully.")
-                return data
-            except Exception as e:
-                logger.error(f"An error occurred: {e}")
-                return None
+# Read a case's image from the data folder when it was added in this run, otherwise from blob storage
+async def read_case_image(case):
+    if case.get("ImagePath"):
+        try:
+            async with aiofiles.open(case["ImagePath"], "rb") as file:
+                return await file.read()
+        except OSError as e:
+            logger.error(f"An error occurred while reading {case['ImagePath']}, falling back to blob storage: {e}")
+    if not case.get("ImageURL"):
+        return None
+    return await read_blob_data(container_client, case["ImageURL"].split('/')[-1])
+
+
+# Columns of the cases selected from the table for processing
+CASE_COLUMNS = ("CustomerID", "CaseID", "Description", "ImageURL", "MouldDetected", "FileName", "DateOpened", "JobAssigned", "ImageHash", "DescribedHash", "DuplicateOf", "Repair", "Tradesman", "MouldSeverity", "OriginalDescription")
 
 
-async def process_case(pool, blob_base64, case_id, customer_id, file_name, image_url, date_opened, job_assigned, data):
+# Select the cases already in the table that need processing. Without a watermark that is every row, and
+# an incremental run only takes rows that are new or changed since the last complete run.
+async def select_cases_to_process(pool, incremental=False):
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            query = """
+            SELECT m.CustomerID, m.CaseID, m.Description, m.ImageURL, m.MouldDetected, m.FileName, m.DateOpened, m.JobAssigned, m.ImageHash, m.DescribedHash,
+                m.DuplicateOf, m.Repair, m.Tradesman, m.MouldSeverity, o.Description
+            FROM MaintenanceRequests AS m
+            LEFT JOIN MaintenanceRequests AS o ON o.CaseID = m.DuplicateOf
+            """
+            watermark = await read_watermark(pool) if incremental else None
+            if watermark is not None:
+                # New images have no description yet, changed images no longer match the one described,
+                # and any other edit to the row moves its rowversion past the watermark
+                await cursor.execute(query + """
+                WHERE m.DescribedHash IS NULL OR m.ImageHash IS NULL OR m.DescribedHash <> m.ImageHash OR m.RowVer > ?
+                """, (watermark,))
+            else:
+                await cursor.execute(query)
+            return [dict(zip(CASE_COLUMNS, row)) for row in await cursor.fetchall() if in_shard(row[1])]
+
+
+# DateOpened as it is read back from the datetime2 column, whether it came from the table or a new case
+def format_date_opened(value):
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None)
+    return value.isoformat()
+
+
+# The stored description still matches the image, so only the rest of the row needs reprocessing
+def has_current_description(case):
+    return bool(case.get("Description") and case.get("DescribedHash") and case["DescribedHash"] == case.get("ImageHash"))
+
+
+# Streams every case through upload, SQL insert, download, GPT-4 Vision, mould parsing, embedding and search
+# upload. Each stage is a worker pool fed by a bounded queue, so a case can be indexed while later images are
+# still uploading and the slowest service sets the pace. Processed cases are also written to an NDJSON export
+# with a .npy vector sidecar. Returns the number of cases in the export and the CaseIDs that failed.
+#
+# New images come from the data folder. Once they are all inserted, the cases already in the table that need
+# processing follow: with incremental, those that are new or changed since the last complete run. Near
+# duplicate images reuse the description of the case they duplicate, waiting for it when it is still in
+# flight. A resumed run appends to the export of the interrupted run and skips the cases already in it.
+async def run_pipeline(pool, data_folder, export_path, incremental=False, resume=False, batch=False):
     try:
-        # Generate the image description
-        description = await generate_image_description(blob_base64)
+        existing, stored_descriptions = await load_existing_cases(pool)
+        # CaseIDs already handed out, since one duplicate key would fail its whole insert batch
+        case_ids = {case_id for case_id, _, _ in existing.values()}
+        changed_images = []
+        # Cases added from the data folder in this run, and the outcome of each description made in this run
+        streamed = set()
+        described = {}
+        # Duplicates waiting for the description of the case they duplicate, by that case's CaseID
+        waiting = {}
+        failed_cases = []
+        duplicates_reused = 0
+        upload_buffer = []
+        upload_buffer_bytes = 0
+
+        exporter = CaseExporter(export_path, resume)
+        # A resumed run skips the stages the journal has each case through: images it uploaded are not read or
+        # uploaded again, and cases it described keep their stored description. The export is the record of
+        # which cases were embedded, so those are skipped altogether and the journal is brought in line with it.
+        journaled = {"uploaded": set(), "described": set()}
+        skipped = {"uploaded": 0, "described": 0, "exported": 0}
+        if resume:
+            journaled = {stage: journal.completed(stage) for stage in journaled}
+            await record_stage(exporter.case_ids, "embedded")
+            logger.info(f"Resuming: {len(journaled['uploaded'])} cases uploaded, {len(journaled['described'])} described and {len(exporter.case_ids)} exported.")
+        embedding_batcher = EmbeddingBatcher()
+        # In a --batch run descriptions and vectors come from Batch API jobs. A case leaves the describe and
+        # embed stages when its job completes, so the stages keep writing requests rather than waiting.
+        vision_jobs = batch_embedder = None
+        if batch:
+            vision_jobs = BatchJobs(vision_batch_client, "vision", "/chat/completions", BATCH_FOLDER, BATCH_MAX_REQUESTS, BATCH_MAX_BYTES, BATCH_POLL_INTERVAL, BATCH_CONCURRENCY, metrics, journal)
+            batch_embedder = BatchEmbedder(BatchJobs(embedding_batch_client, "embedding", "/embeddings", BATCH_FOLDER, BATCH_MAX_REQUESTS, BATCH_MAX_BYTES, BATCH_POLL_INTERVAL, BATCH_CONCURRENCY, metrics, journal))
+            if resume:
+                # Jobs the interrupted run submitted are waited for, and their cases are not submitted again
+                vision_jobs.reattach()
+                batch_embedder.batch_jobs.reattach()
+        vision_batcher = VisionBatcher() if VISION_IMAGES_PER_REQUEST > 1 and not batch else None
+        description_writer = BatchWriter("MaintenanceRequests updates", lambda rows: update_maintenance_requests_batch(pool, rows), SQL_UPDATE_BATCH_SIZE, SQL_UPDATE_FLUSH_INTERVAL)
+        description_writer.start()
+
+        # Cases are passed on once their insert has committed, so a later description update always finds its row
+        async def insert_and_forward(rows):
+            try:
+                await insert_into_sql_table_batch(pool, [(case["CustomerID"], case["CaseID"], "", case["ImageURL"], False, case["FileName"], case["DateOpened"], case["JobAssigned"], case["ImageHash"], case["PerceptualHash"], case["DuplicateOf"]) for case, _ in rows])
+            except Exception:
+                failed_cases.extend(case["CaseID"] for case, _ in rows)
+                raise
+            for case, emit in rows:
+                await emit(case)
+
+        sql_writer = BatchWriter("MaintenanceRequests inserts", insert_and_forward, SQL_INSERT_BATCH_SIZE, SQL_INSERT_FLUSH_INTERVAL)
+        sql_writer.start()
+
+        def original_description(case):
+            duplicate_of = case.get("DuplicateOf")
+            return described.get(duplicate_of) or stored_descriptions.get(duplicate_of) or case.get("OriginalDescription")
+
+        # A duplicate whose original is still in flight waits for it rather than being described separately
+        def original_in_flight(case):
+            return case["DuplicateOf"] in streamed and case["DuplicateOf"] not in described
+
+        async def upload(entry, emit):
+            if entry.name in existing and existing[entry.name][0] in journaled["uploaded"]:
+                skipped["uploaded"] += 1
+                return
+            case = await process_image(entry.path, entry.name, case_ids, existing, changed_images)
+            if case is not None:
+                streamed.add(case["CaseID"])
+                await emit(case)
+
+        async def close_upload(emit):
+            if changed_images:
+                await update_image_hashes(pool, changed_images)
+                # An image that changed needs a new description, whatever the journal says
+                journaled["described"].difference_update(existing[filename][0] for _, _, filename in changed_images)
+
+        async def insert(case, emit):
+            await sql_writer.add((case, emit))
+
+        async def close_insert(emit):
+            await sql_writer.close()
+            if not incremental:
+                # The table was created for this run, so every case in it came from the data folder
+                return
+            cases = [case for case in await select_cases_to_process(pool, incremental) if case["CaseID"] not in streamed]
+            skipped["exported"] = sum(1 for case in cases if case["CaseID"] in exporter.case_ids)
+            cases = [case for case in cases if case["CaseID"] not in exporter.case_ids]
+            logger.info(f"{len(cases)} cases already in the table need processing.")
+            for case in cases:
+                await emit(case)
+
+        # The stored description still applies, or the interrupted run described the case
+        def keeps_description(case):
+            return has_current_description(case) or (case["CaseID"] in journaled["described"] and bool(case.get("Description")))
+
+        # Downloads run ahead of the vision calls, into a queue bounded by the download window
+        async def download(case, emit):
+            if not keeps_description(case) and not (case.get("DuplicateOf") and (original_description(case) or original_in_flight(case))):
+                case["ImageData"] = await read_case_image(case)
+            await emit(case)
+
+        async def describe(case, emit):
+            if keeps_description(case):
+                if case["CaseID"] in journaled["described"]:
+                    skipped["described"] += 1
+                case["Stored"] = True
+                await emit(case)
+                return
+            if case.get("DuplicateOf"):
+                description = original_description(case)
+                if description:
+                    case["Description"] = description
+                    case["ReusedFrom"] = case["DuplicateOf"]
+                    await emit(case)
+                    return
+                if original_in_flight(case):
+                    waiting.setdefault(case["DuplicateOf"], []).append(case)
+                    return
+            await describe_case(case, emit)
+
+        async def describe_case(case, emit):
+            case_id = case["CaseID"]
+            image_data = case.pop("ImageData", None) or await read_case_image(case)
+            description = None
+            if image_data is not None:
+                case["ImageHash"] = hashlib.sha256(image_data).hexdigest()
+                if vision_jobs is not None:
+                    async def on_description(description):
+                        await finish_case(case, description, emit)
+                    await describe_image_in_batch(vision_jobs, image_data, case["ImageHash"], case_id, on_description)
+                    return
+                description, _ = await describe_image(image_data, case["ImageHash"], case_id, vision_batcher)
+            await finish_case(case, description, emit)
+
+        async def finish_case(case, description, emit):
+            case_id = case["CaseID"]
+            described[case_id] = description
+
+            if description:
+                case["Description"] = description
+                await emit(case)
+            else:
+                logger.error(f"No description was generated for case {case_id}")
+                failed_cases.append(case_id)
+
+            # Release the duplicates that were waiting for this case, describing them separately if it failed
+            for duplicate in waiting.pop(case_id, []):
+                if description:
+                    duplicate["Description"] = description
+                    duplicate["ReusedFrom"] = case_id
+                    await emit(duplicate)
+                else:
+                    await describe_case(duplicate, emit)
+
+        # Jobs still running release the duplicates waiting for their cases as they complete, and duplicates
+        # of a case that never reached this stage are described separately. In a --batch run those are new
+        # requests, so the jobs and the waiting duplicates are drained in turn until neither is left.
+        async def close_describe(emit):
+            while True:
+                if vision_jobs is not None:
+                    await vision_jobs.drain()
+                if not waiting:
+                    break
+                while waiting:
+                    _, duplicates = waiting.popitem()
+                    for duplicate in duplicates:
+                        await describe_case(duplicate, emit)
+            if vision_batcher is not None:
+                await vision_batcher.close()
+
+        # Parse each response into the description, repair, tradesman and mould fields
+        async def parse(case, emit):
+            nonlocal duplicates_reused
+            if not case.get("Stored") or case.get("Tradesman") is None:
+                assessment = parse_assessment(case["Description"])
+                del assessment["Structured"]
+                if case.get("Stored"):
+                    # Rows described before the structured fields existed keep their description and gain the fields
+                    case.update(Repair=assessment["Repair"], Tradesman=assessment["Tradesman"], MouldSeverity=assessment["MouldSeverity"])
+                else:
+                    case.update(assessment)
+                    if case.get("ReusedFrom"):
+                        logger.info(f"Reusing the description of case {case['ReusedFrom']} for near duplicate case {case['CaseID']}")
+                        duplicates_reused += 1
+                    logger.info(f"Mould detected for case {case['CaseID']}: {case['MouldDetected']}")
+                # Queue the new description and fields for the next batched database update
+                await description_writer.add((case["CaseID"], case["Description"], case["MouldDetected"], case["ImageHash"], case["Repair"], case["Tradesman"], case["MouldSeverity"]))
+            await emit(case)
+
+        async def close_parse(emit):
+            await description_writer.close()
+
+        async def embed(case, emit):
+            if batch_embedder is not None:
+                async def on_vector(vector):
+                    await finish_embedding(case, vector, emit)
+                await batch_embedder.embed(case["CaseID"], case["Description"], on_vector)
+                return
+            # Generate the vector representation of the description, batched with other cases
+            vector = await embedding_batcher.embed(case["CaseID"], case["Description"])
+            await finish_embedding(case, vector, emit)
+
+        async def finish_embedding(case, vector, emit):
+            case_id = case["CaseID"]
+            if vector is None:
+                failed_cases.append(case_id)
+                return
 
-        # Detect mould status from the description
-        mould_detected = detect_mould_status(description)
-        logger.info(f"Mould detected for case {case_id}: {mould_detected}")
+            document = {
+                "FileName": case["FileName"],
+                "CustomerID": case["CustomerID"],
+                "CaseID": case_id,
+                "Description": case["Description"],
+                "ImageURL": case["ImageURL"],
+                "MouldDetected": bool(case["MouldDetected"]),
+                "Vector": vector.tolist() if hasattr(vector, "tolist") else vector,
+                "DateOpened": format_date_opened(case["DateOpened"]),
+                "JobAssigned": case["JobAssigned"],
+                "DuplicateOf": case.get("DuplicateOf"),
+                "Repair": case.get("Repair"),
+                "Tradesman": case.get("Tradesman"),
+                "MouldSeverity": case.get("MouldSeverity")
+            }
+            exporter.write(document)
+            await record_stage([case_id], "embedded")
+            logger.info(f"Processed case {case_id} for indexing")
+            await emit(document)
+
+        async def close_embed(emit):
+            await embedding_batcher.close()
+            if batch_embedder is not None:
+                await batch_embedder.close()
+
+        async def upload_documents(batch):
+            failed_cases.extend(await upload_batch(search_client, batch))
+
+        # Documents are gathered into batches bounded by count and size, as in batch_documents
+        async def index(document, emit):
+            nonlocal upload_buffer, upload_buffer_bytes
+            document_bytes = len(json.dumps(document))
+            batch = None
+            if upload_buffer and (len(upload_buffer) >= SEARCH_BATCH_SIZE or upload_buffer_bytes + document_bytes > SEARCH_BATCH_MAX_BYTES):
+                batch = upload_buffer
+                upload_buffer = []
+                upload_buffer_bytes = 0
+            upload_buffer.append(document)
+            upload_buffer_bytes += document_bytes
+            if batch:
+                await upload_documents(batch)
+
+        async def close_index(emit):
+            if upload_buffer:
+                await upload_documents(upload_buffer)
+
+        images = (entry for entry in os.scandir(data_folder) if entry.is_file() and entry.name.lower().endswith(('.png', '.jpg', '.jpeg')) and in_shard(entry.name))
+        pipeline = Pipeline([
+            Stage("upload", upload, SEED_CONCURRENCY, PIPELINE_QUEUE_SIZE, close_upload),
+            Stage("insert", insert, 1, PIPELINE_QUEUE_SIZE, close_insert),
+            Stage("download", download, DOWNLOAD_CONCURRENCY, PIPELINE_QUEUE_SIZE),
+            Stage("describe", describe, CASE_CONCURRENCY, DOWNLOAD_WINDOW, close_describe),
+            Stage("parse", parse, 1, PIPELINE_QUEUE_SIZE, close_parse),
+            Stage("embed", embed, EMBED_WORKERS, PIPELINE_QUEUE_SIZE, close_embed),
+            Stage("index", index, SEARCH_UPLOAD_CONCURRENCY, PIPELINE_QUEUE_SIZE, close_index),
+        ], metrics)
+        async with SearchClient(endpoint=SEARCH_SERVICE_ENDPOINT,
+                                index_name=SEARCH_INDEX_NAME,
+                                credential=AzureKeyCredential(SEARCH_API_KEY)) as search_client:
+            await pipeline.run(images)
+        exporter.close()
+
+        # Report the cases that could not be processed rather than dropping them silently
+        if failed_cases:
+            logger.warning(f"{len(failed_cases)} cases failed and were not indexed: {', '.join(failed_cases)}")
+        if duplicates_reused:
+            logger.info(f"Reused descriptions for {duplicates_reused} near duplicate images instead of calling GPT-4 Vision.")
+        if resume:
+            logger.info(f"Resumed run skipped {skipped['uploaded']} uploaded images, {skipped['described']} described cases and {skipped['exported']} exported cases.")
+        if image_stats["images"]:
+            logger.info(f"Preprocessed {image_stats['images']} images, saving {image_stats['bytes_saved']} bytes and about {image_stats['tokens_saved']} image tokens.")
+        return exporter.rows, failed_cases
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        return None, []
 
-        # Update the database with the new description and mould status
-        await update_maintenance_request(pool, case_id, description, mould_detected)
 
-        # Generate the vector representation of the description
-        vector = await generate_vector(description)
+# Downscale and re-encode an image in the process pool before it is sent to GPT-4 Vision
+async def prepare_image(image_data, case_id):
+    if image_executor is None:
+        return image_data
 
-        # Append the processed data to the list
-        data.append({
-            "FileName": file_name,
-            "CustomerID": customer_id,
-            "CaseID": case_id,
-            "Description": description,
-            "ImageURL": image_url,
-            "MouldDetected": mould_detected,
-            "Vector": vector,
-            "DateOpened": date_opened.isoformat(),
-            "JobAssigned": job_assigned
-        })
-        logger.info(f"Processed case {case_id} for indexing")
+    loop = asyncio.get_running_loop()
+    try:
+        processed, original_size, new_size = await loop.run_in_executor(image_executor, preprocess_image, image_data, IMAGE_MAX_EDGE, IMAGE_QUALITY)
     except Exception as e:
-        logger.error(f"An error occurred while processing case {case_id}: {e}")
-
+        logger.error(f"An error occurred while preprocessing the image for case {case_id}, sending the original: {e}")
+        return image_data
 
-# Function to create the Azure AI search index
-def create_search_index():
+    bytes_saved = len(image_data) - len(processed)
+    tokens_saved = estimate_image_tokens(*original_size) - estimate_image_tokens(*new_size)
+    image_stats["images"] += 1
+    image_stats["bytes_saved"] += bytes_saved
+    image_stats["tokens_saved"] += tokens_saved
+    logger.info(f"Preprocessed image for case {case_id}: {original_size[0]}x{original_size[1]} to {new_size[0]}x{new_size[1]}, {bytes_saved} bytes and about {tokens_saved} image tokens saved")
+    return processed
+
+
+# Look up a cached description for the image. Returns the cache key, None when the cache is bypassed,
+# and the cached description and mould flag, or None on a miss. The key names the model rather than a
+# deployment, so every deployment in the pool and the Global Batch deployment of the same model share entries.
+def lookup_description(image_hash, case_id):
+    if description_cache is None:
+        return None, None
+    # Preprocessing settings change what the model sees, so they are part of the key
+    variant = f"{IMAGE_MAX_EDGE}:{IMAGE_QUALITY}" if image_executor is not None else "original"
+    variant = f"{variant}:{VISION_RESPONSE_FORMAT}"
+    cache_key = DescriptionCache.make_key(image_hash, vision_pool.model, VISION_SYSTEM_PROMPT, variant)
+    cached = description_cache.get(cache_key)
+    if cached is not None:
+        logger.info(f"Description cache hit for case {case_id}")
+        metrics.count("vision", "cache_hits")
+    return cache_key, cached
+
+
+# Check a new description and cache it with its mould flag
+def store_description(cache_key, description, case_id):
+    if not description:
+        return None, False
+
+    # The response is parsed into its fields in the parse stage, this is for the cache's mould flag
+    assessment = parse_assessment(description)
+    if not assessment["Structured"]:
+        logger.warning(f"The vision response for case {case_id} was not valid structured output, falling back to the text parser")
+        metrics.count("vision", "unstructured")
+
+    if cache_key is not None:
+        description_cache.put(cache_key, description, assessment["MouldDetected"])
+    return description, assessment["MouldDetected"]
+
+
+# Look up a cached description for the image, or generate one and cache it. A description from a batched
+# request is cached like any other, since it has the same fields for the same image.
+async def describe_image(image_data, image_hash, case_id, vision_batcher=None):
+    cache_key, cached = lookup_description(image_hash, case_id)
+    if cached is not None:
+        return cached
+
+    image_data = await prepare_image(image_data, case_id)
+    blob_base64 = base64.b64encode(image_data).decode('utf-8')
+
+    # Generate the image description, in a request shared with other cases when batching
+    if vision_batcher is not None:
+        description = await vision_batcher.describe(case_id, blob_base64)
+    else:
+        description = await generate_image_description(blob_base64)
+    return store_description(cache_key, description, case_id)
+
+
+# Look up a cached description for the image, or write its request to a batch job. on_description is
+# awaited with the description, which for a batch job is once the job has completed.
+async def describe_image_in_batch(batch_jobs, image_data, image_hash, case_id, on_description):
+    cache_key, cached = lookup_description(image_hash, case_id)
+    if cached is not None:
+        await on_description(cached[0])
+        return
+
+    async def on_result(body):
+        description = None
+        if body and body.get("choices"):
+            usage = body.get("usage") or {}
+            metrics.count("vision", "prompt_tokens", usage.get("prompt_tokens", 0))
+            metrics.count("vision", "completion_tokens", usage.get("completion_tokens", 0))
+            description = body["choices"][0]["message"]["content"]
+        description, _ = store_description(cache_key, description, case_id)
+        await on_description(description)
+
+    custom_id = f"vision-{case_id}"
+    if custom_id in batch_jobs.resumed:
+        # A job of the interrupted run already holds this request, so there is nothing to write
+        await batch_jobs.add(custom_id, None, on_result)
+        return
+    image_data = await prepare_image(image_data, case_id)
+    payload = image_description_payload(base64.b64encode(image_data).decode('utf-8'))
+    payload["model"] = OAI_BATCH_GPTVISION_DEPLOYMENT_NAME
+    await batch_jobs.add(custom_id, payload, on_result)
+
+
+# Function to create the Azure AI search index. An incremental run keeps an existing index and its documents.
+def create_search_index(incremental=False):
     try:
         index_client = SearchIndexClient(
             endpoint=SEARCH_SERVICE_ENDPOINT,
@@ -424,7 +1512,9 @@ def create_search_index():
         )
 
         # Check if the index already exists
-        if SEARCH_INDEX_NAME in index_client.list_index_names():
+        if SEARCH_INDEX_NAME in index_client.list_index_names() and incremental:
+            logger.info(f"Keeping existing search index {SEARCH_INDEX_NAME} for an incremental run")
+        elif SEARCH_INDEX_NAME in index_client.list_index_names():
             try:
                 # Delete the existing index
                 logger.info(f"Recreating search index {SEARCH_INDEX_NAME}")
@@ -479,6 +1569,25 @@ def create_search_index():
                 sortable=True,
                 facetable=True,
             ),
+            SimpleField(
+                name="DuplicateOf",
+                type=SearchFieldDataType.String,
+                filterable=True,
+                facetable=True,
+            ),
+            SimpleField(
+                name="Tradesman",
+                type=SearchFieldDataType.String,
+                filterable=True,
+                facetable=True,
+            ),
+            SimpleField(
+                name="MouldSeverity",
+                type=SearchFieldDataType.String,
+                filterable=True,
+                facetable=True,
+            ),
+            SearchableField(name="Repair", type=SearchFieldDataType.String),
             SearchableField(name="Description", type=SearchFieldDataType.String),
             SimpleField(name="ImageURL", type=SearchFieldDataType.String),
             SearchField(
@@ -490,6 +1599,8 @@ def create_search_index():
             ),
         ]
 
+        # Queries are vectorized with the first embedding deployment, which serves the same model as the rest
+        vectorizer_deployment = embedding_pool.deployments[0]
         vector_search = VectorSearch(
             algorithms=[
                 HnswAlgorithmConfiguration(
@@ -507,10 +1618,10 @@ def create_search_index():
                 AzureOpenAIVectorizer(
                     name="myVectorizer",
                     azure_open_ai_parameters=AzureOpenAIParameters(
-                        resource_uri=OAI_API_ENDPOINT,
-                        deployment_id=OAI_EMBED_DEPLOYMENT_NAME,
-                        model_name=OAI_EMBED_DEPLOYMENT_NAME,
-                        api_key=OAI_API_KEY
+                        resource_uri=vectorizer_deployment.endpoint,
+                        deployment_id=vectorizer_deployment.deployment,
+                        model_name=embedding_pool.model,
+                        api_key=vectorizer_deployment.api_key
                     )
                 )
             ]
@@ -546,43 +1657,304 @@ def create_search_index():
         logger.error(f"An error occurred while creating the search index: {e}")
 
 
-# Store data in Azure AI search index
-def store_in_search_index(data):
-    client = SearchClient(endpoint=SEARCH_SERVICE_ENDPOINT,
-                          index_name=SEARCH_INDEX_NAME,
-                          credential=AzureKeyCredential(SEARCH_API_KEY))
-    
-    try:
-        client.upload_documents(documents=data)
-        logger.info(f"Documents uploaded to search index {SEARCH_INDEX_NAME}.")
-    except Exception as e:
-        logger.error(f"Failed to upload documents to search index {SEARCH_INDEX_NAME}. Error: {e}")
+# Per-document status codes the search service documents as transient
+SEARCH_RETRYABLE_STATUS_CODES = {409, 422, 429, 503}
+
+
+# Split documents into batches bounded by document count and serialized size. The service rejects
+# requests over 1000 documents or 16 MB, and ada-002 vectors make each document around 30 KB of JSON.
+def batch_documents(documents, max_count=SEARCH_BATCH_SIZE, max_bytes=SEARCH_BATCH_MAX_BYTES):
+    batch = []
+    batch_bytes = 0
+    for document in documents:
+        document_bytes = len(json.dumps(document))
+        if batch and (len(batch) >= max_count or batch_bytes + document_bytes > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(document)
+        batch_bytes += document_bytes
+    if batch:
+        yield batch
+
+
+# Upload one batch, then retry only the documents whose individual results failed with a transient status.
+# Returns the keys that could not be indexed.
+async def upload_batch(client, documents):
+    pending = {document["CaseID"]: document for document in documents}
+    document_bytes = {key: len(json.dumps(document)) for key, document in pending.items()}
+    failed = []
+    for attempt in range(SEARCH_UPLOAD_MAX_RETRIES + 1):
+        if attempt:
+            metrics.count("search_upload", "retries")
+        # Counted on every attempt, since a retry sends its documents again
+        metrics.count("search_upload", "bytes_out", sum(document_bytes[key] for key in pending))
+        try:
+            with metrics.timer("search_upload"):
+                results = await client.upload_documents(documents=list(pending.values()))
+        except Exception as e:
+            logger.warning(f"Upload of {len(pending)} documents to search index {SEARCH_INDEX_NAME} failed: {e}")
+            results = None
+
+        if results is not None:
+            retry = {}
+            for result in results:
+                if result.succeeded:
+                    continue
+                if result.status_code in SEARCH_RETRYABLE_STATUS_CODES:
+                    retry[result.key] = pending[result.key]
+                else:
+                    logger.error(f"Document {result.key} was rejected by search index {SEARCH_INDEX_NAME}: {result.status_code} {result.error_message}")
+                    failed.append(result.key)
+            pending = retry
+            metrics.count("search_upload", "documents", sum(1 for result in results if result.succeeded))
+
+        if not pending:
+            metrics.count("search_upload", "failed", len(failed))
+            await record_stage([document["CaseID"] for document in documents if document["CaseID"] not in failed], "indexed")
+            return failed
+        if attempt < SEARCH_UPLOAD_MAX_RETRIES:
+            delay = min(30, 2 ** attempt)
+            await asyncio.sleep(delay / 2 + random.uniform(0, delay / 2))
+
+    logger.error(f"{len(pending)} documents could not be uploaded to search index {SEARCH_INDEX_NAME} after {SEARCH_UPLOAD_MAX_RETRIES} retries.")
+    failed += list(pending)
+    metrics.count("search_upload", "failed", len(failed))
+    await record_stage([document["CaseID"] for document in documents if document["CaseID"] not in failed], "indexed")
+    return failed
+
+
+# Store documents in Azure AI search index, uploading size-bounded batches concurrently. Documents are
+# read from the iterable as batches are needed, so only the batches in flight are held in memory.
+async def store_in_search_index(documents):
+    async with SearchClient(endpoint=SEARCH_SERVICE_ENDPOINT,
+                            index_name=SEARCH_INDEX_NAME,
+                            credential=AzureKeyCredential(SEARCH_API_KEY)) as client:
+        start = time.perf_counter()
+        total = 0
+        batches = 0
+        failed = []
+        in_flight = set()
+        for batch in batch_documents(documents):
+            if len(in_flight) >= SEARCH_UPLOAD_CONCURRENCY:
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                failed.extend(key for task in done for key in task.result())
+            in_flight.add(asyncio.create_task(upload_batch(client, batch)))
+            total += len(batch)
+            batches += 1
+        if in_flight:
+            failed.extend(key for keys in await asyncio.gather(*in_flight) for key in keys)
+
+        elapsed = time.perf_counter() - start
+        uploaded = total - len(failed)
+        logger.info(f"Uploaded {uploaded} documents to search index {SEARCH_INDEX_NAME} in {batches} batches, {uploaded / elapsed if elapsed else 0:.1f} docs/sec.")
+        if failed:
+            logger.error(f"Failed to upload {len(failed)} documents to search index {SEARCH_INDEX_NAME}: {', '.join(failed)}")
+        return not failed
+
+
+# Step 1 and 2 of a run: create the container if it does not exist, then the SQL table and the search index
+async def create_resources(pool, keep_existing):
+    await create_container_if_not_exists(container_client)
+    await create_sql_table(pool, keep_existing)
+    create_search_index(keep_existing)
+
+
+# Keep a shard worker's status file up to date for the coordinator
+async def report_shard_status(path):
+    while True:
+        write_status(path, {"shard": shard[0], "shards": shard[1], "stages": journal.counts(), "done": False})
+        await asyncio.sleep(SHARD_STATUS_INTERVAL)
+
+
+# Merge the exports of the shards of a run into scripts/indexdata, and move the watermark on once every
+# shard completed. Returns whether they all did.
+async def merge_shards(pool, count):
+    shards = [(index, count) for index in range(count)]
+    statuses = [read_status(shard_path(SHARD_STATUS_PATH, each)) for each in shards]
+    merge_exports([shard_path(EXPORT_PATH, each) for each in shards], EXPORT_PATH)
+    if QUANTIZATION_REPORT:
+        report_quantization(EXPORT_PATH)
+
+    incomplete = [f"{index}/{count}" for (index, _), status in zip(shards, statuses) if not (status and status.get("completed"))]
+    if incomplete:
+        logger.warning(f"Shards {', '.join(incomplete)} did not complete, so the watermark was not moved. Run again with --resume to finish them.")
+        return False
+    await save_watermark(pool)
+    logger.info(f"All {count} shards completed, {sum(status['exported'] for status in statuses)} cases exported.")
+    return True
+
 
+# Flags the coordinator of a sharded run passes on to its workers
+WORKER_FLAGS = {"no_cache": "--no-cache", "clear_cache": "--clear-cache", "incremental": "--incremental", "no_preprocess": "--no-preprocess",
+                "resume": "--resume", "no_dedupe": "--no-dedupe", "batch": "--batch"}
 
-async def main():
+
+# Coordinate a sharded run. With --shards the coordinator creates the container, table and index, runs a
+# worker process per shard on this machine, each with its share of the Azure OpenAI quotas and CPUs, and then
+# merges their exports. Across machines, --setup-only does the first part, each machine runs --shard I/N for
+# its shards, and --merge-shards N merges the exports once they are copied to one machine.
+async def coordinate(args):
     pool = await create_pool()
     try:
-        # Step 1: Create the container if it does not exist 
-        await create_container_if_not_exists(container_client)
-        
-        # Step 2: Create the SQL table and insert dummy data
-        await create_sql_table(pool)
-        data_folder = "data/"
-        await create_dummy_database(pool, data_folder)
+        if not args.merge_shards:
+            await create_resources(pool, args.incremental or args.resume)
+        if args.shards:
+            count = args.shards
+            command = [sys.executable, os.path.abspath(__file__)] + [flag for name, flag in WORKER_FLAGS.items() if getattr(args, name)]
+            env = dict(os.environ, PREPDATA_QUOTA_SHARE=str(QUOTA_SHARE / count))
+            env.setdefault("PREPDATA_IMAGE_WORKERS", str(max(1, IMAGE_WORKERS // count)))
+            await run_workers(command, count, env, SHARD_STATUS_PATH, SHARD_STATUS_INTERVAL)
+        if args.shards or args.merge_shards:
+            await merge_shards(pool, args.shards or args.merge_shards)
+    finally:
+        pool.close()
+        await pool.wait_closed()
+        await blob_service_client.close()
 
-        # Step 3: Create the search index
-        create_search_index()
 
-        # Step 4: Process images for indexing and create JSON file
-        json_file_path = "scripts/indexdata.json"
-        data = await process_cases_for_indexing(pool, json_file_path)
+# Report the memory the quantization methods would save on the run's export and their effect on recall
+def report_quantization(export_path):
+    methods = list(QUANTIZERS) if QUANTIZATION_REPORT == "all" else [method.strip() for method in QUANTIZATION_REPORT.split(",")]
+    unknown = [method for method in methods if method not in QUANTIZERS]
+    if unknown:
+        logger.error(f"Unknown quantization methods in PREPDATA_QUANTIZATION_REPORT: {', '.join(unknown)}.")
+        return
+    try:
+        report_export(export_path, methods)
+    except (OSError, ValueError) as e:
+        logger.error(f"An error occurred while reporting on the quantization of {export_path}: {e}")
+
+
+async def main(args):
+    global description_cache, embedding_cache, image_executor, duplicate_index, journal, shard
+    if args.shards or args.merge_shards or args.setup_only:
+        await coordinate(args)
+        return
+    shard = args.shard
+    if shard is not None:
+        # Workers share the coordinator's console, so each line says which shard it came from
+        console_handler.setFormatter(logging.Formatter(f'%(asctime)s - shard {shard[0]}/{shard[1]} - %(levelname)s - %(message)s'))
+
+    if APPLICATIONINSIGHTS_CONNECTION_STRING or os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT"):
+        metrics.enable_opentelemetry(APPLICATIONINSIGHTS_CONNECTION_STRING)
+    if not args.no_preprocess and IMAGE_MAX_EDGE > 0:
+        image_executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    if not args.no_dedupe and DUPLICATE_MAX_DISTANCE >= 0:
+        duplicate_index = DuplicateIndex(DUPLICATE_MAX_DISTANCE)
+    if not args.no_cache:
+        description_cache = DescriptionCache(shard_path(DESCRIPTION_CACHE_PATH, shard), DESCRIPTION_CACHE_MAX_ENTRIES, DESCRIPTION_CACHE_MAX_AGE_DAYS)
+        embedding_cache = EmbeddingCache(shard_path(EMBEDDING_CACHE_PATH, shard), EMBEDDING_CACHE_MEMORY_ENTRIES)
+        if args.clear_cache:
+            description_cache.clear()
+            embedding_cache.clear()
+
+    # A fresh run starts a fresh journal, a resumed run picks up the stages the interrupted run recorded
+    journal = StageJournal(shard_path(JOURNAL_PATH, shard))
+    if args.resume:
+        logger.info(f"Resuming from the stage journal: {journal.summary()}.")
+    else:
+        journal.clear()
+    journal.start()
+    # A resumed run keeps the table, index and export of the run it continues
+    keep_existing = args.incremental or args.resume
+    completed = False
+    exported, failed_cases = None, []
+    status_task = None
+    if shard is not None:
+        status_path = shard_path(SHARD_STATUS_PATH, shard)
+        status_task = asyncio.create_task(report_shard_status(status_path))
 
-        # Step 5: Store data in search index
-        store_in_search_index(data)
+    pool = await create_pool()
+    await init_clients(args.batch)
+    try:
+        # Steps 1 and 2: Create the container, SQL table and search index, which the coordinator has
+        # already done for a shard
+        if shard is None:
+            await create_resources(pool, keep_existing)
+
+        # Step 3: A resumed run first indexes the cases the interrupted run exported but did not index
+        export_path = shard_path(EXPORT_PATH, shard)
+        indexed = True
+        if args.resume and os.path.exists(f"{export_path}.ndjson"):
+            # Reopening the export recovers the cases that were completely written and fixes up its header
+            CaseExporter(export_path, resume=True).close()
+            already_indexed = journal.completed("indexed")
+            indexed = await store_in_search_index(document for document in iter_documents(export_path) if document["CaseID"] not in already_indexed)
+
+        # Step 4: Stream the images through upload, description, embedding and indexing
+        data_folder = "data/"
+        exported, failed_cases = await run_pipeline(pool, data_folder, export_path, keep_existing, args.resume, args.batch)
+        if exported is None:
+            return
+
+        # Only move the watermark on once every row made it into the index, so failures are retried next time.
+        # A shard leaves it to the coordinator, which moves it once every shard completed.
+        if indexed and not failed_cases:
+            if shard is None:
+                await save_watermark(pool)
+            completed = True
+
+        # A shard's export holds only part of the cases, so the coordinator reports on the merged export
+        if QUANTIZATION_REPORT and shard is None:
+            report_quantization(export_path)
     finally:
+        if status_task is not None:
+            status_task.cancel()
         pool.close()
         await pool.wait_closed()
         await blob_service_client.close()
+        await close_clients()
+        if image_executor is not None:
+            image_executor.shutdown()
+        if description_cache is not None:
+            description_cache.close()
+        if embedding_cache is not None:
+            embedding_cache.close()
+        if shard is not None:
+            await journal.flush()
+            write_status(status_path, {"shard": shard[0], "shards": shard[1], "stages": journal.counts(), "done": True,
+                                       "completed": completed, "exported": exported or 0, "failed": len(failed_cases)})
+        # A shard keeps its journal. --resume on the sharded run resumes every shard, and a cleared journal
+        # would have a completed shard index its whole export again.
+        await journal.close(clear=completed and shard is None)
+        report_metrics()
+
+
+# Log the run metrics, and write them out for Prometheus when PREPDATA_METRICS_FILE is set
+def report_metrics():
+    metrics.count("vision", "retries", vision_pool.retries)
+    metrics.count("embedding", "retries", embedding_pool.retries)
+    vision_pool.report()
+    embedding_pool.report()
+    metrics.report()
+    if METRICS_FILE:
+        try:
+            metrics.write_prometheus(METRICS_FILE)
+        except OSError as e:
+            logger.error(f"An error occurred while writing the run metrics to {METRICS_FILE}: {e}")
+    metrics.shutdown()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Prepare the property maintenance demo data.")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the description and embedding caches and call the models for every case.")
+    parser.add_argument("--clear-cache", action="store_true", help="Invalidate the description and embedding caches before processing.")
+    parser.add_argument("--incremental", action="store_true", help="Keep the existing table and index and only process new or changed cases.")
+    parser.add_argument("--no-preprocess", action="store_true", help="Send images to GPT-4 Vision at their original size.")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted run, skipping the cases it already exported and indexed.")
+    parser.add_argument("--no-dedupe", action="store_true", help="Describe near duplicate images separately instead of linking them to the first one.")
+    parser.add_argument("--batch", action="store_true", help="Describe and embed the cases with Azure OpenAI Batch API jobs, for large backfills.")
+    sharding = parser.add_mutually_exclusive_group()
+    sharding.add_argument("--shards", type=int, metavar="N", help="Split the cases into N shards, each processed by its own worker process, and merge their exports.")
+    sharding.add_argument("--shard", type=parse_shard, metavar="I/N", help="Process shard I of N as a worker, for example on one of several machines.")
+    sharding.add_argument("--setup-only", action="store_true", help="Only create the container, table and index, before running shards on several machines.")
+    sharding.add_argument("--merge-shards", type=int, metavar="N", help="Merge the exports of N shards and move the watermark if they all completed.")
+    args = parser.parse_args()
+    if (args.shards is not None and args.shards < 1) or (args.merge_shards is not None and args.merge_shards < 1):
+        parser.error("the number of shards must be at least 1")
+    return args
+
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main(parse_args()))
\ No newline at end of file
@@ -0,0 +1,319 @@
+import os
+import time
+import logging
+import argparse
+import numpy as np
+from export import load_records
+from localsearch import LocalSearchIndex, filter_order, print_matches, sample_queries
+
+logger = logging.getLogger(__name__)
+
+# Rows scored per chunk, which bounds the temporary float32 copy made while decoding codes
+SCORE_CHUNK_ROWS = 4096
+TRAIN_SAMPLE_ROWS = 20000
+
+
+# Half precision copy of the vectors, scored by widening each chunk back to float32
+class Float16Quantizer:
+    name = "float16"
+
+    def train(self, vectors):
+        pass
+
+    def encode(self, vectors):
+        return np.asarray(vectors, dtype=np.float16)
+
+    def scores(self, codes, query):
+        return chunked_scores(codes, lambda chunk: chunk.astype(np.float32) @ query)
+
+    def state(self):
+        return {}
+
+    def load_state(self, arrays):
+        pass
+
+
+# Per-dimension scalar quantization to one byte. The query stays in float32 and is folded into the
+# dimension scales, so scoring is one product over the raw codes plus a constant offset.
+class Int8Quantizer:
+    name = "int8"
+
+    def train(self, vectors):
+        self.low = vectors.min(axis=0).astype(np.float32)
+        self.scale = ((vectors.max(axis=0) - self.low) / 255).astype(np.float32)
+        self.scale[self.scale == 0] = 1
+
+    def encode(self, vectors):
+        return np.clip(np.rint((vectors - self.low) / self.scale), 0, 255).astype(np.uint8)
+
+    def scores(self, codes, query):
+        scaled_query = query * self.scale
+        offset = float(self.low @ query)
+        return chunked_scores(codes, lambda chunk: chunk.astype(np.float32) @ scaled_query + offset)
+
+    def state(self):
+        return {"low": self.low, "scale": self.scale}
+
+    def load_state(self, arrays):
+        self.low = arrays["low"]
+        self.scale = arrays["scale"]
+
+
+# Product quantization: each vector is split into subspaces and every subspace is replaced by the index
+# of its nearest of 256 k-means centroids, so a 1536 dimension vector with 96 subspaces is 96 bytes.
+# Queries are scored with asymmetric distance computation, against a lookup table of the full precision
+# query's products with every centroid.
+class ProductQuantizer:
+    name = "pq"
+
+    def __init__(self, subspaces=96, iterations=15, seed=0):
+        self.subspaces = subspaces
+        self.iterations = iterations
+        self.seed = seed
+
+    def train(self, vectors):
+        dimensions = vectors.shape[1]
+        if dimensions % self.subspaces:
+            raise ValueError(f"{dimensions} dimensions cannot be split into {self.subspaces} subspaces")
+        self.width = dimensions // self.subspaces
+        rng = np.random.default_rng(self.seed)
+        self.centroids = np.stack([
+            kmeans(vectors[:, s * self.width:(s + 1) * self.width], 256, self.iterations, rng)
+            for s in range(self.subspaces)
+        ])
+
+    def encode(self, vectors):
+        codes = np.empty((len(vectors), self.subspaces), dtype=np.uint8)
+        for s in range(self.subspaces):
+            codes[:, s] = nearest_centroids(vectors[:, s * self.width:(s + 1) * self.width], self.centroids[s])
+        return codes
+
+    def scores(self, codes, query):
+        table = np.einsum("scw,sw->sc", self.centroids, query.reshape(self.subspaces, self.width))
+        subspaces = np.arange(self.subspaces)
+        return chunked_scores(codes, lambda chunk: table[subspaces, chunk].sum(axis=1))
+
+    def state(self):
+        return {"centroids": self.centroids}
+
+    def load_state(self, arrays):
+        self.centroids = arrays["centroids"]
+        self.subspaces, _, self.width = self.centroids.shape
+
+
+QUANTIZERS = {
+    "float16": Float16Quantizer,
+    "int8": Int8Quantizer,
+    "pq": ProductQuantizer,
+}
+
+
+def chunked_scores(codes, score_chunk):
+    scores = np.empty(len(codes), dtype=np.float32)
+    for start in range(0, len(codes), SCORE_CHUNK_ROWS):
+        scores[start:start + SCORE_CHUNK_ROWS] = score_chunk(codes[start:start + SCORE_CHUNK_ROWS])
+    return scores
+
+
+def nearest_centroids(points, centroids):
+    distances = (centroids ** 2).sum(axis=1) - 2 * points @ centroids.T
+    return distances.argmin(axis=1)
+
+
+def kmeans(points, clusters, iterations, rng):
+    points = np.asarray(points, dtype=np.float32)
+    if len(points) <= clusters:
+        centroids = np.zeros((clusters, points.shape[1]), dtype=np.float32)
+        centroids[:len(points)] = points
+        return centroids
+
+    centroids = points[rng.choice(len(points), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = nearest_centroids(points, centroids)
+        counts = np.bincount(assignments, minlength=clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, points)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # Reseed empty clusters with random points so every code stays useful
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = points[rng.choice(len(points), len(empty), replace=False)]
+    return centroids
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+# Top-k search over quantized codes in place of the float32 matrix. The approximate scores pick
+# rerank * k candidates, which are then rescored against the full precision vectors. Those can stay
+# memory-mapped on disk, since only the candidate rows are read.
+class QuantizedIndex(LocalSearchIndex):
+    def __init__(self, records, vectors, quantizer, rerank=4, codes=None):
+        # The same row order as LocalSearchIndex, which saved codes also follow
+        records = filter_order(records)
+        self.records = records
+        self.index_fields(records)
+        self.source = vectors
+        self.source_rows = np.fromiter((record["VectorRow"] for record in records), dtype=np.int64, count=len(records))
+        self.quantizer = quantizer
+        self.rerank = rerank
+
+        if codes is None:
+            rng = np.random.default_rng(0)
+            sample = np.sort(rng.choice(len(records), min(len(records), TRAIN_SAMPLE_ROWS), replace=False))
+            quantizer.train(normalize(vectors[self.source_rows[sample]]))
+            codes = np.concatenate([
+                quantizer.encode(normalize(vectors[self.source_rows[start:start + SCORE_CHUNK_ROWS]]))
+                for start in range(0, len(records), SCORE_CHUNK_ROWS)
+            ])
+        self.codes = codes
+
+    @classmethod
+    def load(cls, path, export_path, rerank=4):
+        records, vectors = load_records(export_path)
+        with np.load(path) as arrays:
+            quantizer = QUANTIZERS[str(arrays["method"])]()
+            quantizer.load_state(arrays)
+            codes = arrays["codes"]
+        if len(codes) != len(records):
+            raise ValueError(f"{path} holds {len(codes)} cases but {export_path} has {len(records)}")
+        return cls(records, vectors, quantizer, rerank, codes)
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "wb") as codes_file:
+            np.savez(codes_file, method=self.quantizer.name, codes=self.codes, **self.quantizer.state())
+        logger.info(f"Saved {self.quantizer.name} codes for {len(self.codes)} cases to {path}.")
+
+    def row_vector(self, row):
+        return self.source[self.source_rows[row]]
+
+    def top_k(self, query_vector, k=10, mask=None, exclude_row=None, rerank=None):
+        query = normalize(query_vector)
+        scores = self.quantizer.scores(self.codes, query)
+        if mask is not None:
+            scores[~mask] = -np.inf
+        if exclude_row is not None:
+            scores[exclude_row] = -np.inf
+
+        rerank = self.rerank if rerank is None else rerank
+        shortlist = min(max(k * rerank, k), len(scores))
+        if shortlist <= 0:
+            return []
+        rows = np.argpartition(-scores, shortlist - 1)[:shortlist]
+        rows = rows[np.isfinite(scores[rows])]
+        if rerank:
+            # Read the candidates in file order, which keeps a memory-mapped source sequential
+            order = np.argsort(self.source_rows[rows])
+            rows = rows[order]
+            scores = normalize(self.source[self.source_rows[rows]]) @ query
+        else:
+            scores = scores[rows]
+        top = np.argsort(-scores)[:k]
+        return list(zip(rows[top].tolist(), scores[top].tolist()))
+
+
+def recall(truth, results):
+    found = sum(len(expected & {row for row, _ in result}) for expected, result in zip(truth, results))
+    return found / max(1, sum(len(expected) for expected in truth))
+
+
+def timed_queries(index, queries, k, **options):
+    start = time.perf_counter()
+    results = [index.top_k(query, k, **options) for query in queries]
+    return results, (time.perf_counter() - start) * 1000 / len(queries)
+
+
+# Report the memory each method saves over float32 and its recall@k against exact search, with and
+# without full precision reranking
+def quantization_report(records, vectors, methods, queries, k, rerank, subspaces):
+    exact = LocalSearchIndex(records, vectors)
+    exact_results, exact_ms = timed_queries(exact, queries, k)
+    truth = [{row for row, _ in result} for result in exact_results]
+    float32_bytes = exact.vectors.nbytes
+
+    logger.info(f"Recall@{k} over {len(queries)} queries and {len(records)} cases:")
+    logger.info(f"  {'float32':<14} {float32_bytes / 2**20:9.1f} MiB {'':13} recall 1.000  mean latency {exact_ms:.3f} ms")
+    report = {}
+    for method in methods:
+        quantizer = ProductQuantizer(subspaces) if method == "pq" else QUANTIZERS[method]()
+        start = time.perf_counter()
+        index = QuantizedIndex(records, vectors, quantizer, rerank)
+        build_s = time.perf_counter() - start
+        saved = 1 - index.codes.nbytes / max(1, float32_bytes)
+
+        approximate, approximate_ms = timed_queries(index, queries, k, rerank=0)
+        reranked, reranked_ms = timed_queries(index, queries, k)
+        report[method] = {
+            "bytes": index.codes.nbytes,
+            "saved": saved,
+            "recall": recall(truth, approximate),
+            "reranked_recall": recall(truth, reranked),
+        }
+        logger.info(f"  {method:<14} {index.codes.nbytes / 2**20:9.1f} MiB {saved:6.1%} saved  recall {report[method]['recall']:.3f}  mean latency {approximate_ms:.3f} ms, built in {build_s:.1f} s")
+        logger.info(f"  {method + '+rerank':<14} {'':27} recall {report[method]['reranked_recall']:.3f}  mean latency {reranked_ms:.3f} ms, reranking {rerank * k} candidates")
+    return report
+
+
+# Report on the cases of an export with sampled queries. Also run by prepdata on its export at the end of a
+# run when PREPDATA_QUANTIZATION_REPORT is set.
+def report_export(path, methods, queries=200, k=10, rerank=4, subspaces=96):
+    records, vectors = load_records(path)
+    if not records:
+        logger.info(f"The export {path} has no cases to report on.")
+        return {}
+    return quantization_report(records, vectors, methods, sample_queries(records, vectors, queries), k, rerank, subspaces)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Quantize the exported case vectors and report the memory saved and recall impact.")
+    parser.add_argument("--index", default="scripts/indexdata", help="Export base path (without .ndjson/.npy) or an indexdata.json file.")
+    parser.add_argument("--method", choices=["all"] + list(QUANTIZERS), default="all", help="Quantization method to evaluate.")
+    parser.add_argument("--subspaces", type=int, default=96, help="Product quantization subspaces, which is also its bytes per vector.")
+    parser.add_argument("--rerank", type=int, default=4, help="Rescore rerank * k candidates with the full precision vectors.")
+    parser.add_argument("-k", type=int, default=10, help="Number of neighbours for the recall report.")
+    parser.add_argument("--queries", type=int, default=200, help="Number of queries for the recall report.")
+    parser.add_argument("--save", metavar="PATH", help="Save the codes of a single --method to this .npz file instead of reporting.")
+    parser.add_argument("--codes", metavar="PATH", help="Search codes saved with --save, together with --case-id, instead of reporting.")
+    parser.add_argument("--case-id", help="With --codes, find the cases most similar to this case.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.codes:
+        if not args.case_id:
+            raise SystemExit("Pass --case-id to search the saved codes.")
+        try:
+            index = QuantizedIndex.load(args.codes, args.index, args.rerank)
+        except ValueError as e:
+            raise SystemExit(f"{e}, save the codes again.")
+        if args.case_id not in index.case_rows:
+            raise SystemExit(f"Case {args.case_id} is not in the export {args.index}.")
+        print_matches(index.search_case(args.case_id, args.k))
+        return
+
+    methods = list(QUANTIZERS) if args.method == "all" else [args.method]
+
+    if args.save:
+        if len(methods) != 1:
+            raise SystemExit("Pass a single --method with --save.")
+        records, vectors = load_records(args.index)
+        quantizer = ProductQuantizer(args.subspaces) if methods[0] == "pq" else QUANTIZERS[methods[0]]()
+        QuantizedIndex(records, vectors, quantizer, args.rerank).save(args.save)
+        return
+
+    report_export(args.index, methods, args.queries, args.k, args.rerank, args.subspaces)
+
+
+if __name__ == "__main__":
+    main()
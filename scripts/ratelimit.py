@@ -0,0 +1,103 @@
+import time
+import random
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Statuses that mean the deployment itself is misconfigured, such as a wrong key or deployment name, rather
+# than that the request is bad
+DEPLOYMENT_ERROR_STATUSES = (401, 403, 404)
+
+
+# Raised by a request that failed in a way worth retrying, such as a 429 or a 5xx
+class RetryableError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# Raised by a request that one deployment rejected with a DEPLOYMENT_ERROR_STATUSES status. Retrying on the
+# same deployment will not help, but another deployment of the same model can take the request.
+class DeploymentError(RetryableError):
+    pass
+
+
+# Read the server's requested delay in seconds from Retry-After style headers
+def parse_retry_after(headers):
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("Retry-After"):
+            return float(headers["Retry-After"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+# Token bucket refilled continuously at a per-minute rate. Azure OpenAI enforces its quotas over short
+# windows, so the bucket only holds a burst_seconds share of the minute rather than the whole of it
+class TokenBucket:
+    def __init__(self, per_minute, burst_seconds=10):
+        self.rate = per_minute / 60
+        self.capacity = self.rate * burst_seconds
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until the bucket holds the given amount, clamped so a single oversized request can still run
+    def wait_time(self, amount):
+        self.refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+
+# Admits requests against separate request-per-minute and token-per-minute budgets with a concurrency cap.
+# Throttled or failed requests are retried by DeploymentPool, with the pause and backoff delays given here.
+class RateLimiter:
+    def __init__(self, name, requests_per_minute, tokens_per_minute, max_concurrency, base_delay=1.0, max_delay=60.0):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.lock = asyncio.Lock()
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.paused_until = 0
+        self.throttled = 0
+
+    # Wait in arrival order until both budgets can cover the request, then spend them
+    async def acquire(self, estimated_tokens):
+        async with self.lock:
+            while True:
+                wait = max(
+                    self.paused_until - time.monotonic(),
+                    self.requests.wait_time(1),
+                    self.tokens.wait_time(estimated_tokens)
+                )
+                if wait <= 0:
+                    self.requests.consume(1)
+                    self.tokens.consume(estimated_tokens)
+                    return
+                await asyncio.sleep(wait)
+
+    # Hold back every request on this limiter, used when the service says it is throttling us
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    # Jittered exponential backoff before retry number attempt + 1
+    def backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
@@ -0,0 +1,95 @@
+import os
+import json
+import zlib
+import asyncio
+import logging
+import argparse
+from journal import STAGES
+
+logger = logging.getLogger(__name__)
+
+
+# The shard a file name or CaseID belongs to. crc32 rather than hash(), which is salted per process, so
+# every worker and every node agrees on the split.
+def shard_of(key, count):
+    return zlib.crc32(str(key).encode("utf-8")) % count
+
+
+# Parse a --shard value such as 2/8, the third of eight shards, into (index, count)
+def parse_shard(value):
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected INDEX/COUNT such as 0/4, got {value}")
+    if count < 1:
+        raise argparse.ArgumentTypeError(f"shard count must be at least 1, got {value}")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be from 0 to {count - 1}, got {value}")
+    return index, count
+
+
+# A shard's own copy of a local file, so workers never share a cache, journal or export. For shard 0 of 4,
+# scripts/.cache/journal.sqlite3 becomes scripts/.cache/journal.shard-0-of-4.sqlite3.
+def shard_path(path, shard):
+    if shard is None:
+        return path
+    index, count = shard
+    root, extension = os.path.splitext(path)
+    return f"{root}.shard-{index}-of-{count}{extension}"
+
+
+# Write a shard's progress through a temporary file, so the coordinator never reads half of it
+def write_status(path, status):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as status_file:
+        json.dump(status, status_file)
+    os.replace(f"{path}.tmp", path)
+
+
+def read_status(path):
+    try:
+        with open(path, encoding="utf-8") as status_file:
+            return json.load(status_file)
+    except (OSError, ValueError):
+        return None
+
+
+# Log the stages completed across the shards, from the status file each worker keeps up to date
+def log_progress(statuses, finished):
+    totals = {stage: sum(status["stages"].get(stage, 0) for status in statuses if status) for stage in STAGES}
+    logger.info(f"Shards: {finished} of {len(statuses)} finished, " + ", ".join(f"{totals[stage]} {stage}" for stage in STAGES) + ".")
+
+
+# Run command once per shard with --shard INDEX/COUNT added, as local worker processes, and wait for all of
+# them while logging their combined progress every interval seconds
+async def run_workers(command, count, env, status_path, interval):
+    status_paths = [shard_path(status_path, (index, count)) for index in range(count)]
+    processes = []
+    try:
+        for index, path in enumerate(status_paths):
+            # A status left by an earlier run would read as this run's result
+            if os.path.exists(path):
+                os.remove(path)
+            processes.append(await asyncio.create_subprocess_exec(*command, "--shard", f"{index}/{count}", env=env))
+        logger.info(f"Started {count} shard workers.")
+
+        waits = [asyncio.create_task(process.wait()) for process in processes]
+        while True:
+            await asyncio.wait(waits, timeout=interval)
+            statuses = [read_status(path) for path in status_paths]
+            finished = sum(1 for wait in waits if wait.done())
+            log_progress(statuses, finished)
+            if finished == count:
+                break
+    finally:
+        # An interrupted coordinator stops its workers, which can be resumed with --resume
+        for process in processes:
+            if process.returncode is None:
+                process.terminate()
+                await process.wait()
+
+    for index, process in enumerate(processes):
+        if process.returncode:
+            logger.error(f"Shard {index}/{count} exited with code {process.returncode}.")
@@ -0,0 +1,58 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Buffers rows and hands them to an async write function in batches of batch_size, and optionally
+# every flush_interval seconds so a slow trickle of rows is not held back indefinitely
+class BatchWriter:
+    def __init__(self, name, write_batch, batch_size, flush_interval=None):
+        self.name = name
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows = []
+        self.written = 0
+        self.failed = 0
+        self.timer = None
+        self.stopping = asyncio.Event()
+
+    def start(self):
+        if self.flush_interval and self.timer is None:
+            self.timer = asyncio.create_task(self.flush_periodically())
+
+    async def flush_periodically(self):
+        while not self.stopping.is_set():
+            try:
+                await asyncio.wait_for(self.stopping.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                await self.flush()
+
+    async def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            # Producers wait for the flush, which keeps the buffer from outgrowing the database
+            await self.flush()
+
+    async def flush(self):
+        if not self.rows:
+            return
+
+        rows = self.rows
+        self.rows = []
+        try:
+            await self.write_batch(rows)
+            self.written += len(rows)
+        except Exception as e:
+            self.failed += len(rows)
+            logger.error(f"An error occurred while writing a batch of {len(rows)} rows to {self.name}: {e}")
+
+    async def close(self):
+        if self.timer is not None:
+            # Let an interval flush that is already writing finish rather than cancelling it
+            self.stopping.set()
+            await self.timer
+            self.timer = None
+        await self.flush()
+        logger.info(f"{self.name}: {self.written} rows written, {self.failed} rows failed.")
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+import ann
+from ann import HnswIndex, create_index, load_index, recall_report
+
+
+# Clustered unit vectors, so nearest neighbours are well defined
+@pytest.fixture(scope="module")
+def export():
+    rng = np.random.default_rng(1)
+    centres = rng.standard_normal((20, 32)).astype(np.float32)
+    vectors = centres[rng.integers(0, 20, 600)] + rng.standard_normal((600, 32)).astype(np.float32) * 0.3
+    records = [{"CaseID": f"case-{row}", "VectorRow": row} for row in range(len(vectors))]
+    return records, vectors
+
+
+def exact_neighbours(vectors, query, k):
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return {f"case-{row}" for row in np.argsort(-(unit @ (query / np.linalg.norm(query))))[:k]}
+
+
+def test_hnsw_search_finds_the_exact_neighbours(export):
+    records, vectors = export
+    index = HnswIndex(32, m=8, ef_construction=64)
+    assert index.add_records(records, vectors) == 600
+
+    queries = vectors[:50] + np.random.default_rng(2).standard_normal((50, 32)).astype(np.float32) * 0.1
+    found = sum(len(exact_neighbours(vectors, query, 10) & {label for label, _ in index.search(query, 10, ef_search=64)}) for query in queries)
+    assert found / 500 >= 0.95
+
+
+def test_search_returns_the_case_itself_first(export):
+    records, vectors = export
+    index = HnswIndex(32, m=8, ef_construction=64)
+    index.add_records(records[:200], vectors)
+    label, similarity = index.search(vectors[7], 3)[0]
+    assert label == "case-7"
+    assert similarity == pytest.approx(1, abs=1e-5)
+
+
+def test_add_records_skips_the_cases_already_indexed(export):
+    records, vectors = export
+    index = HnswIndex(32, m=8, ef_construction=32)
+    assert index.add_records(records[:100], vectors) == 100
+    assert index.add_records(records[:150], vectors) == 50
+    assert len(index) == 150
+    assert "case-149" in index and "case-150" not in index
+
+
+def test_a_saved_index_answers_the_same(export, tmp_path):
+    records, vectors = export
+    index = HnswIndex(32, m=8, ef_construction=32)
+    index.add_records(records[:300], vectors)
+    path = str(tmp_path / "cases.hnsw.npz")
+    index.save(path)
+
+    loaded = load_index(path)
+    assert isinstance(loaded, HnswIndex)
+    for query in vectors[300:310]:
+        assert loaded.search(query, 5) == index.search(query, 5)
+    # A loaded index keeps growing from where it stopped
+    assert loaded.add_records(records, vectors) == 300
+
+
+def test_hnswlib_backend(export, tmp_path):
+    pytest.importorskip("hnswlib")
+    records, vectors = export
+    index = create_index(32, 8, 64, 64)
+    assert isinstance(index, ann.HnswlibIndex)
+    # More cases than the initial capacity makes the index grow
+    assert index.add_records(records * 2, vectors) == 600
+    assert index.search(vectors[42], 1)[0][0] == "case-42"
+
+    path = str(tmp_path / "cases.hnsw.npz")
+    index.save(path)
+    loaded = load_index(path)
+    assert loaded.search(vectors[42], 5) == index.search(vectors[42], 5)
+
+
+def test_python_backend_can_be_chosen(monkeypatch):
+    assert isinstance(create_index(8, 4, 16, 16, backend="python"), HnswIndex)
+    monkeypatch.setattr(ann, "hnswlib", None)
+    assert isinstance(create_index(8, 4, 16, 16), HnswIndex)
+    with pytest.raises(SystemExit):
+        create_index(8, 4, 16, 16, backend="hnswlib")
+
+
+def test_recall_report_measures_each_ef_search(export):
+    records, vectors = export
+    index = HnswIndex(32, m=8, ef_construction=64)
+    index.add_records(records, vectors)
+    report = recall_report(index, records, vectors, vectors[:20], 5, [4, 64])
+    assert [name for name, _, _ in report] == ["exact", "efSearch=4", "efSearch=64"]
+    assert report[2][1] >= report[1][1]
+    assert report[2][1] >= 0.95
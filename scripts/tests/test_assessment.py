@@ -0,0 +1,71 @@
+import json
+from assessment import parse_assessment, split_assessments
+
+# A structured response as the model sends it
+MOULD = {"description": "Black mould on the bathroom ceiling.", "repair": "Treat and repaint the ceiling.", "tradesman": "Decorator", "mould_detected": True, "mould_severity": "moderate"}
+
+
+def test_a_structured_response_is_decoded_into_its_fields():
+    assessment = parse_assessment(json.dumps(MOULD))
+    assert assessment["Structured"]
+    assert (assessment["MouldDetected"], assessment["MouldSeverity"], assessment["Tradesman"]) == (True, "moderate", "Decorator")
+    # The stored description keeps the headings the text parser reads
+    assert assessment["Description"] == (
+        "Image Description: Black mould on the bathroom ceiling.\nRepair needed: Treat and repaint the ceiling.\n"
+        "Tradesman Required: Decorator\nMould Status: MOULD DETECTED, moderate severity"
+    )
+    assert parse_assessment(assessment["Description"])["MouldSeverity"] == "moderate"
+
+
+def test_structured_fields_are_normalized():
+    assessment = parse_assessment(json.dumps({**MOULD, "tradesman": "a qualified plumber", "mould_detected": False, "mould_severity": "Severe"}))
+    assert assessment["Tradesman"] == "Plumber"
+    # No mould means no severity, whatever the response said
+    assert assessment["MouldSeverity"] == "none"
+    assert assessment["Description"].endswith("Mould Status: MOULD NOT DETECTED")
+
+    assessment = parse_assessment(json.dumps({**MOULD, "mould_severity": "none"}))
+    assert (assessment["MouldDetected"], assessment["MouldSeverity"]) == (True, None)
+
+
+def test_an_invalid_structured_response_falls_back_to_the_text_parser():
+    for content in ('{"description": "Cut off', json.dumps({**MOULD, "mould_detected": "yes"}), json.dumps({**MOULD, "mould_severity": "extreme"})):
+        assessment = parse_assessment(content)
+        assert not assessment["Structured"]
+        assert assessment["Description"] == content
+
+
+def test_the_text_parser_reads_the_headings():
+    text = "Image Description: Damp patch by the window.\nRepair needed: Fix the seal.\nTradesman Required: Glazier or joiner\nMould Status: MOULD DETECTED, mild"
+    assessment = parse_assessment(text)
+    assert not assessment["Structured"]
+    assert assessment["Description"] == text
+    assert (assessment["Repair"], assessment["Tradesman"]) == ("Fix the seal.", "Glazier")
+    assert (assessment["MouldDetected"], assessment["MouldSeverity"]) == (True, "mild")
+
+    assessment = parse_assessment("Image Description: A broken tap.\nRepair needed: Replace it.\nTradesman Required: Plumber\nMould Status: MOULD NOT DETECTED")
+    assert (assessment["MouldDetected"], assessment["MouldSeverity"]) == (False, "none")
+
+
+def test_assessments_are_split_by_their_case_ids():
+    content = json.dumps({"assessments": [{"case_id": "A1", **MOULD}, {"case_id": " B2 ", **MOULD, "mould_detected": False}]})
+    responses = split_assessments(content, ["A1", "B2"])
+    assert set(responses) == {"A1", "B2"}
+    assert parse_assessment(responses["A1"])["MouldDetected"] is True
+    assert parse_assessment(responses["B2"])["MouldDetected"] is False
+
+
+def test_unusable_assessments_are_left_out():
+    content = json.dumps({"assessments": [
+        {"case_id": "A1", **MOULD},
+        {"case_id": "B2", **MOULD, "tradesman": 3},
+        {"case_id": "C3", **MOULD},
+        {"case_id": "C3", **MOULD, "mould_detected": False},
+        {"case_id": "Z9", **MOULD},
+        "not an assessment",
+    ]})
+    # B2 is invalid, C3 is given twice and Z9 was not in the request
+    assert set(split_assessments(content, ["A1", "B2", "C3"])) == {"A1"}
+    assert split_assessments("not json", ["A1"]) == {}
+    assert split_assessments(json.dumps([MOULD]), ["A1"]) == {}
+    assert split_assessments(json.dumps({"assessments": {"A1": MOULD}}), ["A1"]) == {}
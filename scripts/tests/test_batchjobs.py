@@ -0,0 +1,108 @@
+import os
+import json
+import asyncio
+from types import SimpleNamespace
+from batchjobs import BatchJobs
+from journal import StageJournal
+
+
+# Stands in for the files and batches of the Batch API. A job completes on its first poll, answering each
+# request with its custom_id, except the requests in fail, which it reports as failed.
+class BatchService:
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.contents = {}
+        self.jobs = {}
+        self.deleted = []
+        self.files = SimpleNamespace(create=self.create_file, content=self.file_content, delete=self.delete_file)
+        self.batches = SimpleNamespace(create=self.create_batch, retrieve=self.retrieve_batch)
+
+    async def create_file(self, file, purpose):
+        file_id = f"file-{len(self.contents)}"
+        self.contents[file_id] = file.read().decode("utf-8")
+        return SimpleNamespace(id=file_id)
+
+    async def file_content(self, file_id):
+        return SimpleNamespace(text=self.contents[file_id])
+
+    async def delete_file(self, file_id):
+        self.deleted.append(file_id)
+
+    async def create_batch(self, input_file_id, endpoint, completion_window):
+        batch_id = f"batch-{len(self.jobs)}"
+        self.jobs[batch_id] = input_file_id
+        return SimpleNamespace(id=batch_id, status="in_progress")
+
+    async def retrieve_batch(self, batch_id):
+        requests = [json.loads(line) for line in self.contents[self.jobs[batch_id]].splitlines()]
+        lines = []
+        for request in requests:
+            status = 500 if request["custom_id"] in self.fail else 200
+            lines.append(json.dumps({"custom_id": request["custom_id"], "response": {"status_code": status, "body": {"id": request["custom_id"]}}}))
+        output_file_id = f"output-{batch_id}"
+        self.contents[output_file_id] = "\n".join(lines)
+        counts = SimpleNamespace(total=len(requests), completed=len(requests) - len(self.fail))
+        return SimpleNamespace(id=batch_id, status="completed", request_counts=counts, input_file_id=self.jobs[batch_id], output_file_id=output_file_id, error_file_id=None)
+
+
+async def add_all(jobs, custom_ids):
+    results = {}
+
+    async def on_result(custom_id, result):
+        results[custom_id] = result
+
+    for custom_id in custom_ids:
+        await jobs.add(custom_id, {"input": custom_id}, lambda result, custom_id=custom_id: on_result(custom_id, result))
+    await jobs.drain()
+    return results
+
+
+def test_requests_are_split_into_jobs_and_answered_by_custom_id(tmp_path):
+    service = BatchService(fail=["c"])
+    jobs = BatchJobs(service, "embedding", "/embeddings", str(tmp_path), max_requests=2, max_bytes=10000, poll_interval=0)
+    results = asyncio.run(add_all(jobs, ["a", "b", "c"]))
+    assert results == {"a": {"id": "a"}, "b": {"id": "b"}, "c": None}
+    assert len(service.jobs) == 2
+    # The input files are removed locally and from the service once their results are read
+    assert os.listdir(tmp_path) == []
+    assert sorted(service.deleted) == sorted(service.contents)
+
+
+def test_a_file_is_submitted_when_it_reaches_the_size_bound(tmp_path):
+    service = BatchService()
+    line_bytes = len(json.dumps({"custom_id": "a", "method": "POST", "url": "/embeddings", "body": {"input": "a"}})) + 1
+    jobs = BatchJobs(service, "embedding", "/embeddings", str(tmp_path), max_requests=100, max_bytes=line_bytes * 2, poll_interval=0)
+    asyncio.run(add_all(jobs, ["a", "b", "c", "d", "e"]))
+    assert len(service.jobs) == 3
+
+
+def test_a_resumed_run_waits_for_the_jobs_of_the_interrupted_run(tmp_path):
+    service = BatchService()
+    journal = StageJournal(str(tmp_path / "journal.sqlite3"))
+    interrupted = BatchJobs(service, "vision", "/chat/completions", str(tmp_path), max_requests=100, max_bytes=100000, poll_interval=0, journal=journal)
+
+    # The interrupted run submitted its job but never read the results
+    async def submit():
+        for custom_id in ("a", "b"):
+            await interrupted.add(custom_id, {"input": custom_id}, None)
+        path = interrupted.path
+        interrupted.file.close()
+        with open(path, "rb") as file:
+            input_file = await service.files.create(file=file, purpose="batch")
+        batch = await service.batches.create(input_file_id=input_file.id, endpoint="/chat/completions", completion_window="24h")
+        journal.record_batch_job("vision", batch.id, ["a", "b"])
+
+    asyncio.run(submit())
+    assert journal.batch_jobs("vision") == [("batch-0", ["a", "b"])]
+
+    async def resume():
+        jobs = BatchJobs(service, "vision", "/chat/completions", str(tmp_path), max_requests=100, max_bytes=100000, poll_interval=0, journal=journal)
+        jobs.reattach()
+        return await add_all(jobs, ["a", "b", "c"])
+
+    results = asyncio.run(resume())
+    assert results == {"a": {"id": "a"}, "b": {"id": "b"}, "c": {"id": "c"}}
+    # Only the new request was submitted again, and the finished job left the journal
+    assert len(service.jobs) == 2
+    assert journal.batch_jobs("vision") == []
+    journal.conn.close()
@@ -0,0 +1,144 @@
+import os
+import time
+import numpy as np
+import pytest
+from cache import DescriptionCache, EmbeddingCache
+
+
+@pytest.fixture
+def description_cache(tmp_path):
+    cache = DescriptionCache(str(tmp_path / "descriptions.sqlite3"), max_entries=3, max_age_days=30)
+    yield cache
+    cache.conn.close()
+
+
+def test_description_key_covers_the_image_deployment_prompt_and_variant():
+    key = DescriptionCache.make_key("abc", "gpt-4-turbo", "Describe the image.", "1024:85")
+    assert key == DescriptionCache.make_key("abc", "gpt-4-turbo", "Describe the image.", "1024:85")
+    assert key != DescriptionCache.make_key("abd", "gpt-4-turbo", "Describe the image.", "1024:85")
+    assert key != DescriptionCache.make_key("abc", "gpt-4o", "Describe the image.", "1024:85")
+    assert key != DescriptionCache.make_key("abc", "gpt-4-turbo", "Describe the photo.", "1024:85")
+    assert key != DescriptionCache.make_key("abc", "gpt-4-turbo", "Describe the image.", "original")
+
+
+def test_description_round_trip_survives_reopening(tmp_path):
+    path = str(tmp_path / "descriptions.sqlite3")
+    cache = DescriptionCache(path)
+    cache.put("key", "Black mould on the ceiling. MOULD DETECTED", True)
+    cache.close()
+
+    cache = DescriptionCache(path)
+    assert cache.get("key") == ("Black mould on the ceiling. MOULD DETECTED", True)
+    assert cache.get("other") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
+
+
+def test_expired_descriptions_are_misses(description_cache):
+    description_cache.put("key", "A leaking tap.", False)
+    description_cache.conn.execute("UPDATE Descriptions SET CreatedAt = ?", (time.time() - 31 * 24 * 60 * 60,))
+    assert description_cache.get("key") is None
+    assert description_cache.evict() == 1
+
+
+def test_eviction_keeps_the_most_recently_used(description_cache):
+    for number in range(4):
+        description_cache.put(f"key-{number}", f"Description {number}", False)
+        description_cache.conn.execute("UPDATE Descriptions SET LastUsedAt = ? WHERE CacheKey = ?", (number, f"key-{number}"))
+    # Reading the oldest entry makes it the most recently used
+    assert description_cache.get("key-0") is not None
+    assert description_cache.evict() == 1
+    assert description_cache.get("key-1") is None
+    assert description_cache.get("key-0") is not None
+
+
+def test_clear(description_cache):
+    description_cache.put("key", "A leaking tap.", False)
+    description_cache.clear()
+    assert description_cache.get("key") is None
+
+
+# Three ada-002 sized embeddings and the keys of the descriptions they belong to
+EMBEDDINGS = np.random.default_rng(0).standard_normal((3, 1536)).astype(np.float32)
+KEYS = [EmbeddingCache.make_key(text, "text-embedding-ada-002") for text in ("Damp patch by the window.", "Cracked basin.", "Loose stair rail.")]
+
+
+def fill(path, count=3, **options):
+    cache = EmbeddingCache(path, **options)
+    for key, embedding in zip(KEYS[:count], EMBEDDINGS):
+        cache.put(key, embedding)
+    return cache
+
+
+def test_embedding_key_normalizes_the_text_and_covers_the_model():
+    assert EmbeddingCache.make_key("Damp  patch\n by the window.", "ada") == EmbeddingCache.make_key("Damp patch by the window.", "ada")
+    assert EmbeddingCache.make_key("Damp patch", "ada") != EmbeddingCache.make_key("Damp patch", "text-embedding-3-large")
+
+
+def test_embeddings_are_read_back_after_reopening(tmp_path):
+    path = str(tmp_path / "embeddings.bin")
+    fill(path).close()
+    assert os.path.getsize(path) == EmbeddingCache.HEADER.size + 3 * (32 + 4 * 1536)
+
+    cache = EmbeddingCache(path)
+    for key, embedding in zip(KEYS, EMBEDDINGS):
+        assert np.array_equal(cache.get(key), embedding)
+    assert cache.get(EmbeddingCache.make_key("Blocked gutter.", "text-embedding-ada-002")) is None
+    assert (cache.hits, cache.misses) == (3, 1)
+    cache.close()
+
+
+def test_a_key_ending_in_zero_bytes_is_found_after_reopening(tmp_path):
+    path = str(tmp_path / "embeddings.bin")
+    key = bytes(range(1, 31)) + b"\0\0"
+    cache = EmbeddingCache(path)
+    cache.put(key, EMBEDDINGS[0])
+    cache.close()
+
+    cache = EmbeddingCache(path)
+    assert np.array_equal(cache.get(key), EMBEDDINGS[0])
+    cache.close()
+
+
+def test_a_torn_last_record_is_dropped_and_overwritten(tmp_path):
+    path = str(tmp_path / "embeddings.bin")
+    fill(path, count=2).close()
+    with open(path, "r+b") as cache_file:
+        cache_file.truncate(os.path.getsize(path) - 100)
+
+    cache = EmbeddingCache(path)
+    assert cache.get(KEYS[1]) is None
+    cache.put(KEYS[2], EMBEDDINGS[2])
+    cache.close()
+
+    cache = EmbeddingCache(path)
+    assert set(cache.offsets) == {KEYS[0], KEYS[2]}
+    assert np.array_equal(cache.get(KEYS[2]), EMBEDDINGS[2])
+    cache.close()
+
+
+def test_a_file_in_another_format_is_started_again(tmp_path):
+    path = tmp_path / "embeddings.bin"
+    path.write_bytes(b"not an embedding cache")
+    cache = fill(str(path), count=1)
+    cache.close()
+
+    cache = EmbeddingCache(str(path))
+    assert np.array_equal(cache.get(KEYS[0]), EMBEDDINGS[0])
+    cache.close()
+
+
+def test_memory_holds_the_most_recently_used_embeddings(tmp_path):
+    cache = fill(str(tmp_path / "embeddings.bin"), max_memory_entries=2)
+    assert list(cache.memory) == KEYS[1:]
+    # The oldest embedding left memory but is still read from the file
+    assert np.array_equal(cache.get(KEYS[0]), EMBEDDINGS[0])
+    assert list(cache.memory) == [KEYS[2], KEYS[0]]
+    cache.close()
+
+
+def test_an_embedding_of_another_length_is_not_cached(tmp_path):
+    cache = fill(str(tmp_path / "embeddings.bin"), count=1)
+    cache.put(KEYS[1], EMBEDDINGS[1][:256])
+    assert cache.get(KEYS[1]) is None
+    cache.close()
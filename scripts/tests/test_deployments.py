@@ -0,0 +1,126 @@
+import json
+import time
+import asyncio
+import pytest
+import deployments
+from deployments import DeploymentPool, load_deployments
+from ratelimit import DeploymentError, RetryableError
+
+
+# Two deployments of one model in different regions, as listed in PREPDATA_OPENAI_DEPLOYMENTS_FILE
+@pytest.fixture
+def deployments_file(tmp_path, monkeypatch):
+    monkeypatch.setenv("WEST_OAI_KEY", "west-key")
+    path = tmp_path / "deployments.json"
+    path.write_text(json.dumps({"vision": [
+        {"endpoint": "https://east.openai.azure.com", "deployment": "gpt-4o"},
+        {"endpoint": "https://west.openai.azure.com/", "deployment": "gpt-4o-west", "api_key_env": "WEST_OAI_KEY", "model": "gpt-4o", "rpm": 6000},
+    ]}))
+    return str(path)
+
+
+# The pool picks the first deployment with room rather than one at random, so each test knows which one fails first
+@pytest.fixture
+def first_choice(monkeypatch):
+    monkeypatch.setattr(deployments.random, "choices", lambda candidates, weights: candidates[:1])
+
+
+def vision_pool(path, failure_threshold=2, cooldown=60.0, max_retries=6):
+    return DeploymentPool("vision", load_deployments(path, "vision", "default-key", 600, 1000000, 10, failure_threshold, cooldown, quota_share=0.5, default_model="gpt-4o"), max_retries)
+
+
+# A call that fails with error on the deployments in the named regions and returns the region of any other
+def failing_in(regions, error):
+    async def call(deployment):
+        region = deployment.name.split("/")[0]
+        if region in regions:
+            raise error
+        return region
+    return call
+
+
+def test_deployments_are_read_from_the_file(deployments_file):
+    east, west = load_deployments(deployments_file, "vision", "default-key", 600, 1000000, 10, quota_share=0.5, default_model="gpt-4o")
+    assert (east.name, east.endpoint, east.api_key, east.model) == ("east/gpt-4o", "https://east.openai.azure.com/", "default-key", "gpt-4o")
+    assert (west.api_key, west.deployment, west.model) == ("west-key", "gpt-4o-west", "gpt-4o")
+    # The quota share scales the rates given in the file and the defaults alike
+    assert east.limiter.requests.rate * 60 == pytest.approx(300)
+    assert west.limiter.requests.rate * 60 == pytest.approx(3000)
+    assert west.limiter.tokens.rate * 60 == pytest.approx(500000)
+    assert east.url("chat/completions", "2024-02-15-preview") == "https://east.openai.azure.com/openai/deployments/gpt-4o/chat/completions?api-version=2024-02-15-preview"
+    assert load_deployments(deployments_file, "embedding", "default-key", 600, 1000000, 10) == []
+
+
+def test_the_pool_opens_a_failing_circuit_and_moves_to_another_deployment(deployments_file, first_choice):
+    pool = vision_pool(deployments_file)
+    east, west = pool.deployments
+
+    async def run():
+        return [await pool.run(10, failing_in({"east"}, RetryableError("500 from the service"))) for _ in range(20)]
+
+    assert set(asyncio.run(run())) == {"west"}
+    assert east.is_open and east.trips == 1
+    # Once open the circuit keeps requests away until its cooldown ends
+    assert east.requests == east.failure_threshold
+    assert west.requests == 20
+
+
+def test_a_probe_closes_the_circuit_and_a_failed_probe_reopens_it(deployments_file):
+    pool = vision_pool(deployments_file, cooldown=0, max_retries=0)
+    pool.deployments = pool.deployments[:1]
+    east = pool.deployments[0]
+    east.record_failure()
+    east.record_failure()
+
+    async def probe(deployment):
+        # Only one probe is let through while the circuit is open
+        assert deployment.probing and not deployment.available(time.monotonic())
+        return "east"
+
+    assert asyncio.run(pool.run(10, probe)) == "east"
+    assert not east.is_open and not east.probing
+
+    east.record_failure()
+    east.record_failure()
+    with pytest.raises(RetryableError):
+        asyncio.run(pool.run(10, failing_in({"east"}, RetryableError("500 from the service"))))
+    assert east.is_open and east.trips == 3
+    assert not east.probing
+
+
+def test_a_deployment_error_fails_over_at_once(deployments_file, first_choice):
+    pool = vision_pool(deployments_file, failure_threshold=5)
+    east, west = pool.deployments
+
+    async def run():
+        return [await pool.run(10, failing_in({"east"}, DeploymentError("401 from the service"))) for _ in range(10)]
+
+    assert set(asyncio.run(run())) == {"west"}
+    # A single 401 takes the deployment out of rotation
+    assert east.is_open
+    assert east.requests == 1
+
+    with pytest.raises(DeploymentError):
+        asyncio.run(pool.run(10, failing_in({"east", "west"}, DeploymentError("404 from the service"))))
+
+
+def test_throttled_requests_pause_the_deployment_and_give_up_after_the_retries(deployments_file):
+    pool = vision_pool(deployments_file, max_retries=2)
+    pool.deployments = pool.deployments[:1]
+    east = pool.deployments[0]
+
+    with pytest.raises(RetryableError):
+        asyncio.run(pool.run(10, failing_in({"east"}, RetryableError("429 Too Many Requests", retry_after=0.01))))
+    assert east.requests == 3
+    assert east.limiter.throttled == 3
+    assert pool.retries == 2
+    # Throttling is about quota rather than health
+    assert not east.failures
+
+
+def test_request_errors_are_not_retried(deployments_file):
+    pool = vision_pool(deployments_file)
+    with pytest.raises(ValueError):
+        asyncio.run(pool.run(10, failing_in({"east", "west"}, ValueError("400 from the service"))))
+    assert pool.retries == 0
+    assert sum(deployment.errors for deployment in pool.deployments) == 0
@@ -0,0 +1,127 @@
+import json
+import numpy as np
+import pytest
+from export import CaseExporter, iter_documents, load_export, load_json_export, merge_exports
+
+CASES = [
+    {"CaseID": "1001", "Description": "Black mould behind the wardrobe.", "Vector": [0.5, -0.25, 1.0]},
+    {"CaseID": "1002", "Description": "Cracked basin.", "Vector": [0.0, 2.0, -1.5]},
+    {"CaseID": "1003", "Description": "Loose stair rail.", "Vector": [3.0, 0.125, 0.0]},
+]
+
+
+def export(base_path, cases):
+    exporter = CaseExporter(base_path)
+    for case in cases:
+        exporter.write(case)
+    exporter.close()
+
+
+def test_records_and_vectors_are_written_to_separate_files(tmp_path):
+    base_path = str(tmp_path / "indexdata")
+    export(base_path, CASES)
+
+    records, vectors = load_export(base_path)
+    assert records[1] == {"CaseID": "1002", "Description": "Cracked basin.", "VectorRow": 1}
+    assert vectors.dtype == np.float32
+    assert vectors.tolist() == [case["Vector"] for case in CASES]
+    # The vectors are also a plain .npy file
+    assert np.load(f"{base_path}.npy").shape == (3, 3)
+
+
+def test_iter_documents_restores_the_search_documents(tmp_path):
+    base_path = str(tmp_path / "indexdata")
+    export(base_path, CASES)
+    assert list(iter_documents(base_path)) == CASES
+
+
+def test_a_vector_of_another_length_is_rejected(tmp_path):
+    exporter = CaseExporter(str(tmp_path / "indexdata"))
+    exporter.write(CASES[0])
+    with pytest.raises(ValueError):
+        exporter.write({"CaseID": "1004", "Vector": [1.0, 2.0]})
+    exporter.close()
+
+
+def test_an_empty_export_loads_as_an_empty_matrix(tmp_path):
+    base_path = str(tmp_path / "indexdata")
+    export(base_path, [])
+    records, vectors = load_export(base_path)
+    assert records == []
+    assert vectors.shape == (0, 0)
+
+
+def test_the_json_export_loads_in_the_same_shape(tmp_path):
+    json_path = tmp_path / "indexdata.json"
+    json_path.write_text(json.dumps(CASES, indent=4))
+    records, vectors = load_json_export(str(json_path))
+    assert [record["VectorRow"] for record in records] == [0, 1, 2]
+    assert "Vector" not in records[0]
+    assert vectors.tolist() == [case["Vector"] for case in CASES]
+
+
+# Write the cases and leave the files as a run that was killed would, flushed but never closed
+def interrupted_export(base_path, cases):
+    exporter = CaseExporter(base_path)
+    for case in cases:
+        exporter.write(case)
+    exporter.records_file.flush()
+    exporter.vectors_file.flush()
+    return exporter
+
+
+def test_a_resumed_export_keeps_the_whole_cases(tmp_path):
+    base_path = str(tmp_path / "indexdata")
+    exporter = interrupted_export(base_path, CASES[:2])
+    # The third case was cut off half way through its record
+    exporter.vectors_file.write(np.float32([1, 2, 3]).tobytes())
+    exporter.records_file.write('{"CaseID": "1003", "Desc')
+    exporter.records_file.flush()
+
+    exporter = CaseExporter(base_path, resume=True)
+    assert exporter.case_ids == {"1001", "1002"}
+    exporter.write(CASES[2])
+    exporter.close()
+    assert list(iter_documents(base_path)) == CASES
+
+
+def test_a_record_without_its_whole_vector_is_dropped(tmp_path):
+    base_path = str(tmp_path / "indexdata")
+    interrupted_export(base_path, CASES)
+    with open(f"{base_path}.npy", "r+b") as vectors_file:
+        vectors_file.truncate(vectors_file.seek(0, 2) - 4)
+
+    exporter = CaseExporter(base_path, resume=True)
+    assert exporter.rows == 2
+    exporter.close()
+    assert list(iter_documents(base_path)) == CASES[:2]
+
+
+def test_resuming_without_an_export_starts_one(tmp_path):
+    base_path = str(tmp_path / "indexdata")
+    exporter = CaseExporter(base_path, resume=True)
+    assert exporter.case_ids == set()
+    exporter.write(CASES[0])
+    exporter.close()
+    assert list(iter_documents(base_path)) == CASES[:1]
+
+
+def test_shard_exports_are_merged_into_one(tmp_path):
+    shard_paths = [str(tmp_path / f"indexdata.shard-{index}-of-3") for index in range(3)]
+    export(shard_paths[0], CASES[:2])
+    export(shard_paths[2], CASES[2:])
+    # The second shard never exported anything, so it is skipped
+    base_path = str(tmp_path / "merged" / "indexdata")
+    assert merge_exports(shard_paths, base_path, block_rows=1) == 3
+
+    records, vectors = load_export(base_path)
+    assert [record["VectorRow"] for record in records] == [0, 1, 2]
+    assert list(iter_documents(base_path)) == CASES
+
+
+def test_exports_of_another_dimension_are_not_merged(tmp_path):
+    shard_paths = [str(tmp_path / f"indexdata.shard-{index}-of-2") for index in range(2)]
+    export(shard_paths[0], CASES[:1])
+    export(shard_paths[1], [{"CaseID": "1004", "Vector": [1.0, 2.0]}])
+    with pytest.raises(ValueError):
+        merge_exports(shard_paths, str(tmp_path / "indexdata"))
@@ -0,0 +1,52 @@
+import io
+from PIL import Image
+from images import IMAGE_DEFAULT_TOKENS, estimate_image_tokens, estimate_image_tokens_from_bytes, image_dimensions, preprocess_image
+
+
+def encode(size, format, **options):
+    output = io.BytesIO()
+    Image.new("RGB", size, (120, 110, 100)).save(output, format=format, **options)
+    return output.getvalue()
+
+
+def test_image_dimensions_reads_png_and_jpeg_headers():
+    assert image_dimensions(encode((640, 480), "PNG")) == (640, 480)
+    assert image_dimensions(encode((300, 900), "JPEG")) == (300, 900)
+    assert image_dimensions(encode((300, 900), "JPEG", progressive=True)) == (300, 900)
+    assert image_dimensions(b"GIF89a") is None
+
+
+def test_estimate_image_tokens_follows_the_tile_pricing():
+    # 768x768 after scaling, four tiles
+    assert estimate_image_tokens(1024, 1024) == 85 + 170 * 4
+    # Fits to 1024x2048, then 768x1536, six tiles
+    assert estimate_image_tokens(2048, 4096) == 85 + 170 * 6
+    # Small images are not scaled up
+    assert estimate_image_tokens(400, 300) == 85 + 170
+
+
+def test_estimate_image_tokens_from_bytes():
+    assert estimate_image_tokens_from_bytes(encode((1024, 1024), "JPEG")) == 85 + 170 * 4
+    assert estimate_image_tokens_from_bytes(b"not an image") == IMAGE_DEFAULT_TOKENS
+
+
+def test_preprocess_image_downscales_to_the_max_edge():
+    data, original_size, size = preprocess_image(encode((3000, 2000), "PNG"), max_edge=1024, quality=85)
+    assert (original_size, size) == ((3000, 2000), (1024, 683))
+    assert image_dimensions(data) == (1024, 683)
+    assert data[:2] == b"\xff\xd8"
+
+
+def test_preprocess_image_keeps_a_small_jpeg_without_exif():
+    original = encode((800, 600), "JPEG")
+    assert preprocess_image(original, max_edge=1024, quality=85) == (original, (800, 600), (800, 600))
+
+
+def test_preprocess_image_applies_the_orientation_and_drops_exif():
+    exif = Image.Exif()
+    # Orientation 6, the camera was rotated so the image must be turned 90 degrees
+    exif[0x0112] = 6
+    data, original_size, size = preprocess_image(encode((400, 200), "JPEG", exif=exif), max_edge=1024, quality=85)
+    assert original_size == size == (200, 400)
+    with Image.open(io.BytesIO(data)) as image:
+        assert not image.getexif()
@@ -0,0 +1,82 @@
+import asyncio
+import pytest
+from journal import StageJournal
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "journal.sqlite3")
+
+
+def test_recorded_stages_survive_an_interrupted_run(path):
+    async def interrupted_run():
+        journal = StageJournal(path, batch_size=2)
+        journal.start()
+        await journal.record(["1001", "1002", "1003"], "uploaded")
+        # The run stops without closing the journal, so only whole batches reached the file
+        return journal
+
+    asyncio.run(interrupted_run())
+    journal = StageJournal(path)
+    assert journal.completed("uploaded") == {"1001", "1002"}
+    journal.conn.close()
+
+
+def test_close_writes_the_buffered_records(path):
+    async def run():
+        journal = StageJournal(path, batch_size=100)
+        journal.start()
+        await journal.record(["1001", "1002"], "uploaded")
+        await journal.record(["1001"], "described")
+        await journal.record(["1001"], "described")
+        await journal.close()
+
+    asyncio.run(run())
+    journal = StageJournal(path)
+    assert journal.completed("uploaded") == {"1001", "1002"}
+    assert journal.completed("described") == {"1001"}
+    assert journal.summary() == "2 uploaded, 1 described, 0 embedded, 0 indexed"
+    journal.conn.close()
+
+
+def test_records_are_flushed_on_the_interval(path):
+    async def run():
+        journal = StageJournal(path, batch_size=100, flush_interval=0.05)
+        journal.start()
+        await journal.record(["1001"], "indexed")
+        await asyncio.sleep(0.3)
+        completed = journal.completed("indexed")
+        await journal.close()
+        return completed
+
+    assert asyncio.run(run()) == {"1001"}
+
+
+def test_a_completed_run_clears_the_journal(path):
+    async def run():
+        journal = StageJournal(path)
+        journal.start()
+        await journal.record(["1001"], "indexed")
+        await journal.close(clear=True)
+
+    asyncio.run(run())
+    journal = StageJournal(path)
+    assert journal.completed("indexed") == set()
+    journal.conn.close()
+
+
+def test_counts_include_the_records_flushed_so_far(path):
+    async def run():
+        journal = StageJournal(path, batch_size=100)
+        journal.start()
+        await journal.record(["1001", "1002"], "uploaded")
+        await journal.record(["1001"], "embedded")
+        before = journal.counts()
+        await journal.flush()
+        after = journal.counts()
+        await journal.close()
+        return before, after
+
+    before, after = asyncio.run(run())
+    assert before == {"uploaded": 0, "described": 0, "embedded": 0, "indexed": 0}
+    assert after == {"uploaded": 2, "described": 0, "embedded": 1, "indexed": 0}
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from localsearch import LocalSearchIndex, filter_order
+
+RECORDS = [
+    {"CaseID": "A", "VectorRow": 0, "MouldDetected": True, "JobAssigned": "yes", "DateOpened": "2024-03-01T00:00:00Z"},
+    {"CaseID": "B", "VectorRow": 1, "MouldDetected": False, "JobAssigned": "no", "DateOpened": "2024-05-10T00:00:00Z"},
+    {"CaseID": "C", "VectorRow": 2, "MouldDetected": True, "JobAssigned": "no", "DateOpened": "2024-06-20T00:00:00Z"},
+    {"CaseID": "D", "VectorRow": 3, "MouldDetected": False, "JobAssigned": "yes", "DateOpened": "2024-01-15T00:00:00Z"},
+    {"CaseID": "E", "VectorRow": 4, "MouldDetected": True, "JobAssigned": "yes", "DateOpened": "2024-07-04T00:00:00Z"},
+]
+VECTORS = np.array([
+    [1.0, 0.0, 0.0],
+    [0.0, 2.0, 0.0],
+    [0.9, 0.1, 0.0],
+    [0.0, 0.0, 5.0],
+    [0.7, 0.7, 0.0],
+], dtype=np.float32)
+
+
+@pytest.fixture
+def index():
+    return LocalSearchIndex(RECORDS, VECTORS)
+
+
+def case_ids(matches):
+    return [record["CaseID"] for record, _ in matches]
+
+
+def test_search_ranks_by_cosine_similarity(index):
+    matches = index.search([2.0, 0.0, 0.0], k=3)
+    assert case_ids(matches) == ["A", "C", "E"]
+    assert matches[0][1] == pytest.approx(1.0)
+    assert matches[1][1] == pytest.approx(0.9 / np.hypot(0.9, 0.1))
+
+
+def test_filters_apply_before_ranking(index):
+    assert case_ids(index.search([1.0, 0.0, 0.0], k=5, mould_detected=False)) == ["B", "D"]
+    assert case_ids(index.search([1.0, 0.0, 0.0], k=5, job_assigned="yes", opened_after="2024-02-01")) == ["A", "E"]
+    assert case_ids(index.search([1.0, 0.0, 0.0], k=5, opened_before="2024-06-01", mould_detected=True)) == ["A"]
+    assert index.search([1.0, 0.0, 0.0], k=5, opened_after="2025-01-01") == []
+
+
+def test_search_case_leaves_out_the_case_itself(index):
+    assert case_ids(index.search_case("A", k=2)) == ["C", "E"]
+    assert case_ids(index.search_case("A", k=5, mould_detected=True)) == ["C", "E"]
+
+
+def test_filtered_cases_are_contiguous_rows(index):
+    assert [record["CaseID"] for record in filter_order(RECORDS)] == ["B", "D", "C", "A", "E"]
+    for filters in ({"mould_detected": True}, {"mould_detected": False, "job_assigned": "yes"}, {"mould_detected": True, "opened_after": "2024-03-01"}):
+        rows = np.flatnonzero(index.filter_mask(**filters))
+        assert rows.tolist() == list(range(rows[0], rows[-1] + 1))
+
+
+def test_scattered_candidates_are_scored_together(index, monkeypatch):
+    monkeypatch.setattr("localsearch.MAX_CANDIDATE_RUNS", 1)
+    assert case_ids(index.search([1.0, 0.0, 0.0], k=5, job_assigned="yes")) == ["A", "E", "D"]
+
+
+def test_the_json_export_loads(tmp_path):
+    json_path = tmp_path / "indexdata.json"
+    json_path.write_text('[{"CaseID": "A", "MouldDetected": false, "Vector": [0.0, 1.0]}, {"CaseID": "B", "MouldDetected": true, "Vector": [1.0, 1.0]}]')
+    index = LocalSearchIndex.load(str(json_path))
+    assert len(index) == 2
+    assert case_ids(index.search([1.0, 0.0], k=1)) == ["B"]
@@ -0,0 +1,60 @@
+import pytest
+from metrics import RunMetrics, Histogram, BUCKET_GROWTH
+
+
+def test_percentiles_are_within_a_bucket_of_the_true_value():
+    histogram = Histogram()
+    for millisecond in range(1, 1001):
+        histogram.observe(millisecond / 1000)
+    for q, expected in ((0.5, 0.5), (0.95, 0.95), (0.99, 0.99)):
+        assert expected <= histogram.percentile(q) <= expected * BUCKET_GROWTH
+    assert histogram.percentile(1.0) == histogram.max == 1.0
+    assert histogram.count == 1000
+    assert histogram.total == pytest.approx(500.5)
+
+
+def test_an_empty_histogram_reports_zero():
+    assert Histogram().percentile(0.5) == 0.0
+
+
+def test_a_failing_call_is_timed_and_counted_as_an_error():
+    metrics = RunMetrics()
+    with metrics.timer("vision"):
+        pass
+    with pytest.raises(TimeoutError):
+        with metrics.timer("vision"):
+            raise TimeoutError()
+    stage = metrics.stage("vision")
+    assert stage.latency.count == 2
+    assert stage.counters == {"errors": 1}
+
+
+def test_counters_add_up_and_skip_zero_amounts():
+    metrics = RunMetrics()
+    metrics.count("search_upload", "bytes_out", 100)
+    metrics.count("search_upload", "bytes_out", 50)
+    metrics.count("search_upload", "retries", 0)
+    assert metrics.stage("search_upload").counters == {"bytes_out": 150}
+
+
+def test_prometheus_text_has_cumulative_buckets_and_counters():
+    metrics = RunMetrics()
+    for seconds in (0.003, 0.2, 45):
+        metrics.observe("vision", seconds)
+    metrics.count("vision", "retries", 2)
+    lines = metrics.prometheus_text().splitlines()
+    assert 'prepdata_stage_duration_seconds_bucket{stage="vision",le="0.005"} 1' in lines
+    assert 'prepdata_stage_duration_seconds_bucket{stage="vision",le="0.25"} 2' in lines
+    assert 'prepdata_stage_duration_seconds_bucket{stage="vision",le="120"} 3' in lines
+    assert 'prepdata_stage_duration_seconds_bucket{stage="vision",le="+Inf"} 3' in lines
+    assert 'prepdata_stage_duration_seconds_count{stage="vision"} 3' in lines
+    assert 'prepdata_stage_retries_total{stage="vision"} 2' in lines
+
+
+def test_the_prometheus_file_is_replaced_whole(tmp_path):
+    metrics = RunMetrics()
+    metrics.observe("embedding", 0.1)
+    path = tmp_path / "metrics" / "prepdata.prom"
+    metrics.write_prometheus(str(path))
+    assert path.read_text() == metrics.prometheus_text()
+    assert [item.name for item in path.parent.iterdir()] == ["prepdata.prom"]
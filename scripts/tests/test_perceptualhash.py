@@ -0,0 +1,84 @@
+import io
+import random
+import numpy as np
+from PIL import Image
+from perceptualhash import BKTree, DuplicateIndex, format_hashes, hamming_distance, parse_hashes, perceptual_hashes
+
+
+# A hash that differs from value in its lowest bits bits
+def flip(value, bits):
+    return value ^ ((1 << bits) - 1)
+
+
+def test_bktree_matches_a_linear_scan():
+    rng = random.Random(0)
+    values = [rng.getrandbits(64) for _ in range(300)]
+    # Near copies so some searches have matches at small distances
+    values += [flip(value, rng.randint(0, 8)) for value in values[:100]]
+    tree = BKTree()
+    for item, value in enumerate(values):
+        tree.add(value, item)
+    assert len(tree) == len(values)
+
+    for query in values[:50] + [rng.getrandbits(64) for _ in range(20)]:
+        for max_distance in (0, 4, 10):
+            expected = sorted((hamming_distance(query, value), value, item) for item, value in enumerate(values) if hamming_distance(query, value) <= max_distance)
+            assert sorted(tree.search(query, max_distance)) == expected
+
+
+def test_bktree_keeps_items_with_the_same_hash():
+    tree = BKTree()
+    tree.add(0, "a")
+    tree.add(0, "b")
+    tree.add(flip(0, 3), "c")
+    assert sorted(item for _, _, item in tree.search(0, 0)) == ["a", "b"]
+    assert sorted(item for _, _, item in tree.search(0, 3)) == ["a", "b", "c"]
+    assert BKTree().search(0, 64) == []
+
+
+def test_duplicate_index_threshold():
+    index = DuplicateIndex(max_distance=6)
+    index.add((0, 0), "original")
+    assert len(index) == 1
+    assert index.find((flip(0, 6), flip(0, 6))) == "original"
+    # One bit past the threshold on either hash is not a duplicate
+    assert index.find((flip(0, 7), 0)) is None
+    assert index.find((0, flip(0, 7))) is None
+
+
+def test_duplicate_index_prefers_the_closest_case():
+    index = DuplicateIndex(max_distance=6)
+    index.add((flip(0, 5), flip(0, 5)), "further")
+    index.add((flip(0, 2), flip(0, 1)), "closer")
+    assert index.find((0, 0)) == "closer"
+
+
+# A photo-like test card: smooth gradients with a few shapes, so the hashes have structure to capture
+def photo(seed, size=(640, 480), quality=90):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size[1], 0:size[0]] / max(size)
+    pixels = np.stack([np.sin(x * rng.uniform(2, 9) + rng.uniform(0, 3)) * np.cos(y * rng.uniform(2, 9)) for _ in range(3)], axis=-1)
+    image = Image.fromarray(((pixels + 1) * 127).astype(np.uint8))
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality)
+    return output.getvalue(), image
+
+
+def test_a_rescaled_recompressed_copy_hashes_close():
+    data, image = photo(0)
+    copy = io.BytesIO()
+    image.resize((320, 240), Image.BILINEAR).save(copy, format="JPEG", quality=60)
+    original, duplicate = perceptual_hashes(data), perceptual_hashes(copy.getvalue())
+    assert hamming_distance(original[0], duplicate[0]) <= 6
+    assert hamming_distance(original[1], duplicate[1]) <= 6
+
+    other = perceptual_hashes(photo(1)[0])
+    assert hamming_distance(original[0], other[0]) > 10
+
+
+def test_hashes_round_trip_through_the_column_format():
+    hashes = perceptual_hashes(photo(2)[0])
+    assert len(format_hashes(hashes)) == 32
+    assert parse_hashes(format_hashes(hashes)) == hashes
+    assert parse_hashes(None) is None
+    assert parse_hashes("abc") is None
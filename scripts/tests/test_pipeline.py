@@ -0,0 +1,83 @@
+import asyncio
+from pipeline import Pipeline, Stage
+from metrics import RunMetrics
+
+
+def test_items_pass_through_every_stage_in_order():
+    results = []
+
+    async def double(item, emit):
+        await emit(item * 2)
+
+    async def collect(item, emit):
+        results.append(item)
+
+    asyncio.run(Pipeline([Stage("double", double), Stage("collect", collect)]).run(range(5)))
+    assert results == [0, 2, 4, 6, 8]
+
+
+def test_close_runs_before_the_next_stage_stops():
+    results = []
+    buffered = []
+
+    async def buffer(item, emit):
+        buffered.append(item)
+        if len(buffered) == 2:
+            await emit(list(buffered))
+            buffered.clear()
+
+    async def flush(emit):
+        if buffered:
+            await emit(list(buffered))
+
+    async def collect(item, emit):
+        results.append(item)
+
+    stages = [Stage("buffer", buffer, close=flush), Stage("collect", collect, concurrency=3)]
+    asyncio.run(Pipeline(stages).run(range(5)))
+    assert sorted(results) == [[0, 1], [2, 3], [4]]
+
+
+def test_a_failing_item_is_counted_and_the_rest_go_on():
+    results = []
+
+    async def check(item, emit):
+        if item == 2:
+            raise ValueError("bad item")
+        await emit(item)
+
+    async def collect(item, emit):
+        results.append(item)
+
+    stages = [Stage("check", check, concurrency=2), Stage("collect", collect)]
+    asyncio.run(Pipeline(stages).run(range(4)))
+    assert sorted(results) == [0, 1, 3]
+    assert (stages[0].processed, stages[0].failed) == (3, 1)
+    assert stages[1].processed == 3
+
+
+def test_a_failing_close_still_stops_the_next_stage():
+    results = []
+
+    async def forward(item, emit):
+        await emit(item)
+
+    async def fail(emit):
+        raise RuntimeError("flush failed")
+
+    async def collect(item, emit):
+        results.append(item)
+
+    asyncio.run(Pipeline([Stage("forward", forward, close=fail), Stage("collect", collect)]).run([1, 2]))
+    assert results == [1, 2]
+
+
+
+def test_stage_time_is_recorded_in_the_metrics():
+    metrics = RunMetrics()
+
+    async def wait(item, emit):
+        await asyncio.sleep(0.01)
+
+    asyncio.run(Pipeline([Stage("wait", wait)], metrics=metrics).run(range(3)))
+    assert metrics.stage("wait").latency.count == 3
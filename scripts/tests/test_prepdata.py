@@ -0,0 +1,252 @@
+import os
+import json
+import asyncio
+from types import SimpleNamespace
+import pytest
+
+# prepdata connects its clients at import time and needs an ODBC driver manager for aioodbc
+pytest.importorskip("aioodbc")
+os.environ.setdefault("AZURE_BLOB_CONNECTION_STRING", "DefaultEndpointsProtocol=https;AccountName=test;AccountKey=dGVzdA==;EndpointSuffix=core.windows.net")
+import prepdata
+
+
+# Stands in for the embeddings endpoint and records the inputs of every request
+@pytest.fixture
+def embedding_requests(monkeypatch):
+    requests = []
+
+    async def generate_vectors(descriptions):
+        requests.append(list(descriptions))
+        return [[float(len(description))] for description in descriptions]
+
+    monkeypatch.setattr(prepdata, "generate_vectors", generate_vectors)
+    return requests
+
+
+async def embed_all(batcher, descriptions):
+    vectors = await asyncio.gather(*(batcher.embed(case_id, description) for case_id, description in enumerate(descriptions)))
+    await batcher.close()
+    return vectors
+
+
+def test_embedding_batcher_sends_one_request_per_batch(embedding_requests):
+    batcher = prepdata.EmbeddingBatcher(max_batch_tokens=10000, max_batch_size=3, max_wait=0.01)
+    descriptions = ["a", "bb", "ccc", "dddd", "eeeee"]
+    vectors = asyncio.run(embed_all(batcher, descriptions))
+
+    assert embedding_requests == [["a", "bb", "ccc"], ["dddd", "eeeee"]]
+    # Each case gets the vector of its own description back
+    assert vectors == [[1.0], [2.0], [3.0], [4.0], [5.0]]
+
+
+def test_embedding_batcher_starts_a_new_batch_at_the_token_limit(embedding_requests):
+    batcher = prepdata.EmbeddingBatcher(max_batch_tokens=prepdata.estimate_tokens("x" * 400) * 2, max_batch_size=100, max_wait=0.01)
+    asyncio.run(embed_all(batcher, ["x" * 400, "y" * 400, "z" * 400]))
+
+    assert [len(request) for request in embedding_requests] == [2, 1]
+
+
+def test_embedding_batcher_skips_empty_descriptions(embedding_requests):
+    batcher = prepdata.EmbeddingBatcher(max_wait=0.01)
+    vectors = asyncio.run(embed_all(batcher, ["", None, "a leaking tap"]))
+
+    assert vectors == [None, None, [13.0]]
+    assert embedding_requests == [["a leaking tap"]]
+
+
+def test_fast_executemany_is_set_on_the_pyodbc_cursor():
+    class Cursor:
+        pass
+
+    cursor = Cursor()
+    cursor._impl = Cursor()
+    prepdata.enable_fast_executemany(cursor)
+    assert cursor._impl.fast_executemany is True
+    # A cursor that no longer wraps a pyodbc cursor as _impl keeps the plain executemany
+    prepdata.enable_fast_executemany(Cursor())
+
+
+# Search index client whose upload results are scripted per call, as lists of (key, status) or an exception
+class SearchIndex:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.uploads = []
+
+    async def upload_documents(self, documents):
+        self.uploads.append([document["CaseID"] for document in documents])
+        response = self.responses.pop(0) if self.responses else {}
+        if isinstance(response, Exception):
+            raise response
+        return [SimpleNamespace(key=document["CaseID"], succeeded=response.get(document["CaseID"], 200) < 300,
+                                status_code=response.get(document["CaseID"], 200), error_message="error")
+                for document in documents]
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    sleep = asyncio.sleep
+
+    async def no_wait(delay):
+        await sleep(0)
+
+    monkeypatch.setattr(prepdata.asyncio, "sleep", no_wait)
+
+
+def upload(client, documents):
+    return asyncio.run(prepdata.upload_batch(client, [{"CaseID": case_id} for case_id in documents]))
+
+
+def test_batch_documents_bounds_batches_by_count_and_size():
+    documents = [{"CaseID": str(number), "Description": "x" * 100} for number in range(5)]
+    assert [len(batch) for batch in prepdata.batch_documents(documents, max_count=2, max_bytes=10000)] == [2, 2, 1]
+    document_bytes = len(json.dumps(documents[0]))
+    assert [len(batch) for batch in prepdata.batch_documents(documents, max_count=100, max_bytes=document_bytes * 3)] == [3, 2]
+
+
+def test_upload_batch_retries_only_the_transient_failures(no_backoff):
+    client = SearchIndex({"2": 503, "3": 400}, {})
+    assert upload(client, ["1", "2", "3"]) == ["3"]
+    assert client.uploads == [["1", "2", "3"], ["2"]]
+
+
+def test_upload_batch_retries_a_failed_request(no_backoff):
+    client = SearchIndex(ConnectionResetError("connection reset"), {})
+    assert upload(client, ["1", "2"]) == []
+    assert client.uploads == [["1", "2"], ["1", "2"]]
+
+
+def test_upload_batch_gives_up_after_the_retries(no_backoff, monkeypatch):
+    monkeypatch.setattr(prepdata, "SEARCH_UPLOAD_MAX_RETRIES", 2)
+    client = SearchIndex(*[{"1": 429}] * 3)
+    assert upload(client, ["1", "2"]) == ["1"]
+    assert client.uploads == [["1", "2"], ["1"], ["1"]]
+
+
+def test_the_quantization_report_runs_on_the_export(tmp_path, monkeypatch, caplog):
+    base_path = str(tmp_path / "indexdata")
+    exporter = prepdata.CaseExporter(base_path)
+    for number in range(50):
+        exporter.write({"CaseID": str(number), "Vector": [float(number % 7), 1.0, float(number % 3), 0.5]})
+    exporter.close()
+
+    monkeypatch.setattr(prepdata, "QUANTIZATION_REPORT", "float16, int8")
+    prepdata.report_quantization(base_path)
+    assert "Recall@10" in caplog.text
+    assert "int8" in caplog.text
+
+    monkeypatch.setattr(prepdata, "QUANTIZATION_REPORT", "int4")
+    prepdata.report_quantization(base_path)
+    assert "Unknown quantization methods in PREPDATA_QUANTIZATION_REPORT: int4" in caplog.text
+
+
+def test_embedding_batcher_uses_and_fills_the_embedding_cache(embedding_requests, monkeypatch, tmp_path):
+    cache = prepdata.EmbeddingCache(str(tmp_path / "embeddings.bin"))
+    monkeypatch.setattr(prepdata, "embedding_cache", cache)
+    asyncio.run(embed_all(prepdata.EmbeddingBatcher(max_wait=0.01), ["a leaking tap", "a cracked basin"]))
+    # Identical descriptions share one request, and cached ones need none
+    vectors = asyncio.run(embed_all(prepdata.EmbeddingBatcher(max_wait=0.01), ["a leaking  tap", "damp", "damp"]))
+
+    assert embedding_requests == [["a leaking tap", "a cracked basin"], ["damp"]]
+    assert [list(vector) for vector in vectors] == [[13.0], [4.0], [4.0]]
+    cache.close()
+
+
+def test_embedding_batcher_answers_every_case_when_caching_fails(embedding_requests, monkeypatch):
+    class FullDisk:
+        def get(self, key):
+            return None
+
+        def put(self, key, vector):
+            raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(prepdata, "embedding_cache", FullDisk())
+    batcher = prepdata.EmbeddingBatcher(max_wait=0.01)
+    vectors = asyncio.run(asyncio.wait_for(embed_all(batcher, ["a", "bb", "ccc"]), timeout=5))
+    assert vectors == [[1.0], [2.0], [3.0]]
+    assert batcher.in_flight == {}
+
+
+def test_upload_batch_counts_the_bytes_of_every_attempt(no_backoff, monkeypatch):
+    monkeypatch.setattr(prepdata, "metrics", prepdata.RunMetrics())
+    client = SearchIndex({"2": 503}, {})
+    upload(client, ["1", "2"])
+    assert prepdata.metrics.stage("search_upload").counters["bytes_out"] == 2 * len(json.dumps({"CaseID": "1"})) + len(json.dumps({"CaseID": "2"}))
+
+
+# Stands in for the vision deployment. Records every request and answers each image with an assessment,
+# except for the cases in skip, which a batched response leaves out.
+@pytest.fixture
+def vision_requests(monkeypatch):
+    requests = []
+    skip = set()
+
+    async def request_vision(payload, estimated_tokens, bytes_out, label=""):
+        requests.append(payload)
+        texts = [part["text"] for part in payload["messages"][1]["content"] if part["type"] == "text"]
+        case_ids = [text.removeprefix("Case ID: ") for text in texts if text.startswith("Case ID: ")]
+        assessment = {"description": "A leaking tap.", "repair": "Replace the washer.", "tradesman": "Plumber", "mould_detected": False, "mould_severity": "none"}
+        if not case_ids:
+            return json.dumps(assessment)
+        return json.dumps({"assessments": [{"case_id": case_id, **assessment} for case_id in case_ids if case_id not in skip]})
+
+    monkeypatch.setattr(prepdata, "request_vision", request_vision)
+    return SimpleNamespace(payloads=requests, skip=skip)
+
+
+async def describe_all(batcher, case_ids):
+    descriptions = await asyncio.gather(*(batcher.describe(case_id, "aW1hZ2U=") for case_id in case_ids))
+    await batcher.close()
+    return descriptions
+
+
+def test_vision_batcher_sends_concurrent_images_in_one_request(vision_requests):
+    descriptions = asyncio.run(describe_all(prepdata.VisionBatcher(max_images=4, max_wait=10), ["1", "2", "3", "4"]))
+    assert len(vision_requests.payloads) == 1
+    assert vision_requests.payloads[0]["response_format"] == {"type": "json_object"}
+    assert all(prepdata.parse_assessment(description)["Tradesman"] == "Plumber" for description in descriptions)
+
+
+def test_vision_batcher_describes_a_case_missing_from_the_response_on_its_own(vision_requests):
+    vision_requests.skip.add("2")
+    batcher = prepdata.VisionBatcher(max_images=3, max_wait=10)
+    descriptions = asyncio.run(describe_all(batcher, ["1", "2", "3"]))
+    assert all(descriptions)
+    assert [len(payload["messages"][1]["content"]) for payload in vision_requests.payloads] == [7, 2]
+    assert batcher.fallbacks == 1
+
+
+def test_vision_batcher_sends_a_partial_request_after_the_wait(vision_requests):
+    descriptions = asyncio.run(describe_all(prepdata.VisionBatcher(max_images=4, max_wait=0.01), ["1"]))
+    assert descriptions[0]
+    # A request with one image is a single image request, with the single image prompt
+    assert vision_requests.payloads[0]["messages"][0]["content"][0]["text"] == prepdata.VISION_SYSTEM_PROMPT
+
+
+def test_cached_descriptions_are_keyed_by_the_model_rather_than_the_deployment(monkeypatch, tmp_path):
+    monkeypatch.setattr(prepdata, "description_cache", prepdata.DescriptionCache(str(tmp_path / "descriptions.sqlite3")))
+    deployments = {name: prepdata.Deployment(name, "https://example.openai.azure.com", "key", name, 60, 60000, 1, model="gpt-4o") for name in ("gpt-4o-east", "gpt-4o-batch")}
+    monkeypatch.setattr(prepdata, "vision_pool", prepdata.DeploymentPool("Vision", [deployments["gpt-4o-east"]]))
+    response = json.dumps({"description": "A leaking tap.", "repair": "Replace the washer.", "tradesman": "Plumber", "mould_detected": False, "mould_severity": "none"})
+    cache_key, _ = prepdata.lookup_description("hash", "1001")
+    prepdata.store_description(cache_key, response, "1001")
+
+    monkeypatch.setattr(prepdata, "vision_pool", prepdata.DeploymentPool("Vision", [deployments["gpt-4o-batch"]]))
+    assert prepdata.lookup_description("hash", "1002") == (cache_key, (response, False))
+    prepdata.description_cache.conn.close()
+
+
+def test_the_quantization_report_runs_on_the_merged_export_of_the_shards(tmp_path, monkeypatch):
+    reports = []
+    monkeypatch.setattr(prepdata, "EXPORT_PATH", str(tmp_path / "indexdata"))
+    monkeypatch.setattr(prepdata, "SHARD_STATUS_PATH", str(tmp_path / "status.json"))
+    monkeypatch.setattr(prepdata, "QUANTIZATION_REPORT", "int8")
+    monkeypatch.setattr(prepdata, "report_export", lambda path, methods: reports.append((path, methods)))
+    for index in range(2):
+        exporter = prepdata.CaseExporter(prepdata.shard_path(prepdata.EXPORT_PATH, (index, 2)))
+        exporter.write({"CaseID": str(index), "Vector": [1.0, 0.5]})
+        exporter.close()
+
+    # Neither shard wrote a status, so the merge does not move the watermark and needs no database
+    assert asyncio.run(prepdata.merge_shards(None, 2)) is False
+    assert reports == [(prepdata.EXPORT_PATH, ["int8"])]
+    assert len(list(prepdata.iter_documents(prepdata.EXPORT_PATH))) == 2
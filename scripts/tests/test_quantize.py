@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from localsearch import LocalSearchIndex
+from quantize import Float16Quantizer, Int8Quantizer, ProductQuantizer, QuantizedIndex, normalize, quantization_report, report_export
+from export import CaseExporter
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    rng = np.random.default_rng(3)
+    vectors = rng.standard_normal((800, 64)).astype(np.float32)
+    records = [{"CaseID": str(row), "VectorRow": row, "MouldDetected": row % 3 == 0} for row in range(len(vectors))]
+    return records, vectors
+
+
+@pytest.mark.parametrize("quantizer, tolerance", [(Float16Quantizer(), 1e-3), (Int8Quantizer(), 0.05), (ProductQuantizer(subspaces=16, iterations=8), 0.35)])
+def test_codes_approximate_the_cosine_scores(corpus, quantizer, tolerance):
+    _, vectors = corpus
+    unit = normalize(vectors)
+    quantizer.train(unit)
+    codes = quantizer.encode(unit)
+    query = unit[5]
+    assert np.abs(quantizer.scores(codes, query) - unit @ query).max() < tolerance
+
+
+def test_code_sizes(corpus):
+    records, vectors = corpus
+    assert QuantizedIndex(records, vectors, Int8Quantizer()).codes.nbytes == 800 * 64
+    assert QuantizedIndex(records, vectors, ProductQuantizer(subspaces=16, iterations=2)).codes.nbytes == 800 * 16
+
+
+def test_rerank_recovers_the_exact_results(corpus):
+    records, vectors = corpus
+    exact = LocalSearchIndex(records, vectors)
+    index = QuantizedIndex(records, vectors, ProductQuantizer(subspaces=16, iterations=8), rerank=10)
+    for query in vectors[:20]:
+        assert [row for row, _ in index.top_k(query, 5)] == [row for row, _ in exact.top_k(query, 5)]
+
+
+def test_filters_and_the_case_itself_are_left_out(corpus):
+    records, vectors = corpus
+    index = QuantizedIndex(records, vectors, Int8Quantizer())
+    matches = index.search_case("9", k=5, mould_detected=True)
+    assert len(matches) == 5
+    assert all(record["MouldDetected"] and record["CaseID"] != "9" for record, _ in matches)
+
+
+def test_saved_codes_search_like_the_index_that_saved_them(corpus, tmp_path):
+    records, vectors = corpus
+    base_path = str(tmp_path / "indexdata")
+    exporter = CaseExporter(base_path)
+    for record in records:
+        exporter.write(dict(record, Vector=vectors[record["VectorRow"]]))
+    exporter.close()
+
+    index = QuantizedIndex(records, vectors, Int8Quantizer())
+    index.save(str(tmp_path / "codes.npz"))
+    loaded = QuantizedIndex.load(str(tmp_path / "codes.npz"), base_path)
+    assert [record["CaseID"] for record, _ in loaded.search_case("12", k=5)] == [record["CaseID"] for record, _ in index.search_case("12", k=5)]
+
+
+def test_quantization_report(corpus):
+    records, vectors = corpus
+    report = quantization_report(records, vectors, ["float16", "int8"], vectors[:20], k=10, rerank=4, subspaces=16)
+    assert report["float16"]["saved"] == pytest.approx(0.5)
+    assert report["int8"]["saved"] == pytest.approx(0.75)
+    assert report["float16"]["recall"] >= 0.95
+    assert report["int8"]["reranked_recall"] >= report["int8"]["recall"] - 0.01
+
+
+def test_report_export_of_an_empty_export(tmp_path):
+    CaseExporter(str(tmp_path / "indexdata")).close()
+    assert report_export(str(tmp_path / "indexdata"), ["int8"]) == {}
@@ -0,0 +1,75 @@
+import asyncio
+import pytest
+import ratelimit
+from ratelimit import RateLimiter, TokenBucket, parse_retry_after
+
+
+# A clock the tests move by hand, so the buckets refill deterministically
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock)
+    return clock
+
+
+def test_parse_retry_after_prefers_milliseconds():
+    assert parse_retry_after({"retry-after-ms": "1500", "Retry-After": "9"}) == 1.5
+    assert parse_retry_after({"Retry-After": "9"}) == 9
+    assert parse_retry_after({"Retry-After": "Wed, 21 Oct 2026 07:28:00 GMT"}) is None
+    assert parse_retry_after(None) is None
+
+
+def test_token_bucket_holds_a_burst_and_refills_at_the_minute_rate(clock):
+    bucket = TokenBucket(60, burst_seconds=10)
+    assert bucket.wait_time(10) == 0
+    bucket.consume(10)
+    assert bucket.wait_time(1) == pytest.approx(1)
+
+    clock.now += 4
+    assert bucket.wait_time(4) == 0
+    # The bucket never holds more than the burst, however long it sat idle
+    clock.now += 3600
+    bucket.refill()
+    assert bucket.tokens == pytest.approx(10)
+
+
+def test_token_bucket_lets_an_oversized_request_through_once_full(clock):
+    bucket = TokenBucket(60, burst_seconds=10)
+    assert bucket.wait_time(500) == 0
+    bucket.consume(500)
+    assert bucket.tokens == 0
+
+
+def test_acquire_waits_for_the_token_budget():
+    async def run():
+        limiter = RateLimiter("Test", requests_per_minute=6000, tokens_per_minute=600, max_concurrency=4)
+        # The token bucket holds 100 tokens and refills at 10 per second
+        await limiter.acquire(100)
+        started = asyncio.get_running_loop().time()
+        await limiter.acquire(2)
+        return asyncio.get_running_loop().time() - started
+
+    assert 0.1 <= asyncio.run(run()) < 1
+
+
+def test_pause_holds_back_requests(clock):
+    limiter = RateLimiter("Test", 6000, 60000, 4)
+    limiter.pause(5)
+    limiter.pause(2)
+    assert limiter.paused_until == clock.now + 5
+
+
+def test_backoff_is_jittered_and_capped():
+    limiter = RateLimiter("Test", 60, 60, 1, base_delay=1, max_delay=8)
+    for attempt in range(6):
+        delay = min(8, 2 ** attempt)
+        assert delay / 2 <= limiter.backoff(attempt) <= delay
+
@@ -0,0 +1,38 @@
+import argparse
+import pytest
+from shards import parse_shard, read_status, shard_of, shard_path, write_status
+
+
+def test_every_key_belongs_to_one_shard_in_every_process():
+    # A CaseID read back from SQL as a number belongs to the same shard as the string it was drawn as
+    assert shard_of(100001, 4) == shard_of("100001", 4)
+    counts = [0] * 4
+    for case_id in range(100000, 104000):
+        counts[shard_of(case_id, 4)] += 1
+    # crc32 spreads the keys evenly
+    assert min(counts) > 900
+
+
+def test_shard_values_are_parsed_and_checked():
+    assert parse_shard("2/8") == (2, 8)
+    for value in ("2", "a/4", "4/4", "-1/4", "0/0"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_shard(value)
+
+
+def test_each_shard_gets_its_own_files():
+    assert shard_path("scripts/.cache/journal.sqlite3", (0, 4)) == "scripts/.cache/journal.shard-0-of-4.sqlite3"
+    assert shard_path("scripts/indexdata", (3, 4)) == "scripts/indexdata.shard-3-of-4"
+    assert shard_path("scripts/indexdata", None) == "scripts/indexdata"
+
+
+def test_status_files_round_trip(tmp_path):
+    path = str(tmp_path / "status" / "status.shard-0-of-2.json")
+    status = {"shard": 0, "shards": 2, "stages": {"uploaded": 5}, "done": False}
+    write_status(path, status)
+    assert read_status(path) == status
+    assert not (tmp_path / "status" / "status.shard-0-of-2.json.tmp").exists()
+    # A missing or unreadable status reads as no status
+    assert read_status(str(tmp_path / "missing.json")) is None
+    (tmp_path / "half.json").write_text('{"shard": 0, "sta')
+    assert read_status(str(tmp_path / "half.json")) is None
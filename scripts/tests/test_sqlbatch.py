@@ -0,0 +1,67 @@
+import asyncio
+from sqlbatch import BatchWriter
+
+
+# Records the batches handed to it, and fails the ones that contain a row equal to fail
+class Table:
+    def __init__(self, fail=None):
+        self.batches = []
+        self.fail = fail
+
+    async def write_batch(self, rows):
+        if self.fail in rows:
+            raise RuntimeError("deadlock victim")
+        self.batches.append(rows)
+
+
+def test_rows_are_written_in_batches_and_the_rest_on_close():
+    table = Table()
+
+    async def run():
+        writer = BatchWriter("Test", table.write_batch, batch_size=3)
+        for row in range(7):
+            await writer.add(row)
+        assert table.batches == [[0, 1, 2], [3, 4, 5]]
+        await writer.close()
+        return writer
+
+    writer = asyncio.run(run())
+    assert table.batches == [[0, 1, 2], [3, 4, 5], [6]]
+    assert (writer.written, writer.failed) == (7, 0)
+
+
+def test_a_failed_batch_is_counted_and_does_not_stop_the_writer():
+    table = Table(fail=4)
+
+    async def run():
+        writer = BatchWriter("Test", table.write_batch, batch_size=3)
+        for row in range(8):
+            await writer.add(row)
+        await writer.close()
+        return writer
+
+    writer = asyncio.run(run())
+    assert table.batches == [[0, 1, 2], [6, 7]]
+    assert (writer.written, writer.failed) == (5, 3)
+
+
+def test_close_without_rows_writes_nothing():
+    table = Table()
+    asyncio.run(BatchWriter("Test", table.write_batch, batch_size=3).close())
+    assert table.batches == []
+
+
+def test_a_slow_trickle_is_flushed_on_the_interval():
+    table = Table()
+
+    async def run():
+        writer = BatchWriter("Test", table.write_batch, batch_size=100, flush_interval=0.05)
+        writer.start()
+        await writer.add("a")
+        await asyncio.sleep(0.2)
+        assert table.batches == [["a"]]
+        await writer.add("b")
+        await writer.close()
+
+    asyncio.run(run())
+    assert table.batches == [["a"], ["b"]]